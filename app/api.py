@@ -1,7 +1,10 @@
 import logging
+import time
 from requests import Session
+from app import cassette
 from app.dtos import DeviceResponse
 from app.helpers import status_code_success
+from app.metrics import metrics
 
 requestSession = Session()
 logger = logging.getLogger(__name__)
@@ -13,10 +16,16 @@ def fetch_devices_metadata_from_space_invader_api(
         limit: int = 3000,
         page: int = 0,
 ) -> DeviceResponse:
-    response = requestSession.get(url, headers=headers, timeout=60, params={
+    started_at = time.perf_counter()
+    params = {
         "limit": limit,
         "offset": page,
-    })
+    }
+    response = cassette.send(
+        "haystacks", "GET", url, params,
+        lambda: requestSession.get(url, headers=headers, timeout=60, params=params),
+    )
+    metrics.observe("haystacks_request_seconds", time.perf_counter() - started_at, operation="device_fetch")
     _handle_response(response)
     return DeviceResponse(**response.json())
 
@@ -26,12 +35,17 @@ def send_reports_to_api(url, data, headers=None):
     if not url:
         return
 
-    response = requestSession.post(
-        url,
-        headers=headers,
-        json=data,
-        timeout=60,
+    started_at = time.perf_counter()
+    response = cassette.send(
+        "haystacks", "POST", url, data,
+        lambda: requestSession.post(
+            url,
+            headers=headers,
+            json=data,
+            timeout=60,
+        ),
     )
+    metrics.observe("haystacks_request_seconds", time.perf_counter() - started_at, operation="upload")
     _handle_response(response)
 
 
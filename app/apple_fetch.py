@@ -6,12 +6,20 @@ import datetime
 import json
 import logging
 import time
-from collections import deque
+import weakref
+from contextlib import contextmanager
+from typing import Callable
 
-from requests import Session
+from app.cassette import REPLAY, active_cassette
 from app.credentials.base import CredentialsService
+from app.credentials.pool import as_credentials_pool
 from app.exceptions import AppleAuthCredentialsExpired
+from app.hedging import RequestHedger
+from app.log import RATE_LIMITED
 from app.helpers import status_code_success
+from app.metrics import metrics
+from app.profiling import phase
+from app.response_cache import ResponseCache
 from app.date import unix_epoch, date_milliseconds
 from pydantic import BaseModel, Field
 
@@ -57,35 +65,88 @@ class ResponseDto(BaseModel):
         return self.statusCode == "200"
 
 
-def apple_fetch(credentials_service: CredentialsService, ids: list[str], minutes_ago: int = 15) -> ResponseDto:
+def apple_fetch(
+        credentials_service: CredentialsService,
+        ids: list[str],
+        minutes_ago: int = 15,
+        on_results: Callable[[list[AppleLocation]], None] = None,
+) -> ResponseDto:
+    """
+    Locations of `ids` (most active devices first) over the lookback, newest windows are requested first.
+    `on_results` gets the locations of every chunk of requests as soon as it completes.
+    """
     logger.info("Fetching locations from Apple API for %s IDs with %d minutes lookback", len(ids), minutes_ago)
     start_date = unix_epoch() - minutes_ago * 60
     end_date = unix_epoch()
 
-    if is_short_time_range(start_date, end_date):
-        logger.info("Using ID-only batching strategy (time range < 20 minutes)")
-        payloads = generate_request_payloads(
-            device_ids=ids, start_date=start_date, end_date=end_date, device_batch_size=1, time_chunk_size=None
-        )
-    else:
-        logger.info("Using ID+time batching strategy (time range >= 20 minutes)")
-        # 3600 (seconds in an hour) * 24(hours in a day) = seconds in a day
-        payloads = generate_request_payloads(
-            device_ids=ids, start_date=start_date, end_date=end_date, device_batch_size=1, time_chunk_size=3600*24
+    with phase("payload_planning") as stats:
+        payloads = plan_request_payloads(ids, start_date, end_date)
+        stats.items += len(payloads)
+
+    # Share the credentials cache between all chunks of this fetch
+    credentials_service = as_credentials_pool(credentials_service)
+
+    # With `on_results` every chunk is parsed as it completes, and not again when merging
+    parsed_results = []
+
+    def handle_results(locations: list[AppleLocation]):
+        parsed_results.extend(locations)
+        on_results(locations)
+
+    with phase("apple_fetch") as stats:
+        responses = run_async(
+            _fetch_payload_chunks(
+                credentials_service, split_chunks(payloads, settings.FETCH_CONCURRENCY),
+                on_results=handle_results if on_results is not None else None,
+            )
         )
+        stats.items += len(responses)
+
+    with phase("json_parse") as stats:
+        if on_results is not None:
+            response_dto = create_merged_response_dto(parsed_results)
+        else:
+            response_dto = merge_successful_responses(responses)
+        stats.items += len(response_dto.results)
+    return response_dto
+
 
+async def _fetch_payload_chunks(
+        credentials_service: CredentialsService,
+        chunks: list[list[dict]],
+        on_results: Callable[[list[AppleLocation]], None] = None,
+) -> list:
     responses = []
-    chunks = split_chunks(payloads, 20)
-    for i, payload_chunk in enumerate(chunks):
-        logger.info(f"[{i+1}/{len(chunks)}] Processing requests chunk")
-        responses.extend(asyncio.run(try_fetch_payloads(credentials_service, payload_chunk, max_attempts_per_payload=2)))
+    try:
+        for i, payload_chunk in enumerate(chunks):
+            logger.debug(f"[{i+1}/{len(chunks)}] Processing requests chunk")
+            chunk_responses = await try_fetch_payloads(credentials_service, payload_chunk, max_attempts_per_payload=2)
+            responses.extend(chunk_responses)
+            if on_results is not None:
+                on_results(extract_and_combine_all_results(chunk_responses))
+    finally:
+        if _event_loop_runner is None:
+            await acsnservice_client.close()
+    return responses
 
-    return merge_successful_responses(responses)
+
+def plan_request_payloads(ids: list[str], start_date: int, end_date: int) -> list[dict]:
+    """The acsnservice requests for `ids` over the range, batched as configured in `settings`"""
+    if is_short_time_range(start_date, end_date):
+        logger.info(f"Using ID-only batching strategy (time range < {settings.FETCH_SHORT_RANGE_SECONDS} seconds)")
+        time_chunk_size = None
+    else:
+        logger.info(f"Using ID+time batching strategy (time range >= {settings.FETCH_SHORT_RANGE_SECONDS} seconds)")
+        time_chunk_size = settings.FETCH_TIME_CHUNK_SECONDS
+    return generate_request_payloads(
+        device_ids=ids, start_date=start_date, end_date=end_date,
+        device_batch_size=settings.FETCH_DEVICE_BATCH_SIZE, time_chunk_size=time_chunk_size,
+        bucket_size=settings.FETCH_BUCKET_SECONDS,
+    )
 
 
 def is_short_time_range(start_date: int, end_date: int) -> bool:
-    twenty_minutes_in_seconds = 20 * 60
-    return (end_date - start_date) < twenty_minutes_in_seconds
+    return (end_date - start_date) < settings.FETCH_SHORT_RANGE_SECONDS
 
 
 def build_acsnservice_payload(ids: list[str], start_date: int, end_date: int) -> dict:
@@ -112,24 +173,55 @@ def create_time_chunks(start_date: int, end_date: int, time_chunk_size_in_second
     return chunks
 
 
-def generate_request_payloads(device_ids: list[str], start_date: int, end_date: int, device_batch_size: int = 20, time_chunk_size: int = None):
+def create_aligned_time_chunks(
+        start_date: int, end_date: int, bucket_size: int, time_chunk_size: int = None
+) -> list[tuple[int, int]]:
+    """
+    Windows from `start_date` rounded down to a multiple of `bucket_size` (since the epoch) up to `end_date`.
+    The closed buckets are split at multiples of `time_chunk_size` (one window without it), the open bucket
+    gets a window of its own. Every run thus asks for the same closed windows, which can be cached.
+    """
+    aligned_start = start_date - start_date % bucket_size
+    open_start = max(end_date - end_date % bucket_size, aligned_start)
+    chunks = []
+    if open_start > aligned_start:
+        if time_chunk_size is None:
+            chunks.append((aligned_start, open_start))
+        else:
+            chunk_size = max(time_chunk_size - time_chunk_size % bucket_size, bucket_size)
+            current_start = aligned_start
+            while current_start < open_start:
+                current_end = min(current_start - current_start % chunk_size + chunk_size, open_start)
+                chunks.append((current_start, current_end))
+                current_start = current_end
+    if end_date > open_start:
+        chunks.append((open_start, end_date))
+    return chunks
+
+
+def generate_request_payloads(
+        device_ids: list[str], start_date: int, end_date: int, device_batch_size: int = 20, time_chunk_size: int = None,
+        bucket_size: int = 0,
+):
     payloads = []
     id_batches = split_chunks(device_ids, batch_size=device_batch_size)
-    logger.info(f"Broke down {len(device_ids)} devices into {len(id_batches)} batches of {device_batch_size} devices each")
+    logger.debug(f"Broke down {len(device_ids)} devices into {len(id_batches)} batches of {device_batch_size} devices each")
 
     time_chunks = [(start_date, end_date)]
 
-    if time_chunk_size is not None:
+    if bucket_size > 0:
+        time_chunks = create_aligned_time_chunks(start_date, end_date, bucket_size, time_chunk_size)
+        logger.debug(f"Aligned time range to {len(time_chunks)} chunks on {bucket_size} second buckets")
+    elif time_chunk_size is not None:
         time_chunks = create_time_chunks(start_date, end_date, time_chunk_size)
-        logger.info(f"Broke down time range into {len(time_chunks)} chunks of {time_chunk_size} seconds each")
+        logger.debug(f"Broke down time range into {len(time_chunks)} chunks of {time_chunk_size} seconds each")
 
+    # Newest windows first (in device order within a window), so the freshest locations arrive first
     payloads = []
-    for device_id_batch in id_batches:
+    for time_chunk in reversed(time_chunks):
         payloads.extend(
-            [
-                build_acsnservice_payload(device_id_batch, time_chunk[0], time_chunk[1])
-                for time_chunk in time_chunks
-            ]
+            build_acsnservice_payload(device_id_batch, time_chunk[0], time_chunk[1])
+            for device_id_batch in id_batches
         )
 
     logger.info(f"Created {len(payloads)} payloads")
@@ -140,79 +232,92 @@ async def try_fetch_payloads(
         credentials_service: CredentialsService, payloads: list[dict], max_attempts_per_payload: int = 3,
         max_credentials_attempts: int = 10, wait_time_for_credentials_attempt: int = 1
 ) -> list:
-    responses = []
-
-    queue = deque(payloads)
-    attempts = {}
-
-    failed_payloads = 0
-    successful_payloads = 0
-    credentials_attempts = 0
-
-    idx = 0
-
-    security_headers = credentials_service\
-        .get_credentials()\
-        .model_dump(mode='json', by_alias=True)
-
-    while len(queue) != 0:
-        tasks = [
-            _async_acsnservice_fetch(security_headers, payload["ids"], payload["startDate"], payload["endDate"])
-            for payload in queue
-        ]
-        keys = [
-            " ".join(payload["ids"]) + str(payload["startDate"]) + str(payload["endDate"]) for payload in queue
-        ]
-
-        out = await asyncio.gather(*tasks, return_exceptions=True)
-
-        any_401 = False
-        new_queue = []
-
-        for payload, response in zip(queue, out):
-            key = " ".join(payload["ids"]) + str(payload["startDate"]) + str(payload["endDate"])
-
-            if isinstance(response, Exception):
-                logger.warning(f"Caught exception during Apple request: {response}")
-                if attempts.get(key, 0) <= max_attempts_per_payload:
-                    attempts[key] = attempts.get(key, 0) + 1
-                    new_queue.append(payload)
-
-                continue
-
-            if not status_code_success(response.status_code):
-                logger.warning(f"Received {response.status_code} (Full response: `{response.text}`)")
-
-                if response.status_code == 401:
-                    any_401 = True
-
-                if attempts.get(key, 0) <= max_attempts_per_payload:
-                    attempts[key] = attempts.get(key, 0) + 1
-                    new_queue.append(payload)
-            else:
-                responses.append(response)
-
-            queue = new_queue
-
-        if any_401:
-            logger.info(
-                f"Got 401 - waiting for {wait_time_for_credentials_attempt} seconds and fetching credentials again"
-            )
-            time.sleep(wait_time_for_credentials_attempt)
-
-            if credentials_attempts == max_credentials_attempts:
-                logger.error(
-                    f"Credential fetching retries exceeded (max retries: {max_credentials_attempts}) - exiting early"
+    pool = as_credentials_pool(credentials_service)
+    await pool.ensure_loaded()
+    if await pool.acquire().credentials.get_headers_async() is None:
+        raise CredentialsExpired("No credentials available")
+    refresh_count_at_start = pool.refresh_count
+    max_refreshes = max_credentials_attempts * len(pool.accounts)
+    breaker = pool.breaker
+
+    async def fetch_payload(payload: dict) -> AppleHTTPResponse | None:
+        cached = response_cache.get(payload)
+        if cached is not None:
+            return AppleHTTPResponse(status_code=200, text=cached)
+        attempts = 0
+
+        while True:
+            account = pool.acquire()
+            if breaker is not None:
+                await breaker.before_request(account)
+            security_headers = await account.credentials.get_headers_async()
+
+            async def send() -> AppleHTTPResponse:
+                # Hedged duplicates are throttled and counted like any other request of the account
+                await account.throttle()
+                account.in_flight += 1
+                account.requests += 1
+                try:
+                    return await _async_acsnservice_fetch(security_headers, payload)
+                finally:
+                    account.in_flight -= 1
+
+            try:
+                response = await acsnservice_hedger.run(
+                    send, succeeded=lambda r: status_code_success(r.status_code)
+                )
+            except Exception as e:
+                logger.warning(f"Caught exception during Apple request: {e}", extra=RATE_LIMITED)
+                metrics.increment("apple_fetch_responses_total", status="exception")
+                response = None
+
+            if response is not None:
+                if status_code_success(response.status_code):
+                    account.record_success()
+                    response_cache.put(payload, response.text)
+                    if breaker is not None:
+                        await breaker.record_success(account, security_headers)
+                    return response
+
+                logger.warning(
+                    f"Received {response.status_code} (Response: `{response.text[:200]}`)", extra=RATE_LIMITED
                 )
-                raise CredentialsExpired(f"Credential fetching retries exceeded (max retries: {max_credentials_attempts}")
-
-            credentials_attempts += 1
-
-            security_headers = credentials_service \
-                .get_credentials() \
-                .model_dump(mode='json', by_alias=True)
 
+                if response.status_code == 401:
+                    pool.record_unauthorized(account)
+                    # Credentials fetched while waiting behind the breaker count as well
+                    if pool.refresh_count - refresh_count_at_start >= max_refreshes:
+                        logger.error(
+                            f"Credential fetching retries exceeded (max retries: {max_credentials_attempts}) - exiting early"
+                        )
+                        raise CredentialsExpired(
+                            f"Credential fetching retries exceeded (max retries: {max_credentials_attempts}")
+                    if breaker is not None:
+                        # Every worker waits in `before_request` until newer credentials were written
+                        await breaker.record_unauthorized(account, security_headers)
+                    else:
+                        # Concurrent 401s for the same headers share a single credentials fetch
+                        await account.credentials.refresh(
+                            stale_headers=security_headers, wait=wait_time_for_credentials_attempt
+                        )
+
+            if attempts > max_attempts_per_payload:
+                return None
+            attempts += 1
+            metrics.increment("apple_fetch_retries_total")
+
+    tasks = [asyncio.ensure_future(fetch_payload(payload)) for payload in payloads]
+    try:
+        out = await asyncio.gather(*tasks)
+    except (CredentialsExpired, AppleAuthCredentialsExpired):
+        for task in tasks:
+            task.cancel()
+        raise
+
+    responses = [response for response in out if response is not None]
     logger.info(f"{len(responses)}/{len(payloads)} responses retrieved")
+    if len(pool.accounts) > 1:
+        logger.info(f"Credentials accounts: {pool.stats()}")
 
     return responses
 
@@ -224,6 +329,7 @@ def merge_successful_responses(responses: list[AppleHTTPResponse]) -> ResponseDt
 
     if len(responses) == 1:
         response_dto = ResponseDto(**responses[0].json())
+        metrics.observe("apple_fetch_results_per_request", len(response_dto.results))
         logger.info("Single response with %d results", len(response_dto.results))
         return response_dto
 
@@ -238,6 +344,7 @@ def extract_and_combine_all_results(responses: list[AppleHTTPResponse]) -> list[
         if status_code_success(response.status_code):
             response_data = response.json()
             response_dto = ResponseDto(**response_data)
+            metrics.observe("apple_fetch_results_per_request", len(response_dto.results))
             combined_results.extend(response_dto.results)
     return combined_results
 
@@ -250,20 +357,116 @@ def create_merged_response_dto(results: list[AppleLocation]) -> ResponseDto:
     return ResponseDto(results=results, statusCode="200")
 
 
-async def _async_acsnservice_fetch(security_headers, ids, startdate, enddate) -> AppleHTTPResponse:
-    async with aiohttp.ClientSession(headers=security_headers, timeout=aiohttp.ClientTimeout(total=60)) as session:
-        out = await session.post(
-            "https://gateway.icloud.com/acsnservice/fetch",
-            json={
-                "search": [
-                    {
-                        "startDate": date_milliseconds(startdate),
-                        "endDate": date_milliseconds(enddate),
-                        "ids": ids,
-                    }
-                ]
-            },
-        )
+class AcsnserviceClient:
+    """
+    Pooled HTTP session for acsnservice requests. aiohttp sessions are bound to an event loop,
+    so there is one session per loop (e.g. one per backfill worker thread).
+    """
+
+    def __init__(self, connection_limit: int = 100):
+        self._connection_limit = connection_limit
+        self._sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
 
-        r = AppleHTTPResponse(status_code=out.status, text=await out.text())
-        return r
\ No newline at end of file
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = self._sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._connection_limit),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return session
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+acsnservice_client = AcsnserviceClient()
+# Latencies are tracked for the lifetime of the process (collector daemon, warm Lambda containers)
+acsnservice_hedger = RequestHedger(
+    enabled=settings.FETCH_HEDGE_ENABLED,
+    percentile=settings.FETCH_HEDGE_PERCENTILE,
+    max_ratio=settings.FETCH_HEDGE_MAX_RATIO,
+    min_delay=settings.FETCH_HEDGE_MIN_DELAY_SECONDS,
+)
+# Closed windows only exist when lookbacks are aligned to buckets, otherwise every window is new
+response_cache = ResponseCache(
+    enabled=settings.FETCH_BUCKET_SECONDS > 0,
+    max_size=settings.FETCH_RESPONSE_CACHE_SIZE,
+    directory=settings.FETCH_RESPONSE_CACHE_DIR,
+    settle_seconds=settings.FETCH_RESPONSE_CACHE_SETTLE_SECONDS,
+    max_age=settings.FETCH_RESPONSE_CACHE_MAX_AGE_SECONDS,
+)
+_event_loop_runner: asyncio.Runner | None = None
+
+
+def run_async(coro):
+    """Run `coro` on the persistent event loop if one is active (see `persistent_event_loop`), else on a new one"""
+    if _event_loop_runner is not None:
+        return _event_loop_runner.run(coro)
+    return asyncio.run(coro)
+
+
+@contextmanager
+def persistent_event_loop():
+    """Keep one event loop (and with it the pooled acsnservice connections) alive across fetches"""
+    global _event_loop_runner
+    with asyncio.Runner() as runner:
+        _event_loop_runner = runner
+        try:
+            yield runner
+        finally:
+            _event_loop_runner = None
+            runner.run(acsnservice_client.close())
+
+
+def _acsnservice_search(payload: dict) -> dict:
+    """
+    The search sent to acsnservice. The payload dates are already in milliseconds and, as before the payload was
+    passed through, go through `date_milliseconds` once more: this is the format the gateway has always been sent,
+    any change to it has to be validated against the real gateway first.
+    """
+    return {
+        "startDate": date_milliseconds(payload["startDate"]),
+        "endDate": date_milliseconds(payload["endDate"]),
+        "ids": payload["ids"],
+    }
+
+
+async def _async_acsnservice_fetch(security_headers, payload: dict) -> AppleHTTPResponse:
+    """`payload` as built by `build_acsnservice_payload` (dates already in milliseconds)"""
+    cassette = active_cassette()
+    started_at = time.perf_counter()
+    r = None
+    cancelled = False
+    try:
+        if cassette is not None and cassette.mode == REPLAY:
+            entry = cassette.replay("acsnservice", "POST", settings.ACSNSERVICE_URL, payload)
+            if entry is None:
+                raise LookupError(f"Request for {payload['ids']} is not in cassette {cassette.path}")
+            await asyncio.sleep(cassette.delay(entry))
+            r = AppleHTTPResponse(status_code=entry.status, text=entry.body)
+        else:
+            async with acsnservice_client.session().post(
+                    settings.ACSNSERVICE_URL, headers=security_headers, json={"search": [_acsnservice_search(payload)]}
+            ) as out:
+                r = AppleHTTPResponse(status_code=out.status, text=await out.text())
+            if cassette is not None:
+                cassette.record(
+                    "acsnservice", "POST", settings.ACSNSERVICE_URL, payload, r.status_code, r.text,
+                    time.perf_counter() - started_at,
+                )
+        return r
+    except asyncio.CancelledError:
+        # The losing attempt of a hedge, its latency says nothing about the upstream
+        cancelled = True
+        raise
+    finally:
+        # Timeouts and connection errors count as well, their status is counted by the caller ("exception")
+        if not cancelled:
+            metrics.observe("apple_fetch_request_seconds", time.perf_counter() - started_at)
+        if r is not None:
+            metrics.observe("apple_fetch_response_bytes", len(r.text))
+            metrics.increment("apple_fetch_responses_total", status=str(r.status_code))
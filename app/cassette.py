@@ -0,0 +1,228 @@
+"""
+Record / replay of acsnservice and Haystacks API traffic, to profile production-shaped runs offline.
+A cassette is a gzip-compressed JSON lines file of request / response pairs with their timings.
+Device private keys are redacted from recorded device lists unless kept explicitly, and upload bodies are not recorded.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from app.cryptic import b64_ascii, get_hashed_public_key
+from app.date import unix_epoch
+
+logger = logging.getLogger(__name__)
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteEntry:
+    def __init__(self, kind: str, method: str, url: str, request, status: int, body: str, elapsed: float, at: float):
+        self.kind = kind
+        self.method = method
+        self.url = url
+        self.request = request
+        self.status = status
+        self.body = body
+        self.elapsed = elapsed
+        self.at = at
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    @property
+    def key(self) -> tuple:
+        return _request_key(self.kind, self.method, self.url, self.request)
+
+
+def _request_key(kind: str, method: str, url: str, request) -> tuple:
+    """
+    What a replayed request is matched on. Apple requests match on their ids and window length only,
+    since their absolute dates move with the time of the run.
+    """
+    if kind == "acsnservice":
+        return kind, tuple(request["ids"]), request["endDate"] - request["startDate"]
+    return kind, method, urlsplit(url).path, json.dumps(request, sort_keys=True) if method == "GET" else None
+
+
+def _map_devices(body: str, update) -> str:
+    """`body` of a device list response with `update` applied to every device, unchanged if it is not one"""
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(response, dict) or not isinstance(response.get("data"), list):
+        return body
+    for device in response["data"]:
+        if isinstance(device, dict) and isinstance(device.get("privateKey"), dict):
+            update(device)
+    return json.dumps(response)
+
+
+def _redact_private_key(device: dict):
+    # The location id stays, so replayed Apple requests still ask for the recorded devices
+    private_key = device["privateKey"]
+    if not device.get("publicHash"):
+        device["publicHash"] = b64_ascii(get_hashed_public_key(bytes(private_key["data"])))
+    private_key["data"] = []
+
+
+def _stand_in_private_key(device: dict):
+    """Stable key of the same size for a redacted device (recorded payloads do not decrypt with it)"""
+    if not device["privateKey"].get("data"):
+        device["privateKey"]["data"] = list(hashlib.sha256(f"stand-in:{device.get('id')}".encode()).digest()[:28])
+
+
+class Cassette:
+    """
+    In record mode every exchange is appended to `path` as it completes. In replay mode requests are answered
+    from `path` in recorded order per request, delayed by the recorded latency divided by `speed`
+    (0 answers immediately). Requests repeated more often than recorded get the last recorded answer again.
+    Recorded device lists keep their private keys only with `keep_keys`, otherwise replays get stand-in keys:
+    the crypto work is the same, but the recorded payloads then fail to decrypt.
+    """
+
+    def __init__(self, path: str, mode: str, speed: float = 1.0, keep_keys: bool = False):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.keep_keys = keep_keys
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._file = None
+        self._entries: dict[tuple, list[CassetteEntry]] = defaultdict(list)
+        self._positions: dict[tuple, int] = defaultdict(int)
+        if mode == RECORD:
+            self._file = gzip.open(path, "wt", encoding="utf-8")
+        else:
+            self._load()
+
+    def _load(self):
+        count = 0
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = CassetteEntry(**json.loads(line))
+                if entry.kind == "haystacks" and entry.method == "GET":
+                    entry.body = _map_devices(entry.body, _stand_in_private_key)
+                self._entries[entry.key].append(entry)
+                count += 1
+        logger.info(f"Loaded {count} recorded exchanges from {self.path}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        logger.info(
+            f"Cassette {self.path}: {self.recorded} recorded, {self.replayed} replayed, {self.missed} not found"
+        )
+
+    def record(self, kind: str, method: str, url: str, request, status: int, body: str, elapsed: float):
+        if kind == "haystacks" and method == "GET":
+            if not self.keep_keys:
+                body = _map_devices(body, _redact_private_key)
+        elif kind == "haystacks":
+            # Uploads are matched on their endpoint only, the reports they carry are not kept
+            request = None
+        entry = CassetteEntry(kind, method, url, request, status, body, elapsed, time.monotonic() - self._started_at)
+        line = json.dumps(entry.as_dict()) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+
+    def replay(self, kind: str, method: str, url: str, request) -> CassetteEntry | None:
+        key = _request_key(kind, method, url, request)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.missed += 1
+                return None
+            position = self._positions[key]
+            self._positions[key] = position + 1
+            self.replayed += 1
+            return entries[min(position, len(entries) - 1)]
+
+    def delay(self, entry: CassetteEntry) -> float:
+        return entry.elapsed / self.speed if self.speed > 0 else 0.0
+
+    @staticmethod
+    def credentials_headers() -> dict:
+        """
+        Stand-in Apple headers for replays (credentials are never recorded): the replayed responses
+        do not depend on them, they only have to look fresh to the credentials cache
+        """
+        now = str(unix_epoch())
+        headers = {
+            name: "replay" for name in (
+                "User-Agent", "Accept", "Authorization", "X-Apple-I-MD", "X-Apple-I-MD-RINFO", "X-Apple-I-MD-M",
+                "X-Apple-I-TimeZone", "X-Apple-I-Client-Time",
+            )
+        }
+        headers["X-BA-CLIENT-TIMESTAMP"] = now
+        return headers
+
+
+class ReplayedResponse:
+    """The parts of a `requests` response the API clients use"""
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+_active_cassette: Cassette | None = None
+
+
+def active_cassette() -> Cassette | None:
+    return _active_cassette
+
+
+@contextmanager
+def use_cassette(path: str, mode: str, speed: float = 1.0, keep_keys: bool = False):
+    """Record or replay all acsnservice and Haystacks API traffic inside"""
+    global _active_cassette
+    cassette = Cassette(path, mode, speed, keep_keys=keep_keys)
+    _active_cassette = cassette
+    try:
+        yield cassette
+    finally:
+        _active_cassette = None
+        cassette.close()
+
+
+def send(kind: str, method: str, url: str, request, perform):
+    """
+    Synchronous exchange through the active cassette: `perform()` sends the request for real
+    (and returns a `requests` response) unless it is replayed
+    """
+    cassette = _active_cassette
+    if cassette is None:
+        return perform()
+
+    if cassette.mode == REPLAY:
+        entry = cassette.replay(kind, method, url, request)
+        if entry is None:
+            if method != "GET":
+                # Uploads beyond the recording are acknowledged without being sent
+                return ReplayedResponse(200, "{}")
+            raise LookupError(f"{method} {url} is not in cassette {cassette.path}")
+        time.sleep(cassette.delay(entry))
+        return ReplayedResponse(entry.status, entry.body)
+
+    started_at = time.perf_counter()
+    response = perform()
+    cassette.record(kind, method, url, request, response.status_code, response.text, time.perf_counter() - started_at)
+    return response
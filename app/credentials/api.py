@@ -2,6 +2,7 @@ from pydantic import BaseModel
 import os
 from requests import Session
 
+from app.cassette import REPLAY, Cassette, active_cassette
 from app.credentials.base import CredentialsService
 from app.models import ICloudCredentials
 from app.settings import settings
@@ -20,12 +21,17 @@ class APICredentialsService(CredentialsService):
         self.default_client = default_client
         self.api_key = api_key
 
-    def get_credentials(self) -> ICloudCredentials:
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials:
+        client_id = client_id if client_id is not None else self.default_client
+        active = active_cassette()
+        if active is not None and active.mode == REPLAY:
+            return ICloudCredentials(**Cassette.credentials_headers())
         response = requestSession.get(
-            url=f'{self.base_url}/{self.default_client}',
+            url=f'{self.base_url}/{client_id}',
             headers={
                 'x-api-key': self.api_key
-            }
+            },
+            timeout=settings.CREDENTIALS_REQUEST_TIMEOUT,
         )
         if response.status_code != 200:
             raise Exception(f"Failed to retrieve credentials: {response.status_code} - {response.text}")
@@ -40,11 +46,12 @@ class APICredentialsService(CredentialsService):
             json={
                 'headers': credentials.model_dump(by_alias=True),
                 'schedule_data_fetching': schedule_data_fetching
-            }
+            },
+            timeout=settings.CREDENTIALS_REQUEST_TIMEOUT,
         )
         if response.status_code != 200:
             raise Exception(f"Failed to update credentials: {response.status_code} - {response.text}")
 
 
-api_credentials_service = APICredentialsService(api_key=settings.CREDENTIALS_API_KEY)
+api_credentials_service = APICredentialsService(api_key=settings.CREDENTIALS_API_KEY, base_url=settings.CREDENTIALS_API_URL)
 
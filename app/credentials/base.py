@@ -9,5 +9,10 @@ class CredentialsService:
         pass
 
     @abc.abstractmethod
-    def get_credentials(self) -> ICloudCredentials | None:
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
         pass
+
+    def get_many_credentials(self, client_ids: list[str]) -> dict[str, ICloudCredentials]:
+        """Credentials per client_id - services with a batched read should override this"""
+        credentials = {client_id: self.get_credentials(client_id) for client_id in client_ids}
+        return {client_id: c for client_id, c in credentials.items() if c is not None}
@@ -0,0 +1,197 @@
+"""
+Circuit breaker for expired Apple credentials, shared by all workers through a state store.
+
+The first worker getting a 401 opens the breaker for the credentials version it used (the `X-BA-CLIENT-TIMESTAMP`
+of the headers), and every worker stops sending requests for that account. Waiting workers poll the credentials
+until a newer version was written; one of them is elected to send a probe request (half-open), and once any request
+with the newer version succeeds the breaker closes and all workers resume with that version.
+"""
+import abc
+import asyncio
+import logging
+import threading
+import time
+
+from app.exceptions import AppleAuthCredentialsExpired
+from app.metrics import metrics
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class BreakerState:
+    def __init__(self, state: str = CLOSED, version: int = 0, changed_at: float = 0.0):
+        self.state = state
+        self.version = version  # credentials version the state is about
+        self.changed_at = changed_at  # unix time
+
+    def __repr__(self):
+        return f"BreakerState({self.state}, version={self.version})"
+
+
+class BreakerStore:
+    """
+    Shared breaker state per client id. Every transition is conditional, so concurrent workers
+    agree on a single outcome; the methods return whether the transition happened.
+    """
+
+    @abc.abstractmethod
+    def get(self, client_id: str) -> BreakerState:
+        pass
+
+    @abc.abstractmethod
+    def trip(self, client_id: str, version: int) -> bool:
+        """Open for `version`, unless a newer version is already known or `version` is already open"""
+        pass
+
+    @abc.abstractmethod
+    def start_probe(self, client_id: str, version: int, probe_timeout: float) -> bool:
+        """Half-open for `version` when open for an older version, or when the last probe timed out"""
+        pass
+
+    @abc.abstractmethod
+    def close(self, client_id: str, version: int) -> bool:
+        """Closed for `version`, unless a newer version is already known"""
+        pass
+
+
+class LocalBreakerStore(BreakerStore):
+    """Breaker state of a single process (CLI runs, or the coordinator of a page-parallel run)"""
+
+    def __init__(self):
+        self._states: dict[str, BreakerState] = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_id: str) -> BreakerState:
+        with self._lock:
+            state = self._states.get(client_id, BreakerState())
+            return BreakerState(state.state, state.version, state.changed_at)
+
+    def trip(self, client_id: str, version: int) -> bool:
+        with self._lock:
+            state = self._states.get(client_id)
+            if state is not None and (state.version > version or (state.version == version and state.state == OPEN)):
+                return False
+            self._states[client_id] = BreakerState(OPEN, version, time.time())
+            return True
+
+    def start_probe(self, client_id: str, version: int, probe_timeout: float) -> bool:
+        with self._lock:
+            state = self._states.get(client_id)
+            if state is None:
+                return False
+            now = time.time()
+            if not (
+                    (state.state == OPEN and state.version < version)
+                    or (state.state == HALF_OPEN and state.changed_at < now - probe_timeout)
+            ):
+                return False
+            self._states[client_id] = BreakerState(HALF_OPEN, version, now)
+            return True
+
+    def close(self, client_id: str, version: int) -> bool:
+        with self._lock:
+            state = self._states.get(client_id)
+            if state is None or state.state == CLOSED or state.version > version:
+                return False
+            self._states[client_id] = BreakerState(CLOSED, version, time.time())
+            return True
+
+
+def headers_version(headers: dict | None) -> int:
+    """Credentials version of Apple headers: the time they were generated on the Mac"""
+    try:
+        return int(headers["X-BA-CLIENT-TIMESTAMP"])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+class CredentialsCircuitBreaker:
+    """
+    Worker side of the breaker. The shared state is read at most every `poll_interval` seconds per account
+    while closed; a worker giving up after waiting `max_wait` seconds raises `AppleAuthCredentialsExpired`.
+    """
+
+    def __init__(
+            self,
+            store: BreakerStore,
+            poll_interval: float = settings.CREDENTIALS_BREAKER_POLL_SECONDS,
+            max_wait: float = settings.CREDENTIALS_BREAKER_MAX_WAIT_SECONDS,
+            probe_timeout: float = settings.CREDENTIALS_BREAKER_PROBE_TIMEOUT_SECONDS,
+    ):
+        self._store = store
+        self._poll_interval = poll_interval
+        self._max_wait = max_wait
+        self._probe_timeout = probe_timeout
+        self._states: dict[str, tuple[float, BreakerState]] = {}  # client id -> (read at, state)
+
+    async def _state(self, client_id: str, max_age: float) -> BreakerState:
+        read_at, state = self._states.get(client_id, (0.0, None))
+        if state is not None and time.monotonic() - read_at < max_age:
+            return state
+        # Concurrent requests keep using the previous state while it is read
+        self._states[client_id] = (time.monotonic(), state or BreakerState())
+        state = await asyncio.to_thread(self._store.get, client_id)
+        self._states[client_id] = (time.monotonic(), state)
+        return state
+
+    def _remember(self, client_id: str, state: BreakerState):
+        self._states[client_id] = (time.monotonic(), state)
+
+    async def before_request(self, account) -> bool:
+        """
+        Wait while the breaker of `account` is open. Returns True when the request is the probe
+        for a newer credentials version.
+        """
+        state = await self._state(account.client_id, self._poll_interval)
+        if state.state == CLOSED:
+            if headers_version(account.credentials.headers) < state.version:
+                await account.credentials.refresh(stale_headers=account.credentials.headers)
+            return False
+
+        started_at = time.monotonic()
+        logger.info(f"Credentials breaker of {account.client_id} is {state.state}, waiting for newer credentials")
+        try:
+            while time.monotonic() - started_at < self._max_wait:
+                headers = account.credentials.headers
+                if headers_version(headers) <= state.version:
+                    headers = await account.credentials.refresh(stale_headers=headers, wait=self._poll_interval)
+                version = headers_version(headers)
+
+                if state.state == CLOSED and version >= state.version:
+                    return False
+                if version > state.version or state.state == HALF_OPEN:
+                    if await asyncio.to_thread(
+                            self._store.start_probe, account.client_id, version, self._probe_timeout
+                    ):
+                        self._remember(account.client_id, BreakerState(HALF_OPEN, version, time.time()))
+                        logger.info(f"Probing credentials version {version} of {account.client_id}")
+                        return True
+                    await asyncio.sleep(self._poll_interval)
+                state = await self._state(account.client_id, 0)
+        finally:
+            metrics.observe("apple_credentials_breaker_wait_seconds", time.monotonic() - started_at)
+
+        raise AppleAuthCredentialsExpired(
+            f"No working credentials for {account.client_id} after waiting {self._max_wait} seconds"
+        )
+
+    async def record_success(self, account, headers: dict):
+        _, state = self._states.get(account.client_id, (0.0, None))
+        if state is None or state.state == CLOSED:
+            return
+        version = headers_version(headers)
+        if version >= state.version and await asyncio.to_thread(self._store.close, account.client_id, version):
+            logger.info(f"Closed credentials breaker of {account.client_id} at version {version}")
+        self._remember(account.client_id, await asyncio.to_thread(self._store.get, account.client_id))
+
+    async def record_unauthorized(self, account, headers: dict):
+        version = headers_version(headers)
+        if await asyncio.to_thread(self._store.trip, account.client_id, version):
+            logger.warning(f"Opened credentials breaker of {account.client_id} at version {version}")
+            metrics.increment("apple_credentials_breaker_trips_total", client_id=account.client_id)
+        self._remember(account.client_id, await asyncio.to_thread(self._store.get, account.client_id))
@@ -0,0 +1,142 @@
+"""
+Caching wrapper around a CredentialsService
+"""
+import asyncio
+import logging
+import time
+
+from app.credentials.base import CredentialsService
+from app.date import unix_epoch
+from app.metrics import metrics
+from app.models import ICloudCredentials
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CachedCredentialsService(CredentialsService):
+    """
+    Keeps the latest credentials of the wrapped service together with the header dict sent to Apple,
+    so the fetch hot path neither hits DynamoDB / the credentials API nor re-serialises the model per request.
+
+    Apple credentials expire roughly a minute after they were generated on the Mac (`X-BA-CLIENT-TIMESTAMP`),
+    so they are refreshed in the background `refresh_ahead` seconds before that. Refreshes triggered by
+    concurrent 401s are coalesced into a single fetch.
+    """
+
+    def __init__(
+            self,
+            credentials_service: CredentialsService,
+            ttl: int = settings.CREDENTIALS_TTL_SECONDS,
+            refresh_ahead: int = settings.CREDENTIALS_REFRESH_AHEAD_SECONDS,
+            min_refresh_interval: float = 1,
+    ):
+        self._credentials_service = credentials_service
+        self._ttl = ttl
+        self._refresh_ahead = refresh_ahead
+        self._min_refresh_interval = min_refresh_interval
+        self._credentials: ICloudCredentials | None = None
+        self._headers: dict | None = None
+        self._last_fetch = 0.0
+        self._refresh_task: asyncio.Task | None = None
+        self.refresh_count = 0
+
+    @property
+    def credentials_service(self) -> CredentialsService:
+        return self._credentials_service
+
+    @property
+    def headers(self) -> dict | None:
+        """Cached headers as they are, without triggering a refresh"""
+        return self._headers
+
+    @property
+    def age(self) -> int | None:
+        """Seconds since the cached credentials were generated, None if nothing is cached"""
+        if self._credentials is None:
+            return None
+        try:
+            return unix_epoch() - int(self._credentials.x_ba_client_timestamp)
+        except ValueError:
+            return self._ttl
+
+    def update_credentials(self, credentials: ICloudCredentials, *args, **kwargs):
+        self._credentials_service.update_credentials(credentials, *args, **kwargs)
+        self._store(credentials)
+
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
+        if client_id is not None:
+            return self._credentials_service.get_credentials(client_id)
+        if self._credentials is None or (self._is_stale() and self._can_refetch()):
+            self._store(self._credentials_service.get_credentials())
+        return self._credentials
+
+    def prime(self, credentials: ICloudCredentials | None):
+        """Seed the cache with credentials read elsewhere (e.g. a batched read)"""
+        self._store(credentials)
+
+    def get_headers(self) -> dict | None:
+        self.get_credentials()
+        return self._headers
+
+    async def get_headers_async(self) -> dict | None:
+        if self._headers is None:
+            return await self.refresh()
+        if self._is_stale() and self._can_refetch():
+            self._start_refresh(wait=0)
+        return self._headers
+
+    async def refresh(self, stale_headers: dict | None = None, wait: float = 0) -> dict | None:
+        """
+        Fetch new credentials, unless the cache already moved past `stale_headers`.
+        Concurrent callers share the same in-flight fetch.
+        """
+        if self._headers is not None and self._headers is not stale_headers:
+            return self._headers
+        return await asyncio.shield(self._start_refresh(wait))
+
+    def _start_refresh(self, wait: float) -> asyncio.Task:
+        loop = asyncio.get_running_loop()
+        task = self._refresh_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            task = self._refresh_task = loop.create_task(self._refetch(wait))
+        return task
+
+    async def _refetch(self, wait: float) -> dict | None:
+        delay = max(wait, self._min_refresh_interval - (time.monotonic() - self._last_fetch))
+        if delay > 0:
+            logger.info(f"Fetching credentials again in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+        try:
+            credentials = await asyncio.to_thread(self._credentials_service.get_credentials)
+        except Exception as e:
+            logger.error(f"Failed to refresh credentials: {e}")
+            credentials = None
+
+        self.refresh_count += 1
+        metrics.increment("apple_credentials_refreshes_total")
+        self._store(credentials)
+        return self._headers
+
+    def _store(self, credentials: ICloudCredentials | None):
+        self._last_fetch = time.monotonic()
+        if credentials is None or credentials == self._credentials:
+            return
+
+        self._credentials = credentials
+        self._headers = credentials.model_dump(mode='json', by_alias=True)
+        logger.info(f"Cached new credentials (age: {self.age} seconds)")
+
+    def _is_stale(self) -> bool:
+        age = self.age
+        return age is None or age >= self._ttl - self._refresh_ahead
+
+    def _can_refetch(self) -> bool:
+        return time.monotonic() - self._last_fetch >= self._min_refresh_interval
+
+
+def as_cached_credentials_service(credentials_service: CredentialsService) -> CachedCredentialsService:
+    if isinstance(credentials_service, CachedCredentialsService):
+        return credentials_service
+    return CachedCredentialsService(credentials_service)
@@ -2,10 +2,15 @@
 Service for managing credentials in DynamoDB
 """
 import os
+import time
+
 import boto3
 import logging
 
 from app.credentials.base import CredentialsService
+from app.credentials.breaker import CLOSED, HALF_OPEN, OPEN, BreakerState, BreakerStore
+from app.fetch_runs import FINISHED, RUNNING, FetchRun, FetchRunStore
+from app.helpers import chunks
 from app.models import ICloudCredentials
 from app.settings import settings
 
@@ -14,6 +19,10 @@ logger = logging.getLogger(__name__)
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(f"apple-collector-credentials-{os.environ.get('STAGE', 'dev')}")
 
+# Retries of the keys a BatchGetItem left unprocessed (throttling), with exponential backoff
+UNPROCESSED_KEYS_ATTEMPTS = 5
+UNPROCESSED_KEYS_BACKOFF_SECONDS = 0.05
+
 
 class DynamoDBCredentialsService(CredentialsService):
     def __init__(self, default_client_id: str):
@@ -45,6 +54,167 @@ class DynamoDBCredentialsService(CredentialsService):
             logger.error(f"Error retrieving credentials: {str(e)}")
             return None
 
+    def get_many_credentials(self, client_ids: list[str]) -> dict[str, ICloudCredentials]:
+        credentials = {}
+        for client_id_batch in chunks(list(dict.fromkeys(client_ids)), 100):  # BatchGetItem limit
+            request_items = {table.name: {'Keys': [{'id': client_id} for client_id in client_id_batch]}}
+            for attempt in range(UNPROCESSED_KEYS_ATTEMPTS):
+                if attempt:
+                    time.sleep(UNPROCESSED_KEYS_BACKOFF_SECONDS * 2 ** (attempt - 1))
+                try:
+                    response = dynamodb.batch_get_item(RequestItems=request_items)
+                except Exception as e:
+                    logger.error(f"Error retrieving credentials: {str(e)}")
+                    break
+
+                for item in response.get('Responses', {}).get(table.name, []):
+                    client_id = item.pop('id')
+                    credentials[client_id] = ICloudCredentials(**item)
+
+                request_items = response.get('UnprocessedKeys')
+                if not request_items:
+                    break
+            else:
+                unprocessed = len(request_items.get(table.name, {}).get('Keys', []))
+                logger.warning(f"{unprocessed} credentials still unprocessed after {UNPROCESSED_KEYS_ATTEMPTS} attempts")
+
+        missing = set(client_ids) - set(credentials)
+        if missing:
+            logger.info(f"No credentials found for client_ids: {','.join(sorted(missing))}")
+        return credentials
+
+
+class DynamoDBBreakerStore(BreakerStore):
+    """
+    Breaker state as one item per client in the credentials table (`circuit-breaker#<client_id>`),
+    transitions are conditional writes
+    """
+
+    _names = {'#s': 'breaker_state', '#v': 'credentials_version', '#t': 'changed_at'}
+
+    @staticmethod
+    def _key(client_id: str) -> dict:
+        return {'id': f"circuit-breaker#{client_id}"}
+
+    def get(self, client_id: str) -> BreakerState:
+        item = table.get_item(Key=self._key(client_id), ConsistentRead=True).get('Item')
+        if item is None:
+            return BreakerState()
+        return BreakerState(item['breaker_state'], int(item['credentials_version']), float(item['changed_at']))
+
+    def _transition(self, client_id: str, state: str, version: int, condition: str, values: dict) -> bool:
+        try:
+            table.update_item(
+                Key=self._key(client_id),
+                UpdateExpression='SET #s = :state, #v = :version, #t = :now',
+                ConditionExpression=condition,
+                ExpressionAttributeNames=self._names,
+                ExpressionAttributeValues={
+                    ':state': state, ':version': version, ':now': int(time.time()), **values
+                },
+            )
+            return True
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def trip(self, client_id: str, version: int) -> bool:
+        return self._transition(
+            client_id, OPEN, version,
+            'attribute_not_exists(#v) OR #v < :version OR (#v = :version AND #s <> :state)',
+            {},
+        )
+
+    def start_probe(self, client_id: str, version: int, probe_timeout: float) -> bool:
+        return self._transition(
+            client_id, HALF_OPEN, version,
+            '(#s = :open AND #v < :version) OR (#s = :state AND #t < :stale)',
+            {':open': OPEN, ':stale': int(time.time() - probe_timeout)},
+        )
+
+    def close(self, client_id: str, version: int) -> bool:
+        return self._transition(
+            client_id, CLOSED, version, 'attribute_exists(#v) AND #s <> :state AND #v <= :version', {}
+        )
+
+
+class DynamoDBFetchRunStore(FetchRunStore):
+    """Current fetch run of the fleet as one item in the credentials table (`fetch-run`), written conditionally"""
+
+    _key = {'id': 'fetch-run'}
+    # Every attribute goes through a name placeholder, some of them are reserved words
+    _names = {'#s': 'run_status', '#r': 'run_id', '#t': 'changed_at', '#q': 'queued_at', '#d': 'pages_done'}
+
+    def get(self) -> FetchRun | None:
+        item = table.get_item(Key=self._key, ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        return FetchRun(
+            run_id=item['run_id'], status=item['run_status'], queued_at=int(item['queued_at']),
+            changed_at=int(item['changed_at']), pages=int(item['pages']), pages_done=int(item['pages_done']),
+            triggers=int(item['triggers']),
+        )
+
+    def claim(self, run: FetchRun, coalesce_seconds: int, run_timeout: int) -> bool:
+        try:
+            table.put_item(
+                Item={
+                    **self._key, 'run_id': run.run_id, 'run_status': run.status, 'queued_at': run.queued_at,
+                    'changed_at': run.changed_at, 'pages': run.pages, 'pages_done': 0, 'triggers': run.triggers,
+                },
+                ConditionExpression='attribute_not_exists(#r) OR '
+                                    '(#q <= :coalesced AND (#s = :finished OR #t <= :stale))',
+                ExpressionAttributeNames={'#r': 'run_id', '#s': 'run_status', '#t': 'changed_at', '#q': 'queued_at'},
+                ExpressionAttributeValues={
+                    ':coalesced': run.queued_at - coalesce_seconds,
+                    ':stale': run.queued_at - run_timeout,
+                    ':finished': FINISHED,
+                },
+            )
+            return True
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def coalesce(self):
+        table.update_item(
+            Key=self._key,
+            UpdateExpression='ADD #c :one',
+            ExpressionAttributeNames={'#c': 'triggers'},
+            ExpressionAttributeValues={':one': 1},
+        )
+
+    def _update(self, run_id: str, expression: str, values: dict = None) -> dict | None:
+        condition = '#r = :run_id AND #s <> :finished'
+        try:
+            return table.update_item(
+                Key=self._key,
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                # DynamoDB rejects placeholders an expression does not use
+                ExpressionAttributeNames={
+                    name: attribute for name, attribute in self._names.items() if name in expression + condition
+                },
+                ExpressionAttributeValues={
+                    ':run_id': run_id, ':finished': FINISHED, ':now': int(time.time()), **(values or {})
+                },
+                ReturnValues='ALL_NEW',
+            )['Attributes']
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            return None
+
+    def start(self, run_id: str) -> bool:
+        return self._update(run_id, 'SET #s = :running, #t = :now', {':running': RUNNING}) is not None
+
+    def finish_page(self, run_id: str) -> bool:
+        item = self._update(run_id, 'SET #t = :now ADD #d :one', {':one': 1})
+        if item is None:
+            return False
+        if int(item['pages_done']) >= int(item['pages']):
+            self._update(run_id, 'SET #s = :finished, #t = :now')
+        return True
+
+    def abandon(self, run_id: str):
+        self._update(run_id, 'SET #s = :finished, #t = :now, #q = :zero', {':zero': 0})
+
 
 dynamodb_credentials_service = DynamoDBCredentialsService(
     default_client_id=settings.DEFAULT_CLIENT_MANAGING_CREDENTIALS)
@@ -0,0 +1,185 @@
+"""
+Pool of Apple accounts to spread acsnservice requests over
+"""
+import asyncio
+import logging
+import time
+
+from app.credentials.base import CredentialsService
+from app.credentials.breaker import CredentialsCircuitBreaker
+from app.credentials.cached import CachedCredentialsService
+from app.exceptions import AppleAuthCredentialsExpired
+from app.models import ICloudCredentials
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ClientCredentialsService(CredentialsService):
+    """Binds a multi-client CredentialsService to a single client_id"""
+
+    def __init__(self, credentials_service: CredentialsService, client_id: str):
+        self._credentials_service = credentials_service
+        self.client_id = client_id
+
+    def update_credentials(self, credentials: ICloudCredentials, *args, **kwargs):
+        self._credentials_service.update_credentials(credentials, *args, client_id=self.client_id, **kwargs)
+
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
+        return self._credentials_service.get_credentials(client_id if client_id is not None else self.client_id)
+
+
+class CredentialsAccount:
+    """Credentials, request pacing and health of a single Apple account"""
+
+    def __init__(self, client_id: str, credentials: CachedCredentialsService, max_requests_per_second: float = 0):
+        self.client_id = client_id
+        self.credentials = credentials
+        self.in_flight = 0
+        self.requests = 0
+        self.unauthorized = 0
+        self.consecutive_unauthorized = 0
+        self.disabled_until = 0.0
+        self._request_interval = 1 / max_requests_per_second if max_requests_per_second > 0 else 0
+        self._next_request_at = 0.0
+
+    @property
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.disabled_until
+
+    @property
+    def next_request_at(self) -> float:
+        return self._next_request_at
+
+    async def throttle(self):
+        """Wait for the next request slot of this account"""
+        now = time.monotonic()
+        slot = max(now, self._next_request_at)
+        self._next_request_at = slot + self._request_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def record_success(self):
+        self.consecutive_unauthorized = 0
+
+    def record_unauthorized(self):
+        self.unauthorized += 1
+        self.consecutive_unauthorized += 1
+
+    def disable(self, cooldown: int):
+        logger.warning(
+            f"Taking account {self.client_id} out of rotation for {cooldown} seconds "
+            f"after {self.consecutive_unauthorized} consecutive 401s"
+        )
+        self.disabled_until = time.monotonic() + cooldown
+        self.consecutive_unauthorized = 0
+
+
+class CredentialsPool(CredentialsService):
+    """
+    Spreads Apple requests over several accounts (one per Mac credentials feeder), each with its own
+    credentials cache and request pacing. Accounts that keep getting 401s are taken out of rotation for a while,
+    as long as at least one other account is still healthy. With a `breaker`, workers sharing its state
+    pause together on credential expiry (see app/credentials/breaker.py).
+    """
+
+    def __init__(
+            self,
+            credentials_service: CredentialsService,
+            accounts: list[CredentialsAccount],
+            max_consecutive_unauthorized: int = settings.CREDENTIALS_ACCOUNT_MAX_CONSECUTIVE_401,
+            cooldown: int = settings.CREDENTIALS_ACCOUNT_COOLDOWN_SECONDS,
+            breaker: CredentialsCircuitBreaker | None = None,
+            loaded: bool = False,
+    ):
+        """`loaded`: the accounts' caches load their credentials themselves, `load` is not needed"""
+        self._credentials_service = credentials_service
+        self.accounts = accounts
+        self.breaker = breaker
+        self._max_consecutive_unauthorized = max_consecutive_unauthorized
+        self._cooldown = cooldown
+        self._loaded = loaded
+
+    @classmethod
+    def from_client_ids(
+            cls,
+            credentials_service: CredentialsService,
+            client_ids: list[str],
+            max_requests_per_second: float = settings.CREDENTIALS_ACCOUNT_MAX_REQUESTS_PER_SECOND,
+            breaker: CredentialsCircuitBreaker | None = None,
+    ) -> 'CredentialsPool':
+        accounts = [
+            CredentialsAccount(
+                client_id,
+                CachedCredentialsService(ClientCredentialsService(credentials_service, client_id)),
+                max_requests_per_second,
+            )
+            for client_id in client_ids
+        ]
+        return cls(credentials_service, accounts, breaker=breaker)
+
+    @classmethod
+    def from_service(cls, credentials_service: CachedCredentialsService) -> 'CredentialsPool':
+        """Single-account pool over an existing cache, which loads its credentials itself"""
+        return cls(
+            credentials_service.credentials_service, [CredentialsAccount('default', credentials_service)], loaded=True
+        )
+
+    @property
+    def refresh_count(self) -> int:
+        return sum(account.credentials.refresh_count for account in self.accounts)
+
+    def load(self):
+        """Prime all accounts with a single batched credentials read"""
+        credentials = self._credentials_service.get_many_credentials([account.client_id for account in self.accounts])
+        for account in self.accounts:
+            account.credentials.prime(credentials.get(account.client_id))
+        self._loaded = True
+        logger.info(f"Loaded credentials for {len(credentials)}/{len(self.accounts)} accounts")
+
+    async def ensure_loaded(self):
+        if not self._loaded:
+            await asyncio.to_thread(self.load)
+
+    def acquire(self) -> CredentialsAccount:
+        """Least busy healthy account that has credentials"""
+        candidates = [account for account in self.accounts if account.is_healthy and account.credentials.age is not None]
+        if not candidates:
+            candidates = [account for account in self.accounts if account.is_healthy]
+        if not candidates:
+            raise AppleAuthCredentialsExpired("All credential accounts are out of rotation")
+        return min(candidates, key=lambda account: (account.next_request_at, account.in_flight))
+
+    def record_unauthorized(self, account: CredentialsAccount):
+        account.record_unauthorized()
+        if account.consecutive_unauthorized < self._max_consecutive_unauthorized:
+            return
+        if any(other.is_healthy for other in self.accounts if other is not account):
+            account.disable(self._cooldown)
+
+    def update_credentials(self, credentials: ICloudCredentials, *args, **kwargs):
+        self._credentials_service.update_credentials(credentials, *args, **kwargs)
+
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
+        if client_id is not None:
+            return self._credentials_service.get_credentials(client_id)
+        return self.acquire().credentials.get_credentials()
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "client_id": account.client_id,
+                "requests": account.requests,
+                "unauthorized": account.unauthorized,
+                "healthy": account.is_healthy,
+            }
+            for account in self.accounts
+        ]
+
+
+def as_credentials_pool(credentials_service: CredentialsService) -> CredentialsPool:
+    if isinstance(credentials_service, CredentialsPool):
+        return credentials_service
+    if not isinstance(credentials_service, CachedCredentialsService):
+        credentials_service = CachedCredentialsService(credentials_service)
+    return CredentialsPool.from_service(credentials_service)
@@ -0,0 +1,66 @@
+"""
+Credentials shared by worker processes through a coordinator process
+"""
+import logging
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from app.credentials.base import CredentialsService
+from app.credentials.breaker import LocalBreakerStore
+from app.models import ICloudCredentials
+
+logger = logging.getLogger(__name__)
+
+
+class CredentialsBroker:
+    """
+    Lives in the coordinator process. Workers asking for the same client's credentials within
+    `min_refresh_interval` seconds share a single fetch from the wrapped service.
+    """
+
+    def __init__(self, credentials_service: CredentialsService, min_refresh_interval: float = 1):
+        self._credentials_service = credentials_service
+        self._min_refresh_interval = min_refresh_interval
+        self._cache: dict[str | None, tuple[float, ICloudCredentials | None]] = {}
+        self._lock = threading.Lock()
+        self.fetch_count = 0
+
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
+        with self._lock:
+            cached = self._cache.get(client_id)
+            if cached is not None and time.monotonic() - cached[0] < self._min_refresh_interval:
+                return cached[1]
+            credentials = self._credentials_service.get_credentials(client_id)
+            self._cache[client_id] = (time.monotonic(), credentials)
+            self.fetch_count += 1
+            return credentials
+
+    def update_credentials(self, credentials: ICloudCredentials, *args, **kwargs):
+        with self._lock:
+            self._credentials_service.update_credentials(credentials, *args, **kwargs)
+            self._cache.clear()
+
+    def get_fetch_count(self) -> int:
+        return self.fetch_count
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+
+CoordinatorManager.register("CredentialsBroker", CredentialsBroker)
+CoordinatorManager.register("BreakerStore", LocalBreakerStore)
+
+
+class BrokeredCredentialsService(CredentialsService):
+    """Worker side of a `CredentialsBroker` proxy"""
+
+    def __init__(self, broker):
+        self._broker = broker
+
+    def update_credentials(self, credentials: ICloudCredentials, *args, **kwargs):
+        self._broker.update_credentials(credentials, *args, **kwargs)
+
+    def get_credentials(self, client_id: str = None) -> ICloudCredentials | None:
+        return self._broker.get_credentials(client_id)
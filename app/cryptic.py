@@ -12,6 +12,12 @@ from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.backends import default_backend
 
+# Report payload layout: timestamp (4), confidence (1), ephemeral SECP224R1 point (57, uncompressed),
+# encrypted location (10), GCM tag (16). Newer iOS versions add bytes before the point, `get_result` locates
+# the point, location and tag relative to the end, so longer payloads are left to the GCM tag check.
+PAYLOAD_LENGTH = 88
+UNCOMPRESSED_POINT_PREFIX = 0x04
+
 
 def int_to_bytes(n, length, endianess="big"):
     return int.to_bytes(n, length, endianess)
@@ -32,6 +38,11 @@ def decrypt(enc_data, algorithm_dkey, mode):
     return decryptor.update(enc_data) + decryptor.finalize()
 
 
+def encrypt(data, algorithm_ekey, mode):
+    encryptor = Cipher(algorithm_ekey, mode, default_backend()).encryptor()
+    return encryptor.update(data) + encryptor.finalize(), getattr(encryptor, "tag", None)
+
+
 def unpad(padded_binary, blocksize):
     unpadder = PKCS7(blocksize).unpadder()
     return unpadder.update(padded_binary) + unpadder.finalize()
@@ -58,6 +69,16 @@ def b64_ascii(encodable):
     return b64encode(encodable).decode("ascii")
 
 
+def validate_payload(data: bytes) -> str | None:
+    """Structural problem of a report payload that `get_result` would fail on, None if it looks decodable"""
+    adj = len(data) - PAYLOAD_LENGTH
+    if adj < 0:
+        return "truncated"
+    if data[5 + adj] != UNCOMPRESSED_POINT_PREFIX:
+        return "point_prefix"
+    return None
+
+
 def get_result(priv, data):
     # Some iOS versions may send messages a bit differently. If we have more than 88 bytes in our message,
     # we need to compensate and adjust where key and data start and end.
@@ -1,14 +1,25 @@
+import contextvars
 import logging
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from time import sleep
+from typing import Callable
 from app.api import fetch_devices_metadata_from_space_invader_api, send_reports_to_api
-from app.apple_fetch import apple_fetch, ResponseDto
+from app.apple_fetch import AppleLocation, apple_fetch, ResponseDto
 from app.credentials.base import CredentialsService
 from app.dtos import BeamerDevice, HaystackSignalInput
 from app.exceptions import NoMoreLocationsToFetch
-from app.helpers import chunks
+from app.freshness import FreshnessTracker, published_seconds
+from app.key_index import KeyIndex
+from app.metrics import metrics
+from app.date import unix_epoch
 from app.models import ICloudCredentials
-from app.report import create_reports
+from app.profiling import phase, profile_run
+from app.report import ReportMode, StatsAggregator, create_reports, key_index_resolver, log_report_statistics
+from app.scheduler import PollingScheduler
 from app.settings import settings
+from app.store import ReportStore
+from app.trajectory import simplify
 
 logger = logging.getLogger(__name__)
 
@@ -20,45 +31,339 @@ def fetch_and_report_locations_for_devices(
         minutes_ago: int,
         trackers_filter: set[str] = None,
         send_reports: bool = True,
+        scheduler: PollingScheduler = None,
+        store: ReportStore = None,
+        report_mode: ReportMode = "latest",
+        key_index: KeyIndex = None,
 ):
-    try:
-        device_response = _get_device_metadata_from_space_invader_api(limit, page)
-    except NoMoreLocationsToFetch:
-        return []
-
-    if trackers_filter and len(trackers_filter) > 0:
-        devices_to_consider = [device for device in device_response.data if device.name in trackers_filter]
-    else:
-        devices_to_consider = device_response.data
-    apple_result = _fetch_location_metadata_from_icloud(
-        credentials_service=credentials_service, devices_to_consider=devices_to_consider, minutes_ago=minutes_ago
-    )
-    device_map = create_reports(locations=apple_result.results, devices=devices_to_consider)
+    with profile_run():
+        if trackers_filter:
+            # Trackers are looked up across all pages, `page` does not apply
+            devices_to_consider = resolve_trackers(trackers_filter, key_index=key_index, limit=limit)
+        else:
+            try:
+                with phase("device_fetch") as stats:
+                    device_response = _get_device_metadata_from_space_invader_api(limit, page)
+                    stats.items += len(device_response.data)
+            except NoMoreLocationsToFetch:
+                return []
+            devices_to_consider = device_response.data
 
-    devices_with_reports = [x for x in device_map.values() if x.report is not None]
+        return report_locations_for_devices(
+            credentials_service=credentials_service,
+            devices=devices_to_consider,
+            minutes_ago=minutes_ago,
+            send_reports=send_reports,
+            scheduler=scheduler,
+            store=store,
+            report_mode=report_mode,
+            key_index=key_index,
+        )
 
-    logger.info(f"Enriched {len(devices_with_reports)} devices with reports")
 
-    if send_reports:
-        _send_device_locations_to_space_invader_api(devices_with_reports)
+def report_locations_for_devices(
+        credentials_service: CredentialsService,
+        devices: list[BeamerDevice],
+        minutes_ago: int,
+        send_reports: bool = True,
+        scheduler: PollingScheduler = None,
+        store: ReportStore = None,
+        report_mode: ReportMode = "latest",
+        key_index: KeyIndex = None,
+) -> list[BeamerDevice]:
+    """
+    Fetch, decrypt and (optionally) upload the locations of already loaded devices.
+    With a scheduler only the devices due for polling are fetched, each with a lookback covering its last gap.
+    With a store every decrypted report is kept, not only the latest one per device.
+    In "history" report mode each device keeps all its reports in `device.track`, uploaded simplified.
+    In "latest" report mode with UPLOAD_EARLY, reports are decrypted and uploaded while older windows are still
+    being fetched.
+    """
+    with profile_run():
+        freshness = FreshnessTracker()
+        uploader = None
+        if send_reports and settings.UPLOAD_EARLY and report_mode == "latest":
+            uploader = ProgressiveUploader(devices, store=store, key_index=key_index, freshness=freshness)
+        try:
+            if scheduler is None:
+                apple_result = _fetch_location_metadata_from_icloud(
+                    credentials_service=credentials_service, devices_to_consider=devices, minutes_ago=minutes_ago,
+                    on_results=uploader.add if uploader is not None else None, key_index=key_index,
+                )
+            else:
+                devices, apple_result = _fetch_scheduled_location_metadata_from_icloud(
+                    credentials_service=credentials_service, devices=devices, minutes_ago=minutes_ago,
+                    scheduler=scheduler, on_results=uploader.add if uploader is not None else None,
+                    key_index=key_index,
+                )
+        finally:
+            # What was fetched is uploaded even when the fetch fails part way
+            if uploader is not None:
+                uploader.finish()
+
+        if uploader is not None:
+            device_map = uploader.device_map
+            log_report_statistics(uploader.stats_aggregator, devices, max(len(devices), len(device_map)))
+        else:
+            with phase("decrypt") as stats:
+                device_map = create_reports(
+                    locations=apple_result.results, devices=devices, store=store, mode=report_mode,
+                    key_index=key_index,
+                )
+                stats.items += len(apple_result.results)
+
+        devices_with_reports = [x for x in device_map.values() if x.report is not None]
+
+        logger.info(f"Enriched {len(devices_with_reports)} devices with reports")
+
+        if send_reports and uploader is None:
+            _send_device_locations_to_space_invader_api(devices_with_reports, freshness=freshness)
+        if len(freshness):
+            logger.info(f"Report freshness: {freshness.summary()}")
 
     return devices_with_reports
 
 
-def _send_device_locations_to_space_invader_api(devices_with_reports):
-    for chunk in chunks(devices_with_reports, 100):
+class ProgressiveUploader:
+    """
+    Decrypts the locations of every completed chunk of Apple requests, and uploads the devices whose newest report
+    changed in batches of UPLOAD_BATCH_SIZE from a background thread. With the newest windows fetched first,
+    the freshest reports land while the rest is still being fetched, and even when the run is cut short.
+    """
+
+    def __init__(
+            self,
+            devices: list[BeamerDevice],
+            store: ReportStore = None,
+            key_index: KeyIndex = None,
+            freshness: FreshnessTracker = None,
+    ):
+        self.devices_by_hash = {device.public_hash_base64: device for device in devices} if key_index is None else {}
+        # One id map for the whole run, not one per chunk
+        self.resolve_device = key_index_resolver(key_index, devices) if key_index is not None else None
+        self.store = store
+        self.freshness = freshness
+        self.device_map: dict[str, BeamerDevice] = {}
+        self.stats_aggregator = StatsAggregator()
+        self.uploaded = 0
+        self._uploaded_timestamps: dict[str, int] = {}  # device id -> timestamp of the uploaded report
+        self._pending: dict[str, BeamerDevice] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload")
+        self._uploads: list[Future] = []
+
+    def add(self, locations: list[AppleLocation]):
+        with phase("decrypt") as stats:
+            location_ids = {location.id for location in locations}
+            devices = [self.devices_by_hash[i] for i in location_ids if i in self.devices_by_hash]
+            device_map = create_reports(
+                locations=locations, devices=devices, store=self.store, stats_aggregator=self.stats_aggregator,
+                resolve_device=self.resolve_device,
+            )
+            stats.items += len(locations)
+        self.device_map.update(device_map)
+
+        for location_id in location_ids:
+            device = device_map.get(location_id)
+            if device is not None and device.report is not None and \
+                    self._uploaded_timestamps.get(device.id) != device.report.timestamp:
+                self._pending[device.id] = device
+        if len(self._pending) >= settings.UPLOAD_BATCH_SIZE:
+            self._submit()
+
+    def _submit(self):
+        devices = list(self._pending.values())
+        self._pending.clear()
+        for device in devices:
+            self._uploaded_timestamps[device.id] = device.report.timestamp
+        report_payloads = build_report_payloads(devices)
+        published_at = [published_seconds(device.report.date_published) for device in devices]
+        # The upload thread records its phases in the profile of this run
+        self._uploads.append(self._executor.submit(
+            contextvars.copy_context().run, upload_report_payloads, report_payloads, published_at, self.freshness
+        ))
+
+    def finish(self) -> int:
+        """Upload the remaining reports and wait for all uploads, returns the number of reports accepted"""
+        if self._pending:
+            self._submit()
+        self.uploaded = sum(upload.result() for upload in self._uploads)
+        self._executor.shutdown()
+        return self.uploaded
+
+
+def _fetch_scheduled_location_metadata_from_icloud(
+        credentials_service: CredentialsService,
+        devices: list[BeamerDevice],
+        minutes_ago: int,
+        scheduler: PollingScheduler,
+        on_results: Callable[[list[AppleLocation]], None] = None,
+        key_index: KeyIndex = None,
+) -> tuple[list[BeamerDevice], ResponseDto]:
+    now = unix_epoch()
+    devices_by_id = {device.id: device for device in devices}
+    scheduled_devices = []
+    results = []
+
+    for lookback, device_ids in scheduler.plan(list(devices_by_id), minutes_ago, now).items():
+        devices_to_consider = [devices_by_id[device_id] for device_id in device_ids]
+        apple_result = _fetch_location_metadata_from_icloud(
+            credentials_service=credentials_service, devices_to_consider=devices_to_consider, minutes_ago=lookback,
+            on_results=on_results, key_index=key_index,
+        )
+        scheduled_devices.extend(devices_to_consider)
+        results.extend(apple_result.results)
+
+        report_counts = Counter(location.id for location in apple_result.results)
+        newest_reports = {}
+        for location in apple_result.results:
+            if location.date_published is not None:
+                newest_reports[location.id] = max(newest_reports.get(location.id, 0), location.date_published // 1000)
+        for device in devices_to_consider:
+            scheduler.record(
+                device.id,
+                report_count=report_counts[device.public_hash_base64],
+                newest_report=newest_reports.get(device.public_hash_base64),
+                window=lookback * 60,
+                now=now,
+            )
+
+    scheduler.save()
+    return scheduled_devices, ResponseDto(results=results, statusCode="200")
+
+
+def fetch_device_registry(limit: int = settings.DEVICE_BATCH_SIZE) -> list[BeamerDevice]:
+    """All devices (with their private keys) across all pages of the Haystacks API"""
+    devices = []
+    page = 0
+    with phase("device_fetch") as stats:
+        while True:
+            try:
+                device_response = _get_device_metadata_from_space_invader_api(limit, page)
+            except NoMoreLocationsToFetch:
+                break
+            devices.extend(device_response.data)
+            page += 1
+            if page >= device_response.meta.pageCount:
+                break
+        stats.items += len(devices)
+    return devices
+
+
+def resolve_trackers(
+        trackers: set[str], key_index: KeyIndex = None, limit: int = settings.DEVICE_BATCH_SIZE
+) -> list[BeamerDevice]:
+    """
+    Devices of the given tracker names (or device ids): looked up in the key index when there is one,
+    trackers missing from it are searched page by page in the registry until all are found
+    """
+    devices = {}
+    missing = set(trackers)
+    with phase("device_fetch") as stats:
+        if key_index is not None:
+            for tracker in trackers:
+                device_key = key_index.lookup_device(tracker)
+                if device_key is not None:
+                    devices[device_key.id] = device_key.to_device()
+                    missing.discard(tracker)
+
+        page = 0
+        while missing:
+            if key_index is not None and page == 0:
+                logger.info(f"{len(missing)} trackers are not in key index {key_index.path}, searching the registry")
+            try:
+                device_response = _get_device_metadata_from_space_invader_api(limit, page)
+            except NoMoreLocationsToFetch:
+                break
+            for device in device_response.data:
+                for tracker in {device.name, device.id} & missing:
+                    devices[device.id] = device
+                    missing.discard(tracker)
+            page += 1
+            if page >= device_response.meta.pageCount:
+                break
+        stats.items += len(devices)
+
+    if missing:
+        logger.warning(f"Trackers not found in the device registry: {','.join(sorted(missing))}")
+    return list(devices.values())
+
+
+def _send_device_locations_to_space_invader_api(devices_with_reports, freshness: FreshnessTracker = None):
+    devices_with_reports = [device for device in devices_with_reports if device.report]
+    published_at = [published_seconds(device.report.date_published) for device in devices_with_reports]
+    upload_report_payloads(build_report_payloads(devices_with_reports), published_at, freshness)
+
+
+def build_report_payloads(devices_with_reports: list[BeamerDevice]) -> list[dict]:
+    """Haystacks API request bodies of the devices' reports (with their simplified tracks)"""
+    track_points = _simplify_tracks(devices_with_reports)
+
+    with phase("report_build") as stats:
+        report_payloads = [
+            HaystackSignalInput.get_haystack_signal_from_device(
+                device, track_indices=track_points.get(device.id)
+            ).model_dump(exclude_none=True, mode='json')
+            for device in devices_with_reports if device.report
+        ]
+        stats.items += len(report_payloads)
+    return report_payloads
+
+
+def upload_report_payloads(
+        report_payloads: list[dict], published_at: list[int | None] = None, freshness: FreshnessTracker = None
+) -> int:
+    """
+    Upload in chunks of UPLOAD_BATCH_SIZE, returns the number of reports accepted by the Haystacks API.
+    With `freshness` the age of every acknowledged report is observed (`published_at` in unix seconds per payload).
+    """
+    uploaded = 0
+    for offset in range(0, len(report_payloads), settings.UPLOAD_BATCH_SIZE):
+        chunk = report_payloads[offset:offset + settings.UPLOAD_BATCH_SIZE]
         logger.info(f"Sending {len(chunk)} reports to Haystacks API")
-        report_dtos = [HaystackSignalInput.get_haystack_signal_from_device(device) for device in chunk if device.report]
         try:
-            send_reports_to_api(
-                settings.post_haystacks_endpoint,
-                [dto.model_dump(exclude_none=True, mode='json') for dto in report_dtos],
-                headers=settings.headers
-            )
-            sleep(0.5)
+            with phase("upload") as stats:
+                send_reports_to_api(settings.post_haystacks_endpoint, chunk, headers=settings.headers)
+                stats.items += len(chunk)
+            if freshness is not None and published_at is not None:
+                freshness.observe(published_at[offset:offset + len(chunk)])
+            uploaded += len(chunk)
+            sleep(settings.UPLOAD_PAUSE_SECONDS)
         except Exception as e:
             logger.error(f"Failed to send reports: {e}")
             continue
+    return uploaded
+
+
+def _simplify_tracks(devices: list[BeamerDevice]) -> dict[str, list[int]]:
+    """Track points to upload per device id (devices collected in "history" report mode only)"""
+    track_points = {}
+    if not settings.REPORT_TRACK_UPLOAD or settings.REPORT_TRACK_MAX_POINTS <= 0:
+        return track_points
+
+    collected = 0
+    with phase("trajectory") as stats:
+        for device in devices:
+            if device.track is None or device.report is None:
+                continue
+            track_points[device.id] = simplify(
+                device.track,
+                interval=settings.REPORT_TRACK_INTERVAL_SECONDS,
+                tolerance=settings.REPORT_TRACK_TOLERANCE_METERS,
+                stationary_distance=settings.REPORT_TRACK_STATIONARY_METERS,
+                max_points=settings.REPORT_TRACK_MAX_POINTS,
+            )
+            collected += len(device.track)
+        stats.items += collected
+
+    if track_points:
+        uploaded = sum(len(points) for points in track_points.values())
+        metrics.increment("report_track_points_total", collected, stage="collected")
+        metrics.increment("report_track_points_total", uploaded, stage="uploaded")
+        logger.info(
+            f"Simplified {len(track_points)} tracks from {collected} to {uploaded} points "
+            f"(compression ratio {collected / max(uploaded, 1):.1f}x)"
+        )
+    return track_points
 
 
 def fetch_limited_locations_and_generate_reports_for_them(
@@ -67,15 +372,13 @@ def fetch_limited_locations_and_generate_reports_for_them(
         page: int,
         trackers_filter: set[str],
         minutes_ago: int = 15,
+        key_index: KeyIndex = None,
 ) -> list[BeamerDevice]:
-    try:
-        device_response = _get_device_metadata_from_space_invader_api(limit, page)
-    except NoMoreLocationsToFetch:
-        return []
-
-    devices_to_consider = [device for device in device_response.data if device.name in trackers_filter]
+    # Trackers are looked up across all pages, `page` does not apply
+    devices_to_consider = resolve_trackers(trackers_filter, key_index=key_index, limit=limit)
     apple_result = _fetch_location_metadata_from_icloud(
-        credentials_service=credentials_service, devices_to_consider=devices_to_consider, minutes_ago=minutes_ago
+        credentials_service=credentials_service, devices_to_consider=devices_to_consider, minutes_ago=minutes_ago,
+        key_index=key_index,
     )
     device_map = create_reports(locations=apple_result.results, devices=devices_to_consider)
 
@@ -86,11 +389,17 @@ def _fetch_location_metadata_from_icloud(
     credentials_service: CredentialsService,
     devices_to_consider: list[BeamerDevice],
     minutes_ago: int,
+    on_results: Callable[[list[AppleLocation]], None] = None,
+    key_index: KeyIndex = None,
 ) -> ResponseDto:
+    with phase("key_derivation") as stats:
+        if key_index is not None:
+            _set_indexed_public_hashes(devices_to_consider, key_index)
+        ids = [device.public_hash_base64 for device in devices_to_consider]
+        stats.items += len(ids)
     apple_result = apple_fetch(
-        credentials_service=credentials_service,
-        ids=[device.public_hash_base64 for device in devices_to_consider],
-        minutes_ago=minutes_ago)
+        credentials_service=credentials_service, ids=ids, minutes_ago=minutes_ago, on_results=on_results
+    )
     if not apple_result.is_success:
         logger.error(f"Apple API Error[{apple_result.statusCode}]: {apple_result.error}")
         exit(1)
@@ -99,6 +408,16 @@ def _fetch_location_metadata_from_icloud(
     return apple_result
 
 
+def _set_indexed_public_hashes(devices: list[BeamerDevice], key_index: KeyIndex):
+    """Location ids from the key index, only devices missing from it have their public key derived"""
+    for device in devices:
+        if device.publicHash:
+            continue
+        device_key = key_index.lookup_id(device.id)
+        if device_key is not None:
+            device.publicHash = device_key.public_hash_base64
+
+
 def _get_device_metadata_from_space_invader_api(limit, page):
     """
     :raises NoMoreLocationsToFetch: if no devices are found for the given page
@@ -1,8 +1,10 @@
 from app.cryptic import b64_ascii, bytes_to_int, get_hashed_public_key
-from pydantic import BaseModel, Field, computed_field
+from functools import cached_property
+from pydantic import BaseModel, ConfigDict, Field, computed_field
 from typing import List
 
 from app.models import ICloudCredentials
+from app.track import DeviceTrack
 
 
 class Report(BaseModel):
@@ -41,10 +43,14 @@ class BeamerDevice(BaseModel):
         }
     }
     """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     id: str
     name: str
     privateKey: PrivateKey
+    publicHash: str | None = None  # precomputed at ingestion (app/export.py), derived from the private key otherwise
     report: EnrichedReport | None = None
+    track: DeviceTrack | None = Field(default=None, exclude=True)  # every report, in "history" report mode
 
     @computed_field
     @property
@@ -52,8 +58,10 @@ class BeamerDevice(BaseModel):
         return bytes(self.privateKey.data)
 
     @computed_field
-    @property
+    @cached_property
     def public_hash_base64(self) -> str:
+        if self.publicHash:
+            return self.publicHash
         return b64_ascii(get_hashed_public_key(self.private_key_bytes))
 
     @computed_field
@@ -85,9 +93,16 @@ class HaystackSignalInput(BaseModel):
     id: str
     name: str
     report: HaystackReport
+    # Simplified track, oldest first. Only sent with REPORT_TRACK_UPLOAD, the API is not known to accept it.
+    reports: list[HaystackReport] | None = None
 
     @staticmethod
-    def get_haystack_signal_from_device(device: BeamerDevice) -> 'HaystackSignalInput':
+    def get_haystack_signal_from_device(
+            device: BeamerDevice, track_indices: list[int] = None
+    ) -> 'HaystackSignalInput':
+        reports = None
+        if device.track is not None and track_indices:
+            reports = [HaystackReport(**device.track.point(i)) for i in track_indices]
         return HaystackSignalInput(
             id=device.id,
             name=device.name,
@@ -96,7 +111,8 @@ class HaystackSignalInput(BaseModel):
                 lat=device.report.lat,
                 lon=device.report.lon,
                 conf=device.report.conf
-            )
+            ),
+            reports=reports,
         )
 
 
@@ -1,34 +1,187 @@
 #!/usr/bin/env python3
 
 """
-Export from Property Lists files
-"""
+Export from Property Lists files: bulk ingestion of device keys.
+Plists are parsed (and public key hashes derived) in parallel, devices are deduplicated by key fingerprint
+and uploaded in one PUT. The tool needs no collector settings, the API key comes from API_KEY.
+Splitting the upload into batches (uploaded while parsing continues) is opt-in: the devices endpoint replaces the
+device list on PUT unless it is known to merge them.
 
-from os import walk, path
+Usage: python -m app.export [PLIST_DIR] [URL] (or `manage.py export-devices`)
+"""
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path, walk
 from plistlib import load
-from requests import put
-from cryptic import b64_ascii
+
+from requests import Session
+
+from app.cryptic import b64_ascii, get_hashed_public_key
+from app.helpers import status_code_success
+
+logger = logging.getLogger(__name__)
 
 PLIST_DIR = "/tmp/plists"
 URL = ""
-HEADERS = {"X-API-Key": "xyz"}
+HEADERS = {"x-api-key": os.environ.get("API_KEY", "")}
+# 0: no limit, all devices go in a single request
+MAX_BATCH_DEVICES = 0
+MAX_BATCH_BYTES = 0
+RETRY_BACKOFF = (1, 2, 5, 10, 30)
 
-if __name__ == "__main__":
-    devices = []
-    for root, dirs, files in walk(PLIST_DIR):
+
+def find_plists(plist_dir: str) -> list[str]:
+    plist_paths = []
+    for root, dirs, files in walk(plist_dir):
         for file in files:
             if file.endswith(".plist"):
-                plist_path = path.join(root, file)
-                print("Reading", plist_path)
-                with open(plist_path, "rb") as plist:
-                    for device in load(plist):
-                        devices.append(
-                            {
-                                "name": device["name"],
-                                "privateKey": b64_ascii(device["privateKey"]),
-                            }
-                        )
-    print(devices)
-    if URL.startswith("http"):
-        response = put(URL, headers=HEADERS, json=devices, timeout=60)
-        print("status_code:", response.status_code)
+                plist_paths.append(path.join(root, file))
+    return sorted(plist_paths)
+
+
+def read_plist(plist_path: str) -> list[dict]:
+    """Devices of one plist with their base64 private key and precomputed public key hash (runs in a worker)"""
+    with open(plist_path, "rb") as plist:
+        return [
+            {
+                "name": device["name"],
+                "privateKey": b64_ascii(device["privateKey"]),
+                "publicHash": b64_ascii(get_hashed_public_key(device["privateKey"])),
+            }
+            for device in load(plist)
+        ]
+
+
+class BatchUploader:
+    """
+    Collects devices into batches bounded by count and JSON size (0 = unbounded), uploading each full batch
+    with retries
+    """
+
+    def __init__(
+            self,
+            url: str,
+            headers: dict,
+            max_devices: int = MAX_BATCH_DEVICES,
+            max_bytes: int = MAX_BATCH_BYTES,
+            backoff: tuple[int, ...] = RETRY_BACKOFF,
+    ):
+        self.url = url
+        self.headers = headers
+        self.max_devices = max_devices
+        self.max_bytes = max_bytes
+        self.backoff = backoff
+        self.uploaded = 0
+        self.failed = 0
+        self._batch: list[dict] = []
+        self._batch_bytes = 0
+        self._session = Session()
+
+    def add(self, device: dict):
+        size = len(json.dumps(device)) + 1
+        if self._batch and (
+                0 < self.max_devices <= len(self._batch) or 0 < self.max_bytes < self._batch_bytes + size
+        ):
+            self.flush()
+        self._batch.append(device)
+        self._batch_bytes += size
+
+    def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        if self._put(batch):
+            self.uploaded += len(batch)
+        else:
+            self.failed += len(batch)
+
+    def _put(self, batch: list[dict]) -> bool:
+        for attempt in range(len(self.backoff) + 1):
+            try:
+                response = self._session.put(self.url, headers=self.headers, json=batch, timeout=60)
+                if status_code_success(response.status_code):
+                    logger.info(f"Uploaded {len(batch)} devices")
+                    return True
+                # Client errors will not go away by retrying
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    logger.error(f"Upload of {len(batch)} devices rejected [{response.status_code}]: {response.text}")
+                    return False
+                logger.warning(f"Upload of {len(batch)} devices failed [{response.status_code}]: {response.text}")
+            except Exception as e:
+                logger.warning(f"Upload of {len(batch)} devices failed: {e}")
+            if attempt < len(self.backoff):
+                time.sleep(self.backoff[attempt])
+        logger.error(f"Giving up on a batch of {len(batch)} devices after {len(self.backoff) + 1} attempts")
+        return False
+
+
+def ingest(
+        plist_dir: str = PLIST_DIR,
+        url: str = URL,
+        headers: dict = None,
+        output: str = None,
+        workers: int = None,
+        max_batch_devices: int = MAX_BATCH_DEVICES,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+) -> dict:
+    """
+    Parse all plists below `plist_dir`, upload the unique devices to `url` (when it is an http(s) URL)
+    and/or write them as JSON lines to `output`. Returns counts of the run.
+    """
+    plist_paths = find_plists(plist_dir)
+    logger.info(f"Found {len(plist_paths)} plists in {plist_dir}")
+
+    uploader = None
+    if url.startswith("http"):
+        uploader = BatchUploader(url, headers or HEADERS, max_batch_devices, max_batch_bytes)
+    output_file = open(output, "w") if output else None
+
+    fingerprints: dict[str, str] = {}
+    counts = {"plists": len(plist_paths), "devices": 0, "duplicates": 0, "failed_plists": 0}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(read_plist, plist_path): plist_path for plist_path in plist_paths}
+            for future in as_completed(futures):
+                try:
+                    devices = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to read {futures[future]}: {e}")
+                    counts["failed_plists"] += 1
+                    continue
+
+                for device in devices:
+                    known_as = fingerprints.get(device["publicHash"])
+                    if known_as is not None:
+                        counts["duplicates"] += 1
+                        if known_as != device["name"]:
+                            logger.warning(f"{device['name']} has the same key as {known_as}, skipping it")
+                        continue
+                    fingerprints[device["publicHash"]] = device["name"]
+                    counts["devices"] += 1
+                    if output_file:
+                        output_file.write(json.dumps(device) + "\n")
+                    if uploader:
+                        uploader.add(device)
+        if uploader:
+            uploader.flush()
+    finally:
+        if output_file:
+            output_file.close()
+
+    if uploader:
+        counts["uploaded"], counts["upload_failed"] = uploader.uploaded, uploader.failed
+    logger.info(f"Ingestion finished: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    result = ingest(
+        plist_dir=sys.argv[1] if len(sys.argv) > 1 else PLIST_DIR,
+        url=sys.argv[2] if len(sys.argv) > 2 else URL,
+    )
+    print("status:", result)
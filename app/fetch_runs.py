@@ -0,0 +1,184 @@
+"""
+Coalescing of credential-triggered fetch runs.
+
+Every credentials update may ask for a full-fleet fetch run, and they come in bursts (`refresh-credentials` pushes
+several times in a few minutes). A trigger only enqueues a run when no run was queued in the last
+`coalesce_seconds` and none is queued or in flight; other triggers are counted on the current run. The state is
+shared by all Lambda instances through a store whose writes are conditional, like the credentials breaker.
+"""
+import abc
+import logging
+import threading
+import time
+from typing import Callable
+
+from app.metrics import metrics
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+
+
+class FetchRun:
+    def __init__(
+            self,
+            run_id: str,
+            status: str = QUEUED,
+            queued_at: int = 0,
+            changed_at: int = 0,
+            pages: int = 1,
+            pages_done: int = 0,
+            triggers: int = 1,
+    ):
+        self.run_id = run_id
+        self.status = status
+        self.queued_at = queued_at  # unix time of the first trigger
+        self.changed_at = changed_at
+        self.pages = pages
+        self.pages_done = pages_done
+        self.triggers = triggers  # triggers coalesced into this run
+
+    def __repr__(self):
+        return f"FetchRun({self.run_id}, {self.status}, pages {self.pages_done}/{self.pages}, triggers={self.triggers})"
+
+
+class FetchRunStore:
+    """The current fetch run of the fleet. Transitions are conditional and return whether they happened."""
+
+    @abc.abstractmethod
+    def get(self) -> FetchRun | None:
+        pass
+
+    @abc.abstractmethod
+    def claim(self, run: FetchRun, coalesce_seconds: int, run_timeout: int) -> bool:
+        """
+        Make `run` the current run, unless the current one was queued less than `coalesce_seconds` ago,
+        or is queued or running and changed less than `run_timeout` ago
+        """
+        pass
+
+    @abc.abstractmethod
+    def coalesce(self):
+        """Count a trigger on the current run"""
+        pass
+
+    @abc.abstractmethod
+    def start(self, run_id: str) -> bool:
+        """Running, unless `run_id` is no longer the current run or already finished"""
+        pass
+
+    @abc.abstractmethod
+    def finish_page(self, run_id: str) -> bool:
+        """Count a processed page, the run is finished with its last page"""
+        pass
+
+    @abc.abstractmethod
+    def abandon(self, run_id: str):
+        """Finished without being run (enqueueing or a page failed), the next trigger may queue a run again"""
+        pass
+
+
+class LocalFetchRunStore(FetchRunStore):
+    """Fetch run state of a single process (local runs of the Lambda handlers)"""
+
+    def __init__(self):
+        self._run: FetchRun | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> FetchRun | None:
+        with self._lock:
+            return FetchRun(**vars(self._run)) if self._run is not None else None
+
+    def claim(self, run: FetchRun, coalesce_seconds: int, run_timeout: int) -> bool:
+        with self._lock:
+            current = self._run
+            if current is not None and not (
+                    current.queued_at <= run.queued_at - coalesce_seconds
+                    and (current.status == FINISHED or current.changed_at <= run.queued_at - run_timeout)
+            ):
+                return False
+            self._run = FetchRun(**vars(run))
+            return True
+
+    def coalesce(self):
+        with self._lock:
+            if self._run is not None:
+                self._run.triggers += 1
+
+    def _update(self, run_id: str, update: Callable[[FetchRun], None]) -> bool:
+        with self._lock:
+            if self._run is None or self._run.run_id != run_id or self._run.status == FINISHED:
+                return False
+            update(self._run)
+            self._run.changed_at = int(time.time())
+            return True
+
+    def start(self, run_id: str) -> bool:
+        return self._update(run_id, lambda run: setattr(run, "status", RUNNING))
+
+    def finish_page(self, run_id: str) -> bool:
+        def update(run: FetchRun):
+            run.pages_done += 1
+            if run.pages_done >= run.pages:
+                run.status = FINISHED
+
+        return self._update(run_id, update)
+
+    def abandon(self, run_id: str):
+        def update(run: FetchRun):
+            run.status = FINISHED
+            run.queued_at = 0
+
+        self._update(run_id, update)
+
+
+class FetchRunScheduler:
+    def __init__(
+            self,
+            store: FetchRunStore,
+            coalesce_seconds: int = settings.FETCH_RUN_COALESCE_SECONDS,
+            run_timeout: int = settings.FETCH_RUN_TIMEOUT_SECONDS,
+    ):
+        self._store = store
+        self._coalesce_seconds = coalesce_seconds
+        self._run_timeout = run_timeout
+
+    def trigger(self, pages: int, enqueue: Callable[[FetchRun], None], now: int = None) -> FetchRun | None:
+        """
+        Queue a run of `pages` pages through `enqueue` (which sends its messages), or coalesce
+        the trigger into the current run. Returns the queued run, None when coalesced.
+        """
+        now = now if now is not None else int(time.time())
+        run = FetchRun(run_id=str(now), queued_at=now, changed_at=now, pages=pages)
+        if not self._store.claim(run, self._coalesce_seconds, self._run_timeout):
+            self._store.coalesce()
+            metrics.increment("fetch_run_triggers_total", outcome="coalesced")
+            logger.info(f"Fetch run already queued or in flight, coalesced the trigger into {self._store.get()}")
+            return None
+
+        try:
+            enqueue(run)
+        except Exception:
+            self._store.abandon(run.run_id)
+            raise
+        metrics.increment("fetch_run_triggers_total", outcome="queued")
+        logger.info(f"Queued fetch run {run.run_id} of {pages} pages")
+        return run
+
+    def started(self, run_id: str, triggered_at: int, now: float = None):
+        """A page of the run was picked up, records the trigger-to-run latency"""
+        now = now if now is not None else time.time()
+        metrics.observe("fetch_run_trigger_latency_seconds", max(now - triggered_at, 0))
+        if not self._store.start(run_id):
+            logger.info(f"Fetch run {run_id} is no longer current, processing its page anyway")
+
+    def finished(self, run_id: str):
+        self._store.finish_page(run_id)
+
+    def abandon(self, run_id: str):
+        """A page of the run failed: the run no longer coalesces triggers, the next one queues a new run"""
+        self._store.abandon(run_id)
+        logger.info(f"Abandoned fetch run {run_id}")
@@ -0,0 +1,51 @@
+"""
+Freshness of uploaded reports: time from Apple publishing a report to the Haystacks API acknowledging its upload
+"""
+import threading
+import time
+from array import array
+
+from app.metrics import metrics
+
+
+def published_seconds(date_published: int | None) -> int | None:
+    """Unix seconds of a `datePublished`, which Apple sends in milliseconds"""
+    if date_published is None:
+        return None
+    return date_published // 1000 if date_published > 10 ** 11 else date_published
+
+
+class FreshnessTracker:
+    """Freshness of the reports uploaded in one run, also observed in `report_freshness_seconds`"""
+
+    def __init__(self):
+        self._ages = array("d")
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ages)
+
+    def observe(self, published_at: list[int | None], acked_at: float = None):
+        acked_at = acked_at if acked_at is not None else time.time()
+        ages = [max(acked_at - published, 0.0) for published in published_at if published is not None]
+        for age in ages:
+            metrics.observe("report_freshness_seconds", age)
+        with self._lock:
+            self._ages.extend(ages)
+
+    def summary(self) -> dict | None:
+        with self._lock:
+            ordered = sorted(self._ages)
+        if not ordered:
+            return None
+
+        def percentile(q: float) -> float:
+            return round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 1)
+
+        return {
+            "reports": len(ordered),
+            "p50_s": percentile(0.5),
+            "p90_s": percentile(0.9),
+            "p99_s": percentile(0.99),
+            "max_s": round(ordered[-1], 1),
+        }
@@ -0,0 +1,126 @@
+"""
+Hedged requests: a request still pending after a tracked latency percentile is sent a second time,
+and the first response wins
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """Percentiles over the latest `window` latencies, recomputed at most every `refresh_every` observations"""
+
+    def __init__(self, window: int = 500, refresh_every: int = 50):
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._refresh_every = refresh_every
+        self._since_refresh = 0
+        self._sorted: list[float] = []
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def observe(self, latency: float):
+        self._latencies.append(latency)
+        self._since_refresh += 1
+
+    def percentile(self, q: float) -> float | None:
+        if not self._latencies:
+            return None
+        if self._since_refresh >= self._refresh_every or not self._sorted:
+            self._sorted = sorted(self._latencies)
+            self._since_refresh = 0
+        return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class RequestHedger:
+    """
+    Sends a duplicate of a request that has not completed after the `percentile` latency of recent successful
+    requests (at least `min_delay` seconds, once `min_samples` are known). Hedges are capped at `max_ratio` of
+    all requests by a token bucket, so a slow upstream is not hit with twice the traffic.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = False,
+            percentile: float = 0.95,
+            max_ratio: float = 0.05,
+            min_delay: float = 0.05,
+            min_samples: int = 20,
+            burst: float = 10,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.burst = burst
+        self.latencies = LatencyTracker()
+        self._tokens = 0.0
+
+    def delay(self) -> float | None:
+        """Seconds after which a request is hedged, None while too few latencies are known"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.latencies.percentile(self.percentile), self.min_delay)
+
+    def _take_token(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def run(self, send: Callable[[], Awaitable[T]], succeeded: Callable[[T], bool] = lambda _: True) -> T:
+        """
+        Result of `send()`, or of its hedge if that succeeds first. Every call of `send` is a request of its own,
+        it does its own throttling and accounting.
+        """
+        if not self.enabled:
+            return await send()
+
+        self._tokens = min(self._tokens + self.max_ratio, self.burst)
+        delay = self.delay()
+        primary = asyncio.ensure_future(self._timed(send, succeeded))
+        attempts = [primary]
+        try:
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if done or not self._take_token():
+                return await primary
+
+            metrics.increment("apple_fetch_hedges_total", outcome="sent")
+            hedge = asyncio.ensure_future(self._timed(send, succeeded))
+            attempts.append(hedge)
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None and succeeded(task.result())]
+                if winners:
+                    winner = winners[0]
+                    metrics.increment("apple_fetch_hedges_total", outcome="won" if winner is hedge else "lost")
+                    return winner.result()
+                # A failed attempt only decides the result when no other attempt is pending
+                if not pending:
+                    metrics.increment("apple_fetch_hedges_total", outcome="failed")
+                    # An unsuccessful response (e.g. a 401 to act on) rather than an exception, the primary's first
+                    responses = [task for task in attempts if task.exception() is None]
+                    return (responses[0] if responses else primary).result()
+        finally:
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+
+    async def _timed(self, send: Callable[[], Awaitable[T]], succeeded: Callable[[T], bool]) -> T:
+        started_at = time.perf_counter()
+        result = await send()
+        if succeeded(result):
+            self.latencies.observe(time.perf_counter() - started_at)
+        return result
@@ -0,0 +1,207 @@
+"""
+On-disk, memory-mapped index from hashed public keys (the acsnservice location ids) to device key material,
+with a secondary lookup by device name or id
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from base64 import b64decode
+from bisect import bisect_left
+from typing import Iterable, NamedTuple
+
+from app.cryptic import b64_ascii
+from app.dtos import BeamerDevice, PrivateKey
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HKIX"
+VERSION = 2
+# magic, version, count, offsets of the hash, device index, record offset, record, lookup key
+# and lookup position sections
+HEADER = struct.Struct("<4sIQQQQQQQ")
+HASH_SIZE = 32
+LOOKUP_KEY_SIZE = 16
+PRIVATE_KEY_SIZE = 28
+RECORD_HEADER = struct.Struct("<HH")  # lengths of the device id and name following the private key
+
+
+class DeviceKey(NamedTuple):
+    device_index: int
+    id: str
+    name: str
+    private_key: bytes
+    public_hash: bytes  # the hashed public key, i.e. the location id
+
+    @property
+    def public_hash_base64(self) -> str:
+        return b64_ascii(self.public_hash)
+
+    def to_device(self) -> BeamerDevice:
+        return BeamerDevice(
+            id=self.id,
+            name=self.name,
+            privateKey=PrivateKey(type="Buffer", data=list(self.private_key)),
+            publicHash=self.public_hash_base64,
+        )
+
+
+class _HashView:
+    """Sequence over a sorted section of fixed-size keys, so `bisect` searches the mapped file without copying it"""
+
+    def __init__(self, buffer: memoryview, count: int, size: int = HASH_SIZE):
+        self._buffer = buffer
+        self._count = count
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        return self._buffer[i * self._size:(i + 1) * self._size].tobytes()
+
+
+def _lookup_key(kind: bytes, value: str) -> bytes:
+    return hashlib.blake2b(kind + b"\0" + value.encode(), digest_size=LOOKUP_KEY_SIZE).digest()
+
+
+class KeyIndex:
+    """
+    Layout (little endian): header, then
+    - hashes: `count` sorted 32-byte hashed public keys
+    - device indices: `count` uint32, the position of each device in the registry it was built from
+    - record offsets: `count` uint64, where the key material of each device starts in the records section
+    - records: private key (28 bytes), id and name lengths (2 x uint16), id, name
+    - lookup keys: `2 * count` sorted 16-byte digests of every device's name and id
+    - lookup positions: `2 * count` uint32, the position in the hash section each lookup key belongs to
+    Only the pages touched by lookups are resident.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer = memoryview(self._mmap)
+        magic, version = struct.unpack_from("<4sI", self._buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(
+                f"{path} is not a device key index (version {VERSION}), rebuild it with `manage.py build-key-index`"
+            )
+        (
+            _, _, self.count, hashes_at, indices_at, offsets_at, records_at, lookups_at, positions_at
+        ) = HEADER.unpack_from(self._buffer)
+        self._hashes = _HashView(self._buffer[hashes_at:indices_at], self.count)
+        self._device_indices = self._buffer[indices_at:offsets_at].cast("I")
+        self._record_offsets = self._buffer[offsets_at:records_at].cast("Q")
+        self._records = self._buffer[records_at:lookups_at]
+        self._lookup_keys = _HashView(self._buffer[lookups_at:positions_at], 2 * self.count, LOOKUP_KEY_SIZE)
+        self._lookup_positions = self._buffer[positions_at:].cast("I")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        for view in (
+                self._device_indices, self._record_offsets, self._records, self._lookup_positions, self._buffer
+        ):
+            view.release()
+        self._hashes = self._lookup_keys = None
+        self._mmap.close()
+        self._file.close()
+
+    def find(self, hashed_public_key: bytes) -> int | None:
+        """Position of the hash in the index, None if the device is not indexed"""
+        i = bisect_left(self._hashes, hashed_public_key)
+        if i < self.count and self._hashes[i] == hashed_public_key:
+            return i
+        return None
+
+    def lookup(self, public_hash_base64: str) -> DeviceKey | None:
+        try:
+            hashed_public_key = b64decode(public_hash_base64)
+        except ValueError:
+            return None
+        i = self.find(hashed_public_key)
+        if i is None:
+            return None
+        return self._device_key(i)
+
+    def lookup_device(self, name_or_id: str) -> DeviceKey | None:
+        """Device by its name (e.g. a tracker name) or id, None if it is not indexed"""
+        return self._lookup(b"name", name_or_id) or self._lookup(b"id", name_or_id)
+
+    def lookup_id(self, device_id: str) -> DeviceKey | None:
+        """Device by its id, None if it is not indexed"""
+        return self._lookup(b"id", device_id)
+
+    def _lookup(self, kind: bytes, value: str) -> DeviceKey | None:
+        key = _lookup_key(kind, value)
+        i = bisect_left(self._lookup_keys, key)
+        while i < len(self._lookup_keys) and self._lookup_keys[i] == key:
+            device_key = self._device_key(self._lookup_positions[i])
+            # Digests may collide, the record decides
+            if value == (device_key.name if kind == b"name" else device_key.id):
+                return device_key
+            i += 1
+        return None
+
+    def public_hashes(self) -> Iterable[str]:
+        """All indexed location ids (base64), in hash order"""
+        for i in range(self.count):
+            yield b64_ascii(self._hashes[i])
+
+    def _device_key(self, i: int) -> DeviceKey:
+        offset = self._record_offsets[i]
+        private_key = bytes(self._records[offset:offset + PRIVATE_KEY_SIZE])
+        offset += PRIVATE_KEY_SIZE
+        id_length, name_length = RECORD_HEADER.unpack_from(self._records, offset)
+        offset += RECORD_HEADER.size
+        device_id = bytes(self._records[offset:offset + id_length]).decode()
+        name = bytes(self._records[offset + id_length:offset + id_length + name_length]).decode()
+        return DeviceKey(self._device_indices[i], device_id, name, private_key, self._hashes[i])
+
+    @staticmethod
+    def build(devices: list[BeamerDevice], path: str) -> "KeyIndex":
+        """Write the index of `devices` to `path` (atomically replacing an older index) and open it"""
+        entries = sorted(
+            (b64decode(device.public_hash_base64), device_index) for device_index, device in enumerate(devices)
+        )
+
+        records = bytearray()
+        record_offsets = []
+        for device in devices:
+            record_offsets.append(len(records))
+            device_id, name = device.id.encode(), device.name.encode()
+            records += device.private_key_bytes.rjust(PRIVATE_KEY_SIZE, b"\0")
+            records += RECORD_HEADER.pack(len(device_id), len(name))
+            records += device_id + name
+
+        lookups = sorted(
+            (_lookup_key(kind, value), position)
+            for position, (_, device_index) in enumerate(entries)
+            for kind, value in ((b"name", devices[device_index].name), (b"id", devices[device_index].id))
+        )
+
+        count = len(entries)
+        hashes_at = HEADER.size
+        indices_at = hashes_at + count * HASH_SIZE
+        offsets_at = indices_at + count * 4
+        records_at = offsets_at + count * 8
+        lookups_at = records_at + len(records)
+        positions_at = lookups_at + len(lookups) * LOOKUP_KEY_SIZE
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, VERSION, count, hashes_at, indices_at, offsets_at, records_at, lookups_at, positions_at
+            ))
+            f.write(b"".join(hashed_public_key for hashed_public_key, _ in entries))
+            f.write(struct.pack(f"<{count}I", *(device_index for _, device_index in entries)))
+            f.write(struct.pack(f"<{count}Q", *(record_offsets[device_index] for _, device_index in entries)))
+            f.write(records)
+            f.write(b"".join(key for key, _ in lookups))
+            f.write(struct.pack(f"<{len(lookups)}I", *(position for _, position in lookups)))
+        os.replace(tmp_path, path)
+        logger.info(f"Built key index of {count} devices in {path} ({os.path.getsize(path) / 1024 ** 2:.1f} MB)")
+        return KeyIndex(path)
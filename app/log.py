@@ -0,0 +1,155 @@
+"""
+Logging setup: records are handed to a queue and written by a background thread, optionally as JSON lines,
+with repeated warnings of hot-path call sites rate-limited
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Attributes every LogRecord has, everything else on a record came in through `extra`
+_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName", "rate_limit"}
+
+# `extra` of hot-path warnings that may repeat for every payload or request, and are rate-limited per call site
+RATE_LIMITED = {"rate_limit": True}
+
+_listener: logging.handlers.QueueListener | None = None
+_queue: queue.Queue | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        if record.stack_info:
+            document["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(document, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most `burst` records per call site (file and line) every `interval` seconds, for records logged with
+    `extra=RATE_LIMITED` up to WARNING only. The first record let through after a suppression says how many
+    were dropped.
+    """
+
+    def __init__(self, burst: int = 10, interval: float = 60):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows: dict[tuple, list] = {}  # call site -> [window start, records let through, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno > logging.WARNING or not getattr(record, "rate_limit", False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} ({suppressed} similar records suppressed)"
+                    record.args = None
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging(config_path: str = "app/logging.json", log_format: str = "text", rate_limit: int = 10):
+    """
+    Configure logging from `config_path`, then move its root handlers behind a queue so logging calls
+    never block on I/O. `log_format` "json" switches the handlers to JSON lines.
+    """
+    with open(config_path, "rt") as f:
+        logging.config.dictConfig(json.load(f))
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        if log_format == "json":
+            handler.setFormatter(JsonFormatter())
+        root.removeHandler(handler)
+
+    stop_logging()
+    _start_listener(handlers)
+    root.addHandler(_QueueHandler(RateLimitFilter(burst=rate_limit)))
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Always enqueues to the current queue, which is replaced in forked worker processes"""
+
+    def __init__(self, rate_limit_filter: RateLimitFilter):
+        super().__init__(None)
+        self.addFilter(rate_limit_filter)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Only the message is resolved here (its arguments may change once the call returns), the handlers of the
+        listener format the record: the traceback stays apart from the message, as `exc_text`
+        """
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            # The traceback's frames are not kept alive while the record waits in the queue
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        _queue.put_nowait(record)
+
+
+def _start_listener(handlers):
+    global _listener, _queue
+    _queue = queue.Queue(-1)
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_in_child():
+    # The listener thread does not survive a fork (and the queue's locks may be held), start over in the child
+    if _listener is not None:
+        _start_listener(_listener.handlers)
+
+
+def flush_logs():
+    """Wait until all queued records are written (e.g. before a Lambda invocation returns)"""
+    if _queue is not None:
+        _queue.join()
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,221 @@
+"""
+In-process metrics, exported as CloudWatch Embedded Metric Format (Lambda) or Prometheus text (CLI / daemon)
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, unit: str = "Count"):
+        self.name = name
+        self.description = description
+        self.unit = unit
+        self.values: dict[tuple, float] = {}
+
+    def increment(self, labels: tuple, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple, unit: str):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.unit = unit
+        self.values: dict[tuple, list] = {}  # labels -> [bucket counts (+Inf last), sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the `q` quantile over all label sets (None if empty or beyond the last)"""
+        counts = [0] * (len(self.buckets) + 1)
+        for bucket_counts, _, _ in self.values.values():
+            counts = [total + count for total, count in zip(counts, bucket_counts)]
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return None
+
+
+class MetricsRegistry:
+    def __init__(self, namespace: str = "AppleCollector"):
+        self.namespace = namespace
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str, unit: str = "Count") -> Counter:
+        return self._metrics.setdefault(name, Counter(name, description, unit))
+
+    def histogram(self, name: str, description: str, buckets: tuple, unit: str = "Seconds") -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, description, buckets, unit))
+
+    def get(self, name: str) -> Counter | Histogram:
+        return self._metrics[name]
+
+    def increment(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._metrics[name].increment(tuple(sorted(labels.items())), value)
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            self._metrics[name].observe(tuple(sorted(labels.items())), value)
+
+    def reset(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.values.clear()
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.description}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for labels, value in metric.values.items():
+                    if metric.kind == "counter":
+                        lines.append(f"{metric.name}{_prometheus_labels(labels)} {value}")
+                        continue
+                    bucket_counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(metric.buckets + ("+Inf",), bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f"{metric.name}_bucket{_prometheus_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{metric.name}_sum{_prometheus_labels(labels)} {total}")
+                    lines.append(f"{metric.name}_count{_prometheus_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_emf(self) -> list[dict]:
+        """One Embedded Metric Format document per label set"""
+        documents: dict[tuple, dict] = {}
+        timestamp = int(time.time() * 1000)
+        with self._lock:
+            for metric in self._metrics.values():
+                for labels, value in metric.values.items():
+                    document = documents.get(labels)
+                    if document is None:
+                        document = documents[labels] = {
+                            "_aws": {
+                                "Timestamp": timestamp,
+                                "CloudWatchMetrics": [{
+                                    "Namespace": self.namespace,
+                                    "Dimensions": [[key for key, _ in labels]],
+                                    "Metrics": [],
+                                }],
+                            },
+                            **{key: str(label) for key, label in labels},
+                        }
+                    document["_aws"]["CloudWatchMetrics"][0]["Metrics"].append({"Name": metric.name, "Unit": metric.unit})
+                    if metric.kind == "counter":
+                        document[metric.name] = value
+                    else:
+                        document[metric.name] = _emf_distribution(metric, value)
+        return list(documents.values())
+
+    def flush_emf(self):
+        """Print the metrics as EMF to stdout (picked up from the Lambda logs) and start over"""
+        for document in self.to_emf():
+            print(json.dumps(document), flush=True)
+        self.reset()
+
+    def write_prometheus(self, path: str):
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
+
+
+def _prometheus_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _emf_distribution(histogram: Histogram, value: list) -> dict:
+    """Bucket upper bounds (the last finite bound for +Inf) with their counts"""
+    bucket_counts, _, _ = value
+    bounds = histogram.buckets + (histogram.buckets[-1],)
+    values, counts = [], []
+    for bound, count in zip(bounds, bucket_counts):
+        if count:
+            values.append(bound)
+            counts.append(count)
+    return {"Values": values, "Counts": counts}
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve `metrics` as Prometheus text on /metrics from a background thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
+
+
+metrics = MetricsRegistry()
+metrics.histogram("apple_fetch_request_seconds", "Latency of acsnservice requests", LATENCY_BUCKETS)
+metrics.histogram("apple_fetch_response_bytes", "Size of acsnservice response bodies", SIZE_BUCKETS, unit="Bytes")
+metrics.histogram("apple_fetch_results_per_request", "Locations per successful acsnservice response", COUNT_BUCKETS,
+                  unit="Count")
+metrics.counter("apple_fetch_responses_total", "acsnservice responses by status code")
+metrics.counter("apple_fetch_retries_total", "acsnservice payloads retried")
+metrics.counter("apple_fetch_hedges_total", "Hedged acsnservice requests sent, and whether the hedge won")
+metrics.counter("apple_response_cache_total", "acsnservice requests for closed windows by cache tier that answered")
+metrics.counter("apple_credentials_refreshes_total", "Credential fetches after expiry or 401")
+metrics.counter("apple_credentials_breaker_trips_total", "Credentials circuit breaker openings by account")
+metrics.histogram(
+    "apple_credentials_breaker_wait_seconds", "Time requests waited for newer credentials behind an open breaker",
+    (1, 5, 10, 30, 60, 120, 300, 600),
+)
+metrics.histogram(
+    "report_freshness_seconds", "Time from Apple publishing a report to the Haystacks API acknowledging its upload",
+    (60, 300, 600, 900, 1800, 3600, 3 * 3600, 6 * 3600, 24 * 3600),
+)
+metrics.counter("fetch_run_triggers_total", "Credential-triggered fetch runs queued or coalesced into a queued run")
+metrics.histogram(
+    "fetch_run_trigger_latency_seconds", "Time from the trigger of a fetch run to a worker picking up its page",
+    (1, 5, 10, 30, 60, 120, 300, 600, 900),
+)
+metrics.histogram("haystacks_request_seconds", "Latency of Haystacks API requests", LATENCY_BUCKETS)
+metrics.counter("collector_cycles_total", "Collection cycles of the collector daemon by outcome")
+metrics.counter("report_payloads_rejected_total", "Report payloads not decrypted by reason (incl. quarantined)")
+metrics.counter("report_track_points_total", "Track points collected and uploaded after simplification")
+metrics.counter("backfill_units_total", "Backfill work units by outcome")
+metrics.histogram("collector_cycle_seconds", "Duration of collection cycles", (10, 30, 60, 120, 300, 600, 900))
@@ -0,0 +1,123 @@
+"""
+Phase-level timing of a collection run
+"""
+import logging
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.items = 0
+        self.peak_memory: int | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "phase": self.name,
+            "calls": self.calls,
+            "wall_s": round(self.wall_time, 4),
+            "cpu_s": round(self.cpu_time, 4),
+            "items": self.items,
+            "peak_memory_mb": round(self.peak_memory / 1024 ** 2, 2) if self.peak_memory is not None else None,
+        }
+
+
+class RunProfile:
+    """
+    Wall time, CPU time, item counts and (with `trace_memory`) peak traced memory per phase.
+    Phases entered several times (e.g. once per chunk) are accumulated.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.phases: dict[str, PhaseStats] = {}
+        self._started_at = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        stats = self.phases.setdefault(name, PhaseStats(name))
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.calls += 1
+            stats.wall_time += time.perf_counter() - wall_start
+            stats.cpu_time += time.process_time() - cpu_start
+            if self.trace_memory and tracemalloc.is_tracing():
+                stats.peak_memory = max(stats.peak_memory or 0, tracemalloc.get_traced_memory()[1])
+
+    @property
+    def wall_time(self) -> float:
+        return time.perf_counter() - self._started_at
+
+    def as_dict(self) -> dict:
+        return {
+            "wall_s": round(self.wall_time, 4),
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+            "phases": [stats.as_dict() for stats in self.phases.values()],
+        }
+
+    def report(self) -> str:
+        lines = [f"{'phase':<20}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'items':>10}{'peak MB':>10}"]
+        for stats in self.phases.values():
+            row = stats.as_dict()
+            peak = f"{row['peak_memory_mb']:.2f}" if row["peak_memory_mb"] is not None else "-"
+            lines.append(
+                f"{row['phase']:<20}{row['calls']:>7}{row['wall_s']:>10.3f}{row['cpu_s']:>10.3f}{row['items']:>10}{peak:>10}"
+            )
+        lines.append(f"{'total':<20}{'':>7}{self.wall_time:>10.3f}")
+        return "\n".join(lines)
+
+
+_current_profile: ContextVar[RunProfile | None] = ContextVar("current_profile", default=None)
+
+
+def current_profile() -> RunProfile | None:
+    return _current_profile.get()
+
+
+@contextmanager
+def profile_run(trace_memory: bool = False):
+    """
+    Collect phases of everything run inside into a new RunProfile and log it at the end,
+    unless a profile is already active (the enclosing run reports it then)
+    """
+    active = _current_profile.get()
+    if active is not None:
+        yield active
+        return
+
+    profile = RunProfile(trace_memory=trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+        logger.info(f"Run profile: {profile.as_dict()}")
+
+
+@contextmanager
+def phase(name: str):
+    """Time a phase of the active run profile (a detached PhaseStats when no run is being profiled)"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield PhaseStats(name)
+        return
+    with profile.phase(name) as stats:
+        yield stats
@@ -0,0 +1,62 @@
+"""
+Bounded quarantine of report payloads that cannot be decrypted, so they never cost crypto time twice
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class PayloadQuarantine:
+    """
+    Content hashes of rejected payloads (base64 as received) with the reason and how often they were seen.
+    Rejections that depend on more than the payload (a decryption failure depends on the device key) are kept
+    under a `scope`, and only skip the payload within that scope.
+    The least recently seen payloads are dropped beyond `max_size` entries.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, list] = OrderedDict()  # hash -> [reason, times seen]
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    @staticmethod
+    def _hash(payload: str, scope: str = "") -> bytes:
+        digest = hashlib.blake2b(payload.encode("ascii", "replace"), digest_size=16)
+        if scope:
+            digest.update(b"\0" + scope.encode())
+        return digest.digest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def check(self, payload: str, scope: str = "") -> str | None:
+        """Reason `payload` was quarantined for (within `scope`), None if it is not quarantined"""
+        if self.max_size <= 0:
+            return None
+        key = self._hash(payload, scope)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry[1] += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def add(self, payload: str, reason: str, scope: str = ""):
+        if self.max_size <= 0:
+            return
+        key = self._hash(payload, scope)
+        with self._lock:
+            self._entries[key] = [reason, 1]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            reasons: dict[str, int] = {}
+            for reason, _ in self._entries.values():
+                reasons[reason] = reasons.get(reason, 0) + 1
+            return {"size": len(self._entries), "evicted": self.evicted, "reasons": reasons}
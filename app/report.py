@@ -1,40 +1,87 @@
-import datetime
+import binascii
+import hashlib
 import logging
 import struct
 import warnings
+from array import array
+from typing import TYPE_CHECKING, Callable, Literal
 from base64 import b64decode
 from app.apple_fetch import AppleLocation
-from app.cryptic import bytes_to_int, get_result
+from app.cryptic import bytes_to_int, get_result, validate_payload
 from app.dtos import BeamerDevice, EnrichedReport, Report
-from app.date import EPOCH_DIFF
+from app.date import EPOCH_DIFF, unix_epoch
+from app.log import RATE_LIMITED
+from app.metrics import metrics
+from app.quarantine import PayloadQuarantine
+from app.settings import settings
+from app.track import DeviceTrack
+
+if TYPE_CHECKING:
+    from app.key_index import KeyIndex
+    from app.store import ReportStore
 
 logger = logging.getLogger(__name__)
 
+ReportMode = Literal["latest", "history"]
+
+# Kept for the lifetime of the process (collector daemon, warm Lambda containers)
+payload_quarantine = PayloadQuarantine(settings.PAYLOAD_QUARANTINE_SIZE)
+
 
 class StatsAggregator:
+    """
+    Per-device location counts and timestamp ranges in parallel arrays (one slot per device),
+    summarised into a single log record with distributions instead of one record per device
+    """
+
     def __init__(self):
-        self._no_locations_per_device = {}
-        self._min_timestamp_per_device = {}
-        self._max_timestamp_per_device = {}
+        self._slots: dict[str, int] = {}
+        self._counts = array("I")
+        self._min_timestamps = array("q")
+        self._max_timestamps = array("q")
 
     def add_report(self, beam_name: str, timestamp: int):
-        self._no_locations_per_device[beam_name] = self._no_locations_per_device.get(beam_name, 0) + 1
-        self._min_timestamp_per_device[beam_name] = min(self._min_timestamp_per_device.get(beam_name, timestamp), timestamp)
-        self._max_timestamp_per_device[beam_name] = max(self._max_timestamp_per_device.get(beam_name, 0), timestamp)
-
-    def get_stats(self) -> list[dict]:
-        records = []
-
-        for beam in sorted(self._no_locations_per_device.keys()):
-            d = {
-                "beam_name": beam,
-                "no_locations": self._no_locations_per_device[beam],
-                "min_timestamp": datetime.datetime.fromtimestamp(self._min_timestamp_per_device[beam]),
-                "max_timestamp": datetime.datetime.fromtimestamp(self._max_timestamp_per_device[beam])
-            }
-            records.append(d)
+        slot = self._slots.get(beam_name)
+        if slot is None:
+            slot = self._slots[beam_name] = len(self._counts)
+            self._counts.append(0)
+            self._min_timestamps.append(timestamp)
+            self._max_timestamps.append(timestamp)
+        self._counts[slot] += 1
+        if timestamp < self._min_timestamps[slot]:
+            self._min_timestamps[slot] = timestamp
+        if timestamp > self._max_timestamps[slot]:
+            self._max_timestamps[slot] = timestamp
+
+    @property
+    def device_names(self) -> set[str]:
+        return set(self._slots)
+
+    def summary(self, device_count: int, now: int = None) -> dict:
+        now = now if now is not None else unix_epoch()
+        locations = sum(self._counts)
+        return {
+            "devices": device_count,
+            "devices_with_locations": len(self._counts),
+            "devices_without_locations": max(device_count - len(self._counts), 0),
+            "locations": locations,
+            "locations_per_device": _distribution(self._counts),
+            "newest_location_age_s": _distribution([now - timestamp for timestamp in self._max_timestamps]),
+            "oldest_location": min(self._min_timestamps) if locations else None,
+            "newest_location": max(self._max_timestamps) if locations else None,
+        }
+
 
-        return records
+def _distribution(values) -> dict | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "min": ordered[0],
+        "p50": ordered[len(ordered) // 2],
+        "p90": ordered[min(int(len(ordered) * 0.9), len(ordered) - 1)],
+        "max": ordered[-1],
+    }
 
 
 def decode_tag(data):
@@ -45,50 +92,167 @@ def decode_tag(data):
     return {"lat": latitude, "lon": longitude, "conf": confidence, "status": status}
 
 
-def create_reports(locations: list[AppleLocation], devices: list[BeamerDevice]):
-    """Decrypt payload and create a report"""
-    device_mapping = {device.public_hash_base64: device for device in devices}
-    locations_per_device = {device.id: 0 for device in devices}
+def decrypt_report(
+        location: AppleLocation, device: BeamerDevice, quarantine: PayloadQuarantine | None = payload_quarantine
+) -> EnrichedReport | None:
+    """
+    Decrypt a single location of `device`, None if the payload cannot be decoded. Payloads are checked
+    structurally before any crypto, rejected payloads go into `quarantine` and are skipped when seen again.
+    Decryption failures are quarantined per device key: a corrected key gets to decrypt the payload again.
+    """
+    key_scope = _key_fingerprint(device)
+    if quarantine is not None and (
+            quarantine.check(location.payload) is not None
+            or quarantine.check(location.payload, scope=key_scope) is not None
+    ):
+        metrics.increment("report_payloads_rejected_total", reason="quarantined")
+        return None
+
+    try:
+        data = b64decode(location.payload)
+    except binascii.Error:
+        data = b""
+    problem = validate_payload(data)
+    if problem is not None:
+        _reject(location, device, quarantine, problem, f"{len(data)} byte payload")
+        return None
+
+    timestamp = bytes_to_int(data[0:4]) + EPOCH_DIFF
+    try:
+        report = Report(**decode_tag(get_result(device.private_key_numeric, data)))
+    except Exception as e:
+        _reject(location, device, quarantine, "decrypt", repr(e), scope=key_scope)
+        return None
+
+    return EnrichedReport(
+        **report.model_dump(),
+        device_id=device.id,
+        timestamp=timestamp,
+        date_published=location.date_published if location.date_published is not None else timestamp,
+        description=location.description,
+    )
+
+
+def _key_fingerprint(device: BeamerDevice) -> str:
+    return hashlib.blake2b(device.private_key_bytes, digest_size=8).hexdigest()
+
 
-    stats_aggregator = StatsAggregator()
+def _reject(
+        location: AppleLocation,
+        device: BeamerDevice,
+        quarantine: PayloadQuarantine | None,
+        reason: str,
+        detail: str,
+        scope: str = "",
+):
+    metrics.increment("report_payloads_rejected_total", reason=reason)
+    if quarantine is not None:
+        quarantine.add(location.payload, reason, scope=scope)
+    # Rate-limited per call site (see app/log.py), the traceback only at debug level
+    logger.warning(
+        f"Rejected payload of device {device.name} ({reason}): {detail}",
+        exc_info=logger.isEnabledFor(logging.DEBUG), extra=RATE_LIMITED,
+    )
+
+
+def key_index_resolver(key_index: "KeyIndex", devices: list[BeamerDevice]) -> Callable[[str], BeamerDevice | None]:
+    """
+    Location id -> device via the key index, preferring the given device objects. Devices missing from the index
+    (registered after it was built) are resolved by deriving their keys, once. Build it once per run: the id map
+    covers all `devices`.
+    """
+    devices_by_id = {device.id: device for device in devices}
+    unindexed: dict[str, BeamerDevice] | None = None
+
+    def resolve(location_id: str) -> BeamerDevice | None:
+        nonlocal unindexed
+        device_key = key_index.lookup(location_id)
+        if device_key is not None:
+            return devices_by_id.get(device_key.id) or device_key.to_device()
+        if unindexed is None:
+            unindexed = {
+                device.public_hash_base64: device
+                for device in devices
+                if key_index.lookup(device.public_hash_base64) is None
+            }
+            if unindexed:
+                logger.warning(f"{len(unindexed)} devices are missing from key index {key_index.path}, rebuild it")
+        return unindexed.get(location_id)
+
+    return resolve
+
+
+def create_reports(
+        locations: list[AppleLocation],
+        devices: list[BeamerDevice],
+        store: "ReportStore" = None,
+        mode: ReportMode = "latest",
+        key_index: "KeyIndex" = None,
+        stats_aggregator: StatsAggregator = None,
+        resolve_device: Callable[[str], BeamerDevice | None] = None,
+):
+    """
+    Decrypt payloads and set the newest report of each device. In "history" mode every report is also kept
+    in the device's track. Every decrypted report is appended to `store`, if given.
+    With a `key_index` location ids are resolved from the index instead of deriving the public key of every device,
+    the returned mapping then only holds the devices with locations (`devices` may even be empty).
+    Callers decrypting a run in several calls pass the run's `resolve_device` (see `key_index_resolver`) instead.
+    Statistics go to `stats_aggregator` when given (the caller logs them, e.g. once for several calls).
+    """
+    if key_index is not None and resolve_device is None:
+        resolve_device = key_index_resolver(key_index, devices)
+    if resolve_device is None:
+        device_mapping = {device.public_hash_base64: device for device in devices}
+    else:
+        device_mapping = {}
+
+    log_statistics = stats_aggregator is None
+    stats_aggregator = stats_aggregator if stats_aggregator is not None else StatsAggregator()
+    decrypted_reports = []
 
     for location in locations:
-        data = b64decode(location.payload)
-        timestamp = bytes_to_int(data[0:4]) + EPOCH_DIFF
         device: BeamerDevice = device_mapping.get(location.id)
+        if device is None and resolve_device is not None:
+            device = resolve_device(location.id)
+            if device is not None:
+                device_mapping[location.id] = device
 
         if not device:
-            logger.warning("Device not found for location", extra={"location": location})
+            logger.warning(f"Device not found for location {location.id}", extra=RATE_LIMITED)
             continue
-        try:
-            report = decode_tag(get_result(device.private_key_numeric, data))
-            report = Report(**report)
-            stats_aggregator.add_report(device.name, timestamp)
-        except Exception as e:
-            logger.exception(f"Failed to decode tag for device {device.name}", extra={
-                "device": device,
-                "error": str(e),
-                "icloud_payload": data,
-            })
+        enriched_report = decrypt_report(location, device)
+        if enriched_report is None:
             continue
+        stats_aggregator.add_report(device.name, enriched_report.timestamp)
+        if device.report is None or enriched_report.timestamp >= device.report.timestamp:
+            device.report = enriched_report
+        if mode == "history":
+            if device.track is None:
+                device.track = DeviceTrack()
+            device.track.add(enriched_report)
+        if store is not None:
+            decrypted_reports.append(enriched_report)
 
-        enriched_report = EnrichedReport(
-            **report.model_dump(),
-            device_id=device.id,
-            timestamp=timestamp,
-            date_published=location.date_published if location.date_published is not None else timestamp,
-            description=location.description,
-        )
-        device.report = enriched_report
-
-    devices_with_locations = set()
-    for device_stats in stats_aggregator.get_stats():
-        logger.info(device_stats)
-        devices_with_locations.add(device_stats["beam_name"])
+    if store is not None:
+        store.append(decrypted_reports)
+    if mode == "history":
+        for device in device_mapping.values():
+            if device.track is not None:
+                device.track.sort()
 
-    devices_without_locations = {device.name for device in devices if device.name not in devices_with_locations}
+    if log_statistics:
+        log_report_statistics(stats_aggregator, devices, max(len(devices), len(device_mapping)))
+    return device_mapping
 
-    logger.info(f"Devices with locations: {','.join(devices_with_locations)}")
-    logger.info(f"Devices without locations: {','.join(devices_without_locations)}")
 
-    return device_mapping
+def log_report_statistics(stats_aggregator: StatsAggregator, devices: list[BeamerDevice], device_count: int):
+    logger.info(f"Report statistics: {stats_aggregator.summary(device_count)}")
+    if len(payload_quarantine):
+        logger.info(f"Payload quarantine: {payload_quarantine.stats()}")
+    if logger.isEnabledFor(logging.DEBUG):
+        devices_with_locations = stats_aggregator.device_names
+        logger.debug(f"Devices with locations: {','.join(sorted(devices_with_locations))}")
+        logger.debug(
+            f"Devices without locations: "
+            f"{','.join(sorted(device.name for device in devices if device.name not in devices_with_locations))}"
+        )
@@ -0,0 +1,131 @@
+"""
+Cache of acsnservice responses for closed time windows: once a window lies far enough in the past Apple's answer
+for it no longer changes, so overlapping runs, backfills and CLI debugging only have to ask for the open window.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Response bodies keyed by the device ids and window of the request, in an in-process LRU of `max_size`
+    entries and, when `directory` is set, in one file per response shared by all processes on the host.
+    Only windows that ended `settle_seconds` ago are cached; disk entries expire after `max_age` seconds.
+    """
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            max_size: int = 10000,
+            directory: str = "",
+            settle_seconds: int = 600,
+            max_age: int = 7 * 24 * 3600,
+    ):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.max_age = max_age
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned = False
+
+    @staticmethod
+    def _key(payload: dict) -> str:
+        ids = ",".join(sorted(payload["ids"]))
+        return hashlib.blake2b(
+            f"{ids}|{payload['startDate']}|{payload['endDate']}".encode(), digest_size=16
+        ).hexdigest()
+
+    def is_closed(self, payload: dict, now: float = None) -> bool:
+        """`payload` dates are in milliseconds, see `build_acsnservice_payload`"""
+        return payload["endDate"] / 1000 <= (now or time.time()) - self.settle_seconds
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, payload: dict) -> str | None:
+        if not self.enabled or not self.is_closed(payload):
+            return None
+        key = self._key(payload)
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+        if text is not None:
+            metrics.increment("apple_response_cache_total", result="memory")
+            return text
+
+        if self.directory:
+            try:
+                path = self._path(key)
+                if os.path.getmtime(path) >= time.time() - self.max_age:
+                    with open(path) as f:
+                        text = f.read()
+            except OSError:
+                text = None
+            if text is not None:
+                self._remember(key, text)
+                metrics.increment("apple_response_cache_total", result="disk")
+                return text
+
+        metrics.increment("apple_response_cache_total", result="miss")
+        return None
+
+    def put(self, payload: dict, text: str):
+        if not self.enabled or not self.is_closed(payload):
+            return
+        key = self._key(payload)
+        self._remember(key, text)
+        if self.directory:
+            self._write(key, text)
+
+    def _remember(self, key: str, text: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _write(self, key: str, text: str):
+        try:
+            if not self._pruned:
+                os.makedirs(self.directory, exist_ok=True)
+                self.prune()
+            # Written under a temporary name, so concurrent readers never see a partial response
+            temporary = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "w") as f:
+                f.write(text)
+            os.replace(temporary, self._path(key))
+        except OSError as e:
+            logger.warning(f"Could not write response cache entry to {self.directory}: {e}")
+
+    def prune(self):
+        """Remove disk entries older than `max_age`"""
+        self._pruned = True
+        oldest = time.time() - self.max_age
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < oldest:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logger.info(f"Removed {removed} expired responses from {self.directory}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,130 @@
+"""
+Adaptive per-device polling: active trackers are polled often, dormant ones are backed off exponentially
+"""
+import heapq
+import json
+import logging
+import os
+from collections import defaultdict
+
+from pydantic import BaseModel
+
+from app.date import unix_epoch
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Lookbacks are rounded up to these tiers (minutes), so devices with similar gaps share Apple requests
+LOOKBACK_TIERS = (15, 60, 6 * 60, 24 * 60, 7 * 24 * 60)
+
+EWMA_ALPHA = 0.3
+
+
+class DeviceStats(BaseModel):
+    device_id: str
+    last_seen: int | None = None  # newest published report
+    last_polled: int | None = None
+    report_interval: float | None = None  # smoothed seconds between reports
+    empty_streak: int = 0
+    next_poll: int = 0
+
+
+class PollingScheduler:
+    def __init__(
+            self,
+            state_path: str = None,
+            min_interval: int = settings.SCHEDULER_MIN_INTERVAL_SECONDS,
+            max_interval: int = settings.SCHEDULER_MAX_INTERVAL_SECONDS,
+            max_devices_per_run: int = settings.SCHEDULER_MAX_DEVICES_PER_RUN,
+    ):
+        self.state_path = state_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_devices_per_run = max_devices_per_run
+        self.stats: dict[str, DeviceStats] = {}
+        if state_path and os.path.exists(state_path):
+            self.load()
+
+    def load(self):
+        with open(self.state_path) as f:
+            self.stats = {item["device_id"]: DeviceStats(**item) for item in json.load(f)}
+        logger.info(f"Loaded polling statistics of {len(self.stats)} devices")
+
+    def save(self):
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([stats.model_dump() for stats in self.stats.values()], f)
+        os.replace(tmp_path, self.state_path)
+
+    def plan(self, device_ids: list[str], minutes_ago: int, now: int = None) -> dict[int, list[str]]:
+        """
+        Device ids due for polling, grouped by lookback in minutes (covering the gap since their last poll),
+        shortest lookbacks first and the most active devices first within a lookback.
+        Most overdue (then most recently seen) devices win when the per-run budget is exhausted.
+        """
+        now = now if now is not None else unix_epoch()
+        queue = []
+        for device_id in device_ids:
+            stats = self.stats.get(device_id)
+            if stats is None:
+                heapq.heappush(queue, (0, 0, device_id))
+            elif stats.next_poll <= now:
+                heapq.heappush(queue, (stats.next_poll, -(stats.last_seen or 0), device_id))
+
+        budget = self.max_devices_per_run or len(queue)
+        plan = defaultdict(list)
+        while queue and budget > 0:
+            _, _, device_id = heapq.heappop(queue)
+            plan[self._lookback(self.stats.get(device_id), minutes_ago, now)].append(device_id)
+            budget -= 1
+        for ids in plan.values():
+            ids.sort(key=self._activity)
+
+        logger.info(
+            f"Scheduled {sum(len(ids) for ids in plan.values())}/{len(device_ids)} devices "
+            f"({', '.join(f'{len(ids)} x {minutes}min' for minutes, ids in sorted(plan.items()))})"
+        )
+        return dict(sorted(plan.items()))
+
+    def record(self, device_id: str, report_count: int, newest_report: int | None, window: int, now: int = None):
+        """Update the statistics of a polled device and schedule its next poll"""
+        now = now if now is not None else unix_epoch()
+        stats = self.stats.setdefault(device_id, DeviceStats(device_id=device_id))
+        stats.last_polled = now
+
+        if report_count > 0:
+            observed_interval = window / report_count
+            stats.report_interval = observed_interval if stats.report_interval is None else (
+                EWMA_ALPHA * observed_interval + (1 - EWMA_ALPHA) * stats.report_interval
+            )
+            stats.last_seen = max(stats.last_seen or 0, newest_report or now)
+            stats.empty_streak = 0
+        else:
+            stats.empty_streak += 1
+
+        stats.next_poll = now + self.interval(stats)
+
+    def interval(self, stats: DeviceStats) -> int:
+        if stats.empty_streak == 0 and stats.report_interval is not None:
+            interval = stats.report_interval
+        else:
+            interval = self.min_interval * 2 ** min(stats.empty_streak, 32)
+        return int(min(max(interval, self.min_interval), self.max_interval))
+
+    def _activity(self, device_id: str) -> tuple:
+        """Sort key: most recently seen, then most frequently reporting devices first"""
+        stats = self.stats.get(device_id)
+        if stats is None:
+            return 0, float("inf")
+        return -(stats.last_seen or 0), stats.report_interval if stats.report_interval is not None else float("inf")
+
+    @staticmethod
+    def _lookback(stats: DeviceStats | None, minutes_ago: int, now: int) -> int:
+        if stats is None or stats.last_polled is None:
+            return minutes_ago
+        minutes = -(-(now - stats.last_polled) // 60)
+        if minutes <= minutes_ago:
+            return minutes_ago
+        return next((tier for tier in LOOKBACK_TIERS if tier >= minutes), LOOKBACK_TIERS[-1])
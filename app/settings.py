@@ -1,7 +1,23 @@
+import json
+import logging
+
 from pydantic import BaseModel
 from pydantic.v1 import BaseSettings
 import os
 
+logger = logging.getLogger(__name__)
+
+# Settings a tuned profile (`manage.py tune`) may set, environment variables still take precedence.
+# DEVICE_BATCH_SIZE is not one of them: it is also the page size of the Lambda runs, which fetch a single page.
+TUNABLE_SETTINGS = (
+    "FETCH_CONCURRENCY",
+    "FETCH_DEVICE_BATCH_SIZE",
+    "FETCH_TIME_CHUNK_SECONDS",
+    "FETCH_SHORT_RANGE_SECONDS",
+    "UPLOAD_BATCH_SIZE",
+    "UPLOAD_PAUSE_SECONDS",
+)
+
 
 class Headers(BaseModel):
     x_api_key: str
@@ -22,12 +38,73 @@ class Settings(BaseSettings):
     DEVICE_BATCH_SIZE: int = 2500  # 2135 in total
     CREDENTIALS_API_KEY: str
 
+    # Throughput knobs, measured by `manage.py tune`
+    TUNED_PROFILE_PATH: str = 'tuned_profile.json'  # loaded when the file exists
+    FETCH_CONCURRENCY: int = 20  # acsnservice requests in flight
+    FETCH_DEVICE_BATCH_SIZE: int = 1  # device ids per acsnservice request
+    FETCH_TIME_CHUNK_SECONDS: int = 24 * 3600  # time window per acsnservice request for long lookbacks
+    FETCH_SHORT_RANGE_SECONDS: int = 20 * 60  # lookbacks below this are not split by time
+    UPLOAD_BATCH_SIZE: int = 100  # reports per Haystacks API request
+    UPLOAD_PAUSE_SECONDS: float = 0.5  # between Haystacks API requests
+    UPLOAD_EARLY: bool = True  # upload batches while older windows are still fetched ("latest" report mode)
+    # Hedged acsnservice requests: resend requests slower than this percentile of recent latencies
+    FETCH_HEDGE_ENABLED: bool = False
+    FETCH_HEDGE_PERCENTILE: float = 0.95
+    FETCH_HEDGE_MAX_RATIO: float = 0.05  # hedges per request at most
+    FETCH_HEDGE_MIN_DELAY_SECONDS: float = 0.05
+
+    # Epoch-aligned lookback windows, so responses for closed windows can be cached (0 disables alignment and cache)
+    FETCH_BUCKET_SECONDS: int = 0
+    FETCH_RESPONSE_CACHE_SIZE: int = 10000  # responses kept in memory
+    FETCH_RESPONSE_CACHE_DIR: str = ''  # e.g. /tmp/acsnservice-cache, shared by all processes on the host
+    FETCH_RESPONSE_CACHE_SETTLE_SECONDS: int = 600  # windows that ended longer ago are closed
+    FETCH_RESPONSE_CACHE_MAX_AGE_SECONDS: int = 7 * 24 * 3600  # disk entries
+
+    LOG_FORMAT: str = "text"  # "json" for JSON lines (CloudWatch)
+    LOG_RATE_LIMIT_PER_MINUTE: int = 10  # hot-path warnings per call site and minute, 0 disables the limit
+
     SENTRY_ENABLED: bool = True
     SENTRY_ENV: str = "local"
     SENTRY_DSN: str = ""
     MAX_RETRIES_ON_APPLE_AUTH_EXPIRED: int = 17
 
+    ACSNSERVICE_URL: str = "https://gateway.icloud.com/acsnservice/fetch"
+    CREDENTIALS_API_URL: str = "https://ghfbaqjy00.execute-api.eu-central-1.amazonaws.com/prod/credentials"
+
+    SCHEDULER_STATE_PATH: str = ''  # Enables adaptive per-device polling when set
+    SCHEDULER_MIN_INTERVAL_SECONDS: int = 300
+    SCHEDULER_MAX_INTERVAL_SECONDS: int = 24 * 3600
+    SCHEDULER_MAX_DEVICES_PER_RUN: int = 0  # 0 = unlimited
+
+    # Simplification of uploaded tracks ("history" report mode), see app/trajectory.py. Tracks stay local unless
+    # REPORT_TRACK_UPLOAD is set: `reports` is not part of the known Haystacks API contract.
+    REPORT_TRACK_UPLOAD: bool = False
+    REPORT_TRACK_INTERVAL_SECONDS: int = 5 * 60  # at most one point per interval
+    REPORT_TRACK_TOLERANCE_METERS: float = 25
+    REPORT_TRACK_STATIONARY_METERS: float = 15
+    REPORT_TRACK_MAX_POINTS: int = 288  # 0 uploads the newest report only
+    KEY_INDEX_PATH: str = ''  # Device key index (manage.py build-key-index) used to resolve location ids
+    REPORT_STORE_PATH: str = ''  # SQLite file every decrypted report is appended to (CLI and collector)
+    PAYLOAD_QUARANTINE_SIZE: int = 10000  # payloads that failed to decrypt, skipped when seen again (0 disables)
+
+    # Fetch runs triggered by credential updates (put_credentials with schedule_data_fetching)
+    FETCH_RUN_COALESCE_SECONDS: int = 10 * 60  # triggers this soon after a queued run share it
+    FETCH_RUN_TIMEOUT_SECONDS: int = 15 * 60  # a run not finished by then no longer holds back new ones
+
     DEFAULT_CLIENT_MANAGING_CREDENTIALS: str = 'space-invader-mac'
+    CREDENTIALS_TTL_SECONDS: int = 60  # Apple credentials expire roughly a minute after generation
+    CREDENTIALS_REFRESH_AHEAD_SECONDS: int = 10
+    CREDENTIALS_REQUEST_TIMEOUT: int = 10
+    CREDENTIALS_CLIENT_IDS: str = ''  # Comma-separated accounts to spread Apple requests over
+    CREDENTIALS_ACCOUNT_MAX_REQUESTS_PER_SECOND: float = 0  # 0 = unlimited
+    CREDENTIALS_ACCOUNT_MAX_CONSECUTIVE_401: int = 3
+    CREDENTIALS_ACCOUNT_COOLDOWN_SECONDS: int = 60
+    # Fleet-wide circuit breaker on credential expiry (state in the credentials table for Lambda workers)
+    CREDENTIALS_BREAKER_ENABLED: bool = True
+    CREDENTIALS_BREAKER_POLL_SECONDS: float = 5
+    CREDENTIALS_BREAKER_MAX_WAIT_SECONDS: float = 60  # Lambda runs, a small part of their 900 s timeout
+    CREDENTIALS_BREAKER_LONG_RUN_MAX_WAIT_SECONDS: float = 600  # collector, backfill and other CLI runs
+    CREDENTIALS_BREAKER_PROBE_TIMEOUT_SECONDS: float = 30
 
     @property
     def get_haystacks_endpoint(self) -> str:
@@ -37,6 +114,11 @@ class Settings(BaseSettings):
     def post_haystacks_endpoint(self) -> str:
         return f'{self.BASE_URL}/{self._get_haystack_endpoint_without_prefix()}'
 
+    @property
+    def credentials_client_ids(self) -> list[str]:
+        client_ids = [client_id.strip() for client_id in self.CREDENTIALS_CLIENT_IDS.split(',') if client_id.strip()]
+        return client_ids or [self.DEFAULT_CLIENT_MANAGING_CREDENTIALS]
+
     @property
     def headers(self) -> dict:
         return Headers(x_api_key=self.API_KEY).model_dump()
@@ -51,5 +133,25 @@ class Settings(BaseSettings):
         env_file = ".env"
         case_sensitive = True
 
+        @classmethod
+        def customise_sources(cls, init_settings, env_settings, file_secret_settings):
+            return init_settings, env_settings, _tuned_profile_source(env_settings), file_secret_settings
+
+
+def _tuned_profile_source(env_settings):
+    def tuned_profile(settings: BaseSettings) -> dict:
+        path = env_settings(settings).get("TUNED_PROFILE_PATH", Settings.__fields__["TUNED_PROFILE_PATH"].default)
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                values = json.load(f).get("settings", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring tuned profile {path}: {e}")
+            return {}
+        return {name: value for name, value in values.items() if name in TUNABLE_SETTINGS}
+
+    return tuned_profile
+
 
 settings = Settings()
@@ -2,26 +2,37 @@ import uuid
 import boto3
 import json
 
+from app.fetch_runs import FetchRun
+
 sqs = boto3.client('sqs')
 
 
 def schedule_device_location_metadata_enrichment(
         queue_url: str,
         num_batches: int,
-        batch_size: int
+        batch_size: int,
+        run: FetchRun = None,
 ) -> None:
+    """
+    One message per page. Messages of a run have deterministic group and deduplication ids, so FIFO deduplication
+    drops a page enqueued twice for the same run, and pages of consecutive runs never run concurrently.
+    """
+    run_id = run.run_id if run is not None else str(uuid.uuid4())
     for page in range(num_batches):
         message = {
             "page": page,
             "limit": batch_size,
             "minutes_ago": 15,
         }
-        message_group_id = f'page-processing-group_{str(uuid.uuid4())}'
+        if run is not None:
+            message["run_id"] = run.run_id
+            message["triggered_at"] = run.queued_at
 
         response = sqs.send_message(
             QueueUrl=queue_url,
             MessageBody=json.dumps(message),
-            MessageGroupId=message_group_id,
+            MessageGroupId=f'page-processing-group_{page}',
+            MessageDeduplicationId=f'fetch-run_{run_id}_page_{page}',
         )
         print(f"Sent message for page {page}, MessageId: {response['MessageId']}")
 
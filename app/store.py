@@ -0,0 +1,166 @@
+"""
+Local time-series store of decrypted reports (SQLite), queryable by device, time range and bounding box
+"""
+import logging
+import sqlite3
+import threading
+from typing import Iterable, Iterator
+
+from app.dtos import EnrichedReport
+from app.helpers import chunks
+
+logger = logging.getLogger(__name__)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 8  # ~38m x 19m cells
+INSERT_BATCH_SIZE = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    device_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    conf REAL NOT NULL,
+    status INTEGER NOT NULL,
+    date_published INTEGER,
+    geohash TEXT NOT NULL,
+    PRIMARY KEY (device_id, timestamp, lat, lon)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS reports_timestamp ON reports (timestamp);
+CREATE INDEX IF NOT EXISTS reports_geohash ON reports (geohash, timestamp);
+"""
+
+COLUMNS = ("device_id", "timestamp", "lat", "lon", "conf", "status", "date_published")
+
+
+def geohash_encode(lat: float, lon: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, value, even = 0, 0, True
+    while len(chars) < precision:
+        value_range, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+
+def _geohash_cell_size(precision: int) -> tuple[float, float]:
+    """(height, width) in degrees of a geohash cell"""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def geohash_cover(
+        min_lat: float, min_lon: float, max_lat: float, max_lon: float, max_cells: int = 64
+) -> list[str]:
+    """The geohash prefixes of the finest precision whose cells covering the bounding box are at most `max_cells`"""
+    cover = [""]
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = _geohash_cell_size(precision)
+        rows = int(max_lat // height) - int(min_lat // height) + 1
+        columns = int(max_lon // width) - int(min_lon // width) + 1
+        if rows * columns > max_cells:
+            break
+        # Sampling every cell size (plus the far edges) hits every cell the box overlaps
+        lats = [min_lat + row * height for row in range(rows)] + [max_lat]
+        lons = [min_lon + column * width for column in range(columns)] + [max_lon]
+        cells = {geohash_encode(lat, lon, precision) for lat in lats for lon in lons}
+        cover = sorted(cells)
+    return cover
+
+
+class ReportStore:
+    """
+    Every decrypted report, keyed by (device_id, timestamp, lat, lon) so re-fetched locations are stored once.
+    Safe to share between threads: each thread gets its own connection and writes are serialized.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connection.executescript(SCHEMA)
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def append(self, reports: Iterable[EnrichedReport]) -> int:
+        """Insert reports in batches, returns the number of new rows"""
+        rows = [
+            (
+                report.device_id, report.timestamp, report.lat, report.lon, report.conf, report.status,
+                report.date_published, geohash_encode(report.lat, report.lon),
+            )
+            for report in reports
+        ]
+        inserted = 0
+        with self._lock:
+            for batch in chunks(rows, INSERT_BATCH_SIZE):
+                with self._connection:
+                    cursor = self._connection.executemany(
+                        "INSERT OR IGNORE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch
+                    )
+                    inserted += cursor.rowcount
+        logger.info(f"Stored {inserted}/{len(rows)} new reports in {self.path}")
+        return inserted
+
+    def query(
+            self,
+            start_date: int = None,
+            end_date: int = None,
+            device_ids: list[str] = None,
+            bbox: tuple[float, float, float, float] = None,
+            limit: int = None,
+    ) -> Iterator[dict]:
+        """
+        Reports ordered by device and timestamp. `bbox` is (min_lat, min_lon, max_lat, max_lon), pre-filtered on
+        the covering geohash prefixes and then checked exactly.
+        """
+        conditions, parameters = [], []
+        if start_date is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(start_date)
+        if end_date is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(end_date)
+        if device_ids:
+            conditions.append(f"device_id IN ({', '.join('?' * len(device_ids))})")
+            parameters.extend(device_ids)
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            prefixes = [prefix for prefix in geohash_cover(*bbox) if prefix]
+            if prefixes:
+                conditions.append(f"({' OR '.join('(geohash >= ? AND geohash < ?)' for _ in prefixes)})")
+                for prefix in prefixes:
+                    parameters.extend((prefix, prefix + "~"))
+            conditions.append("lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?")
+            parameters.extend((min_lat, max_lat, min_lon, max_lon))
+
+        sql = f"SELECT {', '.join(COLUMNS)} FROM reports"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        sql += " ORDER BY device_id, timestamp"
+        if limit:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+
+        for row in self._connection.execute(sql, parameters):
+            yield dict(zip(COLUMNS, row))
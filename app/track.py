@@ -0,0 +1,63 @@
+"""
+Compact per-device history of decrypted reports
+"""
+from array import array
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.dtos import EnrichedReport
+
+
+class DeviceTrack:
+    """
+    Reports of one device as parallel typed arrays (~30 bytes per report instead of a model instance each),
+    sorted by timestamp once all reports are added
+    """
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.date_published = array("q")
+        self.lats = array("d")
+        self.lons = array("d")
+        self.confs = array("f")
+        self.statuses = array("B")
+        self._sorted = True
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add(self, report: "EnrichedReport"):
+        if self.timestamps and report.timestamp < self.timestamps[-1]:
+            self._sorted = False
+        self.timestamps.append(report.timestamp)
+        self.date_published.append(report.date_published if report.date_published is not None else report.timestamp)
+        self.lats.append(report.lat)
+        self.lons.append(report.lon)
+        self.confs.append(report.conf)
+        self.statuses.append(report.status)
+
+    def sort(self):
+        """Order by timestamp, dropping duplicates of the same report (e.g. from overlapping fetches)"""
+        if self._sorted and len(set(self.timestamps)) == len(self.timestamps):
+            return
+        order = sorted(range(len(self)), key=self.timestamps.__getitem__)
+        keep = []
+        for i in order:
+            if keep:
+                previous = keep[-1]
+                if (self.timestamps[i], self.lats[i], self.lons[i]) == (
+                        self.timestamps[previous], self.lats[previous], self.lons[previous]):
+                    continue
+            keep.append(i)
+        for name in ("timestamps", "date_published", "lats", "lons", "confs", "statuses"):
+            values = getattr(self, name)
+            setattr(self, name, array(values.typecode, (values[i] for i in keep)))
+        self._sorted = True
+
+    def point(self, i: int) -> dict:
+        return {
+            "timestamp": self.timestamps[i],
+            "lat": self.lats[i],
+            "lon": self.lons[i],
+            "conf": self.confs[i],
+        }
@@ -0,0 +1,108 @@
+"""
+Trajectory simplification of device tracks before upload
+"""
+import math
+
+from app.track import DeviceTrack
+
+EARTH_RADIUS_METERS = 6_371_000
+
+
+def simplify(
+        track: DeviceTrack,
+        interval: int,
+        tolerance: float,
+        stationary_distance: float,
+        max_points: int,
+) -> list[int]:
+    """
+    Indices (oldest first) of the points of a sorted track worth uploading:
+    1. the most confident report per `interval` seconds bucket,
+    2. without points within `stationary_distance` metres of the previous kept point (a device standing still),
+    3. simplified with Douglas-Peucker at `tolerance` metres, deviations weighted by relative confidence,
+    4. capped to the `max_points` most recent points.
+    The newest report is always kept.
+    """
+    if len(track) == 0 or max_points <= 0:
+        return []
+
+    indices = _bucket(track, interval)
+    indices = _drop_stationary(track, indices, stationary_distance)
+    if tolerance > 0 and len(indices) > 2:
+        indices = _douglas_peucker(track, indices, tolerance)
+    return indices[-max_points:]
+
+
+def _bucket(track: DeviceTrack, interval: int) -> list[int]:
+    if interval <= 0:
+        return list(range(len(track)))
+    newest = len(track) - 1
+    indices = []
+    for i in range(len(track)):
+        if indices and track.timestamps[i] // interval == track.timestamps[indices[-1]] // interval:
+            # The newest report always survives, elsewhere the most confident one of the bucket does
+            if indices[-1] != newest and (i == newest or track.confs[i] > track.confs[indices[-1]]):
+                indices[-1] = i
+            continue
+        indices.append(i)
+    return indices
+
+
+def _drop_stationary(track: DeviceTrack, indices: list[int], stationary_distance: float) -> list[int]:
+    if stationary_distance <= 0 or len(indices) < 3:
+        return indices
+    kept = [indices[0]]
+    for i in indices[1:-1]:
+        if _distance(track, kept[-1], i) >= stationary_distance:
+            kept.append(i)
+    kept.append(indices[-1])
+    return kept
+
+
+def _douglas_peucker(track: DeviceTrack, indices: list[int], tolerance: float) -> list[int]:
+    """Iterative Douglas-Peucker over a local equirectangular projection (metres)"""
+    max_conf = max(track.confs[i] for i in indices) or 1
+    origin_lat = math.radians(track.lats[indices[0]])
+    scale_x = EARTH_RADIUS_METERS * math.cos(origin_lat)
+    points = [
+        (
+            math.radians(track.lons[i]) * scale_x,
+            math.radians(track.lats[i]) * EARTH_RADIUS_METERS,
+            track.confs[i] / max_conf,
+        )
+        for i in indices
+    ]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        worst, worst_distance = None, tolerance
+        for k in range(first + 1, last):
+            # Low-confidence outliers have to deviate further to be kept
+            distance = _segment_distance(points[k], points[first], points[last]) * points[k][2]
+            if distance > worst_distance:
+                worst, worst_distance = k, distance
+        if worst is not None:
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return [i for i, kept in zip(indices, keep) if kept]
+
+
+def _segment_distance(point: tuple, start: tuple, end: tuple) -> float:
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+    t = max(0.0, min(1.0, ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length_squared))
+    return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+
+
+def _distance(track: DeviceTrack, i: int, j: int) -> float:
+    """Equirectangular approximation in metres, accurate enough at track point distances"""
+    lat_i, lat_j = math.radians(track.lats[i]), math.radians(track.lats[j])
+    x = math.radians(track.lons[j] - track.lons[i]) * math.cos((lat_i + lat_j) / 2)
+    y = lat_j - lat_i
+    return math.hypot(x, y) * EARTH_RADIUS_METERS
@@ -0,0 +1,335 @@
+"""
+Resumable historical backfill: the device x time space is split into work units (a batch of devices over one day)
+which are fetched in parallel, checkpointed once their reports are written, and skipped when the backfill is resumed.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+
+from app.apple_fetch import (
+    CredentialsExpired, acsnservice_client, generate_request_payloads, merge_successful_responses, split_chunks,
+    try_fetch_payloads,
+)
+from app.credentials.base import CredentialsService
+from app.credentials.pool import as_credentials_pool
+from app.device_service import fetch_device_registry, resolve_trackers
+from app.dtos import BeamerDevice, EnrichedReport
+from app.exceptions import AppleAuthCredentialsExpired
+from app.key_index import KeyIndex
+from app.metrics import metrics
+from app.report import decrypt_report
+from app.settings import settings
+from app.store import ReportStore
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 24 * 3600
+
+
+class WorkUnit:
+    def __init__(self, start_date: int, end_date: int, devices: list[BeamerDevice]):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.devices = devices
+        self.attempts = 0
+
+    @property
+    def name(self) -> str:
+        return f"{_isoformat(self.start_date)} [{len(self.devices)} devices]"
+
+
+class BackfillState:
+    """
+    Finished units, one JSON line each, appended after the unit's reports were written.
+    Progress is tracked per device as the fetched windows of each day, so units can be re-planned when the registry
+    changes. A partial last day is only fetched from where the earlier run stopped when a later run extends the end
+    date, its reports are not written twice.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.completed: dict[tuple[str, int], int] = {}  # (device id, window start) -> window end
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring truncated line in backfill state {self.path}")
+                    continue
+                for device_id in entry["device_ids"]:
+                    self._add(device_id, entry["start_date"], entry["end_date"])
+        logger.info(f"Loaded {len(self.completed)} finished device windows from {self.path}")
+
+    def _add(self, device_id: str, start_date: int, end_date: int):
+        key = (device_id, start_date)
+        self.completed[key] = max(self.completed.get(key, start_date), end_date)
+
+    def fetched_until(self, device_id: str, start_date: int, end_date: int) -> int:
+        """End of the windows fetched back to back from `start_date` on, at most `end_date`"""
+        fetched = start_date
+        while fetched < end_date and self.completed.get((device_id, fetched), fetched) > fetched:
+            fetched = self.completed[(device_id, fetched)]
+        return min(fetched, end_date)
+
+    def mark_completed(self, unit: WorkUnit, report_count: int):
+        device_ids = [device.id for device in unit.devices]
+        entry = {
+            "start_date": unit.start_date,
+            "end_date": unit.end_date,
+            "device_ids": device_ids,
+            "reports": report_count,
+        }
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            for device_id in device_ids:
+                self._add(device_id, unit.start_date, unit.end_date)
+
+
+class ReportWriter:
+    """Appends decrypted reports as JSON lines, flushed per unit"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, unit: WorkUnit, reports: list[EnrichedReport]):
+        names = {device.id: device.name for device in unit.devices}
+        lines = "".join(
+            json.dumps({"name": names[report.device_id], **report.model_dump()}) + "\n" for report in reports
+        )
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def plan_work_units(
+        devices: list[BeamerDevice],
+        start_date: int,
+        end_date: int,
+        state: BackfillState,
+        devices_per_unit: int,
+) -> list[WorkUnit]:
+    """
+    Units of up to `devices_per_unit` devices over one day, skipping device days that are already done.
+    Partially fetched days (the last day of an earlier run) continue where they stopped.
+    """
+    units = []
+    devices = sorted(devices, key=lambda device: device.id)
+    day_start = start_date
+    while day_start < end_date:
+        day_end = min(day_start + DAY_SECONDS, end_date)
+        pending: dict[int, list[BeamerDevice]] = {}
+        for device in devices:
+            fetched_until = state.fetched_until(device.id, day_start, day_end)
+            if fetched_until < day_end:
+                pending.setdefault(fetched_until, []).append(device)
+        for unit_start, unit_devices in sorted(pending.items()):
+            units.extend(
+                WorkUnit(unit_start, day_end, batch) for batch in split_chunks(unit_devices, devices_per_unit)
+            )
+        day_start = day_end
+    return units
+
+
+class Backfill:
+    def __init__(
+            self,
+            credentials_service: CredentialsService,
+            units: list[WorkUnit],
+            state: BackfillState,
+            writer: ReportWriter,
+            workers: int = 4,
+            requests_per_chunk: int = settings.FETCH_CONCURRENCY,
+            store: ReportStore = None,
+            unit_attempts: int = 3,
+            retry_delay: float = 30,
+    ):
+        self.credentials_service = as_credentials_pool(credentials_service)
+        self.units = units
+        self.state = state
+        self.writer = writer
+        self.workers = workers
+        self.requests_per_chunk = requests_per_chunk
+        self.store = store
+        self.unit_attempts = unit_attempts
+        self.retry_delay = retry_delay
+        self.completed_units = 0
+        self.failed_units = 0
+        self.reports = 0
+        self._queue: queue.Queue[WorkUnit] = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+
+    def stop(self, *args):
+        if not self._stop.is_set():
+            logger.info("Shutdown requested - finishing the units in progress")
+        self._stop.set()
+
+    def run(self) -> bool:
+        """Process all units, True if every unit finished"""
+        for unit in self.units:
+            self._queue.put(unit)
+
+        threads = [
+            threading.Thread(target=self._worker, name=f"backfill-{i}", daemon=True)
+            for i in range(min(self.workers, len(self.units)))
+        ]
+        for thread in threads:
+            thread.start()
+        # Join with a timeout so signals are still handled by the main thread
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+
+        logger.info(
+            f"Backfill finished {self.completed_units}/{len(self.units)} units ({self.failed_units} failed) "
+            f"with {self.reports} reports in {time.monotonic() - self._started_at:.0f}s"
+        )
+        return self.completed_units == len(self.units)
+
+    def _worker(self):
+        # Each worker runs its own event loop, with its own pooled acsnservice session
+        with asyncio.Runner() as runner:
+            try:
+                while not self._stop.is_set():
+                    try:
+                        unit = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._process(runner, unit)
+            finally:
+                runner.run(acsnservice_client.close())
+
+    def _process(self, runner: asyncio.Runner, unit: WorkUnit):
+        unit.attempts += 1
+        try:
+            reports = runner.run(self._fetch_unit(unit))
+            if reports is not None:
+                self.writer.write(unit, reports)
+                if self.store is not None:
+                    self.store.append(reports)
+                self.state.mark_completed(unit, len(reports))
+        except (CredentialsExpired, AppleAuthCredentialsExpired) as e:
+            # Every other unit would fail the same way, keep the checkpoint for a later resume
+            logger.error(f"Stopping backfill, credentials are not usable: {e}")
+            self._finish(unit, None)
+            self.stop()
+            return
+        except Exception as e:
+            logger.exception(f"Unit {unit.name} failed: {e}")
+            reports = None
+
+        if reports is None and unit.attempts < self.unit_attempts and not self._stop.is_set():
+            # Queued again behind the other units, the failure is counted only once the attempts are used up
+            metrics.increment("backfill_units_total", outcome="retried")
+            logger.info(f"Retrying unit {unit.name} (attempt {unit.attempts + 1}/{self.unit_attempts})")
+            self._stop.wait(self.retry_delay)
+            self._queue.put(unit)
+            return
+        self._finish(unit, reports)
+
+    async def _fetch_unit(self, unit: WorkUnit) -> list[EnrichedReport] | None:
+        devices_by_hash = {device.public_hash_base64: device for device in unit.devices}
+        payloads = generate_request_payloads(
+            list(devices_by_hash), unit.start_date, unit.end_date,
+            device_batch_size=settings.FETCH_DEVICE_BATCH_SIZE, time_chunk_size=None,
+            bucket_size=settings.FETCH_BUCKET_SECONDS,
+        )
+        responses = []
+        for chunk in split_chunks(payloads, self.requests_per_chunk):
+            responses.extend(await try_fetch_payloads(self.credentials_service, chunk, max_attempts_per_payload=2))
+        if len(responses) < len(payloads):
+            logger.warning(f"Unit {unit.name}: {len(payloads) - len(responses)} requests failed")
+            return None
+
+        reports = []
+        for location in merge_successful_responses(responses).results:
+            device = devices_by_hash.get(location.id)
+            report = decrypt_report(location, device) if device else None
+            if report is not None:
+                reports.append(report)
+        return reports
+
+    def _finish(self, unit: WorkUnit, reports: list[EnrichedReport] | None):
+        outcome = "failed" if reports is None else "succeeded"
+        metrics.increment("backfill_units_total", outcome=outcome)
+        with self._lock:
+            if reports is None:
+                self.failed_units += 1
+            else:
+                self.completed_units += 1
+                self.reports += len(reports)
+            done = self.completed_units + self.failed_units
+            elapsed = time.monotonic() - self._started_at
+            remaining = (len(self.units) - done) * elapsed / done
+        logger.info(
+            f"[{done}/{len(self.units)}] Unit {unit.name} {outcome}"
+            f"{f' with {len(reports)} reports' if reports is not None else ''}, ETA {remaining:.0f}s"
+        )
+
+
+def parse_date(value: str) -> int:
+    """Unix timestamp of an ISO date or date-time, UTC unless the value has an offset"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def _isoformat(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M")
+
+
+def run_backfill(
+        credentials_service: CredentialsService,
+        start_date: int,
+        end_date: int,
+        state_path: str,
+        output_path: str,
+        workers: int = 4,
+        devices_per_unit: int = 100,
+        trackers_filter: set[str] = None,
+        limit: int = settings.DEVICE_BATCH_SIZE,
+        store: ReportStore = None,
+        key_index: KeyIndex = None,
+) -> bool:
+    if trackers_filter:
+        devices = resolve_trackers(trackers_filter, key_index=key_index, limit=limit)
+    else:
+        devices = fetch_device_registry(limit)
+
+    if settings.FETCH_BUCKET_SECONDS > 0:
+        # Units then start on bucket boundaries, and reruns ask for the same (cached) windows
+        start_date -= start_date % settings.FETCH_BUCKET_SECONDS
+    state = BackfillState(state_path)
+    units = plan_work_units(devices, start_date, end_date, state, devices_per_unit)
+    logger.info(
+        f"Backfilling {len(devices)} devices from {_isoformat(start_date)} to {_isoformat(end_date)}: "
+        f"{len(units)} units pending, writing reports to {output_path}"
+    )
+    if not units:
+        return True
+
+    backfill = Backfill(credentials_service, units, state, ReportWriter(output_path), workers=workers, store=store)
+    signal.signal(signal.SIGTERM, backfill.stop)
+    signal.signal(signal.SIGINT, backfill.stop)
+    return backfill.run()
@@ -0,0 +1,206 @@
+"""
+Benchmarks of the fetch / decrypt / report hot paths, with machine-readable baselines
+"""
+import json
+import logging
+import platform
+import random
+import statistics
+import time
+from base64 import b64decode, b64encode
+from contextlib import contextmanager
+
+from app.apple_fetch import AppleHTTPResponse, AppleLocation, generate_request_payloads, merge_successful_responses
+from app.credentials.api import APICredentialsService
+from app.cryptic import bytes_to_int, get_hashed_public_key, get_public_from_private, get_result
+from app.date import unix_epoch
+from app.device_service import fetch_and_report_locations_for_devices
+from app.dtos import BeamerDevice
+from app.report import create_reports, decode_tag
+from app.settings import settings
+from app.simulator import AcsnserviceSimulator, SimulatorConfig, SimulatorThread, encrypt_location_payload
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.2  # 20% slower than the baseline median counts as a regression
+
+
+class Fixture:
+    """Synthetic fleet and encrypted locations shared by the benchmarks"""
+
+    def __init__(self, fleet_size: int, seed: int = 0):
+        self.simulator = AcsnserviceSimulator(fleet_size, SimulatorConfig(seed=seed, active_ratio=1))
+        self.rng = random.Random(seed)
+        self.private_keys = [device.private_key_bytes for device in self.simulator.devices]
+
+    def devices(self) -> list[BeamerDevice]:
+        return [BeamerDevice(**device.to_api_dict()) for device in self.simulator.devices]
+
+    def locations(self, count: int) -> list[AppleLocation]:
+        now = unix_epoch()
+        locations = []
+        for i in range(count):
+            device = self.simulator.devices[i % len(self.simulator.devices)]
+            timestamp = now - self.rng.randrange(86400)
+            payload = encrypt_location_payload(
+                device.public_key, timestamp, device.lat, device.lon, conf=100, status=0, extra_bytes=i % 2
+            )
+            locations.append(AppleLocation(
+                date_published=timestamp * 1000,
+                payload=b64encode(payload).decode("ascii"),
+                description="found",
+                id=device.public_hash_base64,
+                status_code=0,
+            ))
+        return locations
+
+
+def _run(name: str, func, items: int, repeat: int, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    result = {
+        "median_s": median,
+        "min_s": min(timings),
+        "max_s": max(timings),
+        "repeat": repeat,
+        "items": items,
+        "items_per_s": items / median if median else None,
+    }
+    logger.info(f"{name}: median {median * 1000:.1f} ms, {result['items_per_s'] or 0:,.0f} items/s")
+    return result
+
+
+@contextmanager
+def _pointed_at(simulator_thread: SimulatorThread):
+    original = settings.ACSNSERVICE_URL, settings.BASE_URL
+    settings.ACSNSERVICE_URL = f"{simulator_thread.base_url}/acsnservice/fetch"
+    settings.BASE_URL = simulator_thread.base_url
+    try:
+        yield
+    finally:
+        settings.ACSNSERVICE_URL, settings.BASE_URL = original
+
+
+def run_benchmarks(
+        fleet_size: int = 2500,
+        report_sizes: tuple[int, ...] = (10_000, 100_000),
+        lookback_days: int = 30,
+        repeat: int = 3,
+        end_to_end: bool = True,
+) -> dict:
+    fixture = Fixture(fleet_size)
+    results = {}
+
+    results["key_derivation.get_public_from_private"] = _run(
+        "key_derivation.get_public_from_private",
+        lambda: [get_public_from_private(key) for key in fixture.private_keys],
+        items=fleet_size, repeat=repeat,
+    )
+    results["key_derivation.get_hashed_public_key"] = _run(
+        "key_derivation.get_hashed_public_key",
+        lambda: [get_hashed_public_key(key) for key in fixture.private_keys],
+        items=fleet_size, repeat=repeat,
+    )
+
+    locations = fixture.locations(max(report_sizes))
+    devices_by_hash = {device.public_hash_base64: device for device in fixture.simulator.devices}
+    decrypt_input = [
+        (bytes_to_int(devices_by_hash[location.id].private_key_bytes), b64decode(location.payload))
+        for location in locations[:fleet_size]
+    ]
+    results["decrypt.get_result_decode_tag"] = _run(
+        "decrypt.get_result_decode_tag",
+        lambda: [decode_tag(get_result(priv, data)) for priv, data in decrypt_input],
+        items=len(decrypt_input), repeat=repeat,
+    )
+
+    for size in report_sizes:
+        name = f"create_reports.{size}"
+        results[name] = _run(
+            name,
+            lambda devices: create_reports(locations[:size], devices),
+            items=size, repeat=repeat, setup=lambda: (fixture.devices(),),
+        )
+
+    response_count = 1000
+    responses = [
+        AppleHTTPResponse(status_code=200, text=json.dumps({
+            "results": [location.model_dump(by_alias=True) for location in locations[i * 10:(i + 1) * 10]],
+            "statusCode": "200",
+        }))
+        for i in range(response_count)
+    ]
+    results[f"merge_successful_responses.{response_count}"] = _run(
+        f"merge_successful_responses.{response_count}",
+        lambda: merge_successful_responses(responses),
+        items=response_count, repeat=repeat,
+    )
+
+    ids = [device.public_hash_base64 for device in fixture.simulator.devices]
+    end_date = unix_epoch()
+    results[f"generate_request_payloads.{lookback_days}d"] = _run(
+        f"generate_request_payloads.{lookback_days}d",
+        lambda: generate_request_payloads(
+            ids, end_date - lookback_days * 86400, end_date, device_batch_size=1, time_chunk_size=86400
+        ),
+        items=fleet_size * lookback_days, repeat=repeat,
+    )
+
+    if end_to_end:
+        simulator = AcsnserviceSimulator(fleet_size, SimulatorConfig(latency_ms=50, latency_jitter_ms=25))
+        with SimulatorThread(simulator) as simulator_thread, _pointed_at(simulator_thread):
+            credentials_service = APICredentialsService(api_key="", base_url=f"{simulator_thread.base_url}/credentials")
+            results["end_to_end.fetch_and_report_locations_for_devices"] = _run(
+                "end_to_end.fetch_and_report_locations_for_devices",
+                lambda: fetch_and_report_locations_for_devices(
+                    credentials_service=credentials_service, page=0, limit=fleet_size, minutes_ago=60,
+                ),
+                items=fleet_size, repeat=repeat,
+            )
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": unix_epoch(),
+            "fleet_size": fleet_size,
+        },
+        "results": results,
+    }
+
+
+def compare_with_baseline(run: dict, baseline: dict, threshold: float = None) -> list[str]:
+    """
+    Names of the benchmarks whose median regressed beyond their threshold: `threshold` when given,
+    otherwise the one stored with the baseline
+    """
+    regressions = []
+    for name, result in run["results"].items():
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        allowed_change = threshold if threshold is not None else reference.get("threshold", DEFAULT_THRESHOLD)
+        allowed = reference["median_s"] * (1 + allowed_change)
+        change = result["median_s"] / reference["median_s"] - 1
+        logger.info(f"{name}: {change:+.1%} vs baseline")
+        if result["median_s"] > allowed:
+            regressions.append(name)
+    return regressions
+
+
+def save_baseline(run: dict, path: str, threshold: float = None):
+    for result in run["results"].values():
+        result.setdefault("threshold", threshold if threshold is not None else DEFAULT_THRESHOLD)
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+
+
+def load_baseline(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
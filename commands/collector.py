@@ -0,0 +1,127 @@
+"""
+Long-running collector: runs collection cycles on a schedule, keeping the device registry, derived keys,
+HTTP connections and credentials warm between cycles.
+"""
+import logging
+import signal
+import threading
+import time
+
+from app.apple_fetch import persistent_event_loop
+from app.device_service import fetch_device_registry, report_locations_for_devices
+from app.dtos import BeamerDevice
+from app.metrics import metrics, start_metrics_server
+from app.profiling import profile_run
+from app.scheduler import PollingScheduler
+from app.settings import settings
+from commands.location_and_reports import credentials_pool, key_index, report_store
+
+logger = logging.getLogger(__name__)
+
+
+class Collector:
+    def __init__(
+            self,
+            interval: int,
+            minutes_ago: int,
+            limit: int = settings.DEVICE_BATCH_SIZE,
+            send_reports: bool = True,
+            registry_refresh_cycles: int = 12,
+            scheduler: PollingScheduler = None,
+    ):
+        self.interval = interval
+        self.minutes_ago = minutes_ago
+        self.limit = limit
+        self.send_reports = send_reports
+        self.registry_refresh_cycles = registry_refresh_cycles
+        self.scheduler = scheduler
+        self.cycles = 0
+        self._devices: list[BeamerDevice] = []
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        if not self._stop.is_set():
+            logger.info("Shutdown requested - finishing the current cycle")
+        self._stop.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        with persistent_event_loop():
+            next_run = time.monotonic()
+            while not self._stop.is_set():
+                self.run_cycle()
+
+                # Cycles never overlap: a cycle that overran its slot is followed by the next one right away
+                next_run += self.interval
+                now = time.monotonic()
+                if next_run < now:
+                    skipped = int((now - next_run) // self.interval) + 1
+                    logger.warning(f"Cycle overran the {self.interval}s interval, skipping {skipped} slot(s)")
+                    next_run += skipped * self.interval
+                self._stop.wait(max(0.0, next_run - now))
+
+        logger.info(f"Collector stopped after {self.cycles} cycles")
+
+    def run_cycle(self):
+        started_at = time.perf_counter()
+        try:
+            with profile_run():
+                devices = self._registry()
+                devices_with_reports = report_locations_for_devices(
+                    credentials_service=credentials_pool,
+                    devices=devices,
+                    minutes_ago=self.minutes_ago,
+                    send_reports=self.send_reports,
+                    scheduler=self.scheduler,
+                    store=report_store,
+                    key_index=key_index,
+                )
+        except Exception as e:
+            logger.exception(f"Collection cycle failed: {e}")
+            metrics.increment("collector_cycles_total", outcome="failed")
+            return
+        finally:
+            self.cycles += 1
+
+        duration = time.perf_counter() - started_at
+        metrics.increment("collector_cycles_total", outcome="succeeded")
+        metrics.observe("collector_cycle_seconds", duration)
+        logger.info(
+            f"Cycle {self.cycles}: {len(devices_with_reports)}/{len(devices)} devices with reports in {duration:.1f}s "
+            f"({len(devices) / duration:.1f} devices/s)"
+        )
+
+    def _registry(self) -> list[BeamerDevice]:
+        """Devices of the previous cycle (keeping their derived keys), reloaded every `registry_refresh_cycles`"""
+        if not self._devices or self.cycles % self.registry_refresh_cycles == 0:
+            self._devices = fetch_device_registry(self.limit)
+            logger.info(f"Loaded {len(self._devices)} devices into the registry")
+        for device in self._devices:
+            device.report = None
+            device.track = None
+        return self._devices
+
+
+def run_collector(
+        interval: int,
+        minutes_ago: int,
+        limit: int = settings.DEVICE_BATCH_SIZE,
+        send_reports: bool = True,
+        registry_refresh_cycles: int = 12,
+        metrics_port: int = None,
+        adaptive: bool = False,
+        schedule_state: str = None,
+):
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    Collector(
+        interval=interval,
+        # Never look back less than one interval, so nothing falls between two cycles
+        minutes_ago=max(minutes_ago, -(-interval // 60)),
+        limit=limit,
+        send_reports=send_reports,
+        registry_refresh_cycles=registry_refresh_cycles,
+        scheduler=PollingScheduler(schedule_state) if adaptive else None,
+    ).run()
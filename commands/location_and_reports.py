@@ -1,15 +1,30 @@
 import logging
 
 from app.credentials.api import api_credentials_service
+from app.credentials.breaker import CredentialsCircuitBreaker, LocalBreakerStore
+from app.credentials.pool import CredentialsPool
 from app.dtos import BeamerDevice
+from app.key_index import KeyIndex
 from app.helpers import retry_on_apple_auth_expired
 from app.models import ICloudCredentials
+from app.report import ReportMode
 from app.settings import settings
+from app.store import ReportStore
 from app.device_service import fetch_and_report_locations_for_devices
 from app.credentials.api import api_credentials_service
 
 logger = logging.getLogger(__name__)
 
+credentials_pool = CredentialsPool.from_client_ids(
+    api_credentials_service,
+    settings.credentials_client_ids,
+    breaker=CredentialsCircuitBreaker(
+        LocalBreakerStore(), max_wait=settings.CREDENTIALS_BREAKER_LONG_RUN_MAX_WAIT_SECONDS
+    ) if settings.CREDENTIALS_BREAKER_ENABLED else None,
+)
+report_store = ReportStore(settings.REPORT_STORE_PATH) if settings.REPORT_STORE_PATH else None
+key_index = KeyIndex(settings.KEY_INDEX_PATH) if settings.KEY_INDEX_PATH else None
+
 
 def resolve_locations(
         tracker_ids: set[str] = None,
@@ -18,14 +33,18 @@ def resolve_locations(
         send_reports: bool = True,
         minutes_ago: int = 15,
         print_report: bool = False,
+        report_mode: ReportMode = "latest",
 ) -> None:
     devices: list[BeamerDevice] = fetch_and_report_locations_for_devices(
-        credentials_service=api_credentials_service,
+        credentials_service=credentials_pool,
         page=page,
         limit=limit,
         minutes_ago=minutes_ago,
         trackers_filter=tracker_ids,
         send_reports=send_reports,
+        store=report_store,
+        report_mode=report_mode,
+        key_index=key_index,
     )
 
     if print_report:
@@ -33,4 +52,6 @@ def resolve_locations(
             logger.info('*****************************************')
             logger.info(f'Fetched locations for device: {device.name} ({device.id})')
             logger.info(f'Report: {device.report}')
+            if device.track is not None:
+                logger.info(f'Track: {len(device.track)} reports')
             logger.info('*****************************************')
@@ -0,0 +1,150 @@
+"""
+Page-parallel collection: device pages are fetched and decrypted by a process pool, while the coordinator
+(this process) serves the credentials to all workers and uploads the reports of finished pages.
+"""
+import logging
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.api import fetch_devices_metadata_from_space_invader_api
+from app.credentials.base import CredentialsService
+from app.credentials.breaker import CredentialsCircuitBreaker
+from app.credentials.pool import CredentialsPool
+from app.credentials.shared import BrokeredCredentialsService, CoordinatorManager
+from app.device_service import build_report_payloads, fetch_and_report_locations_for_devices, upload_report_payloads
+from app.freshness import FreshnessTracker, published_seconds
+from app.key_index import KeyIndex
+from app.profiling import profile_run
+from app.report import ReportMode
+from app.settings import settings
+from app.store import ReportStore
+
+logger = logging.getLogger(__name__)
+
+# Per worker process, set up by `_init_worker`
+_worker_state: dict = {}
+
+
+def _init_worker(broker, breaker_store):
+    # Connections and caches are per process: nothing opened by the coordinator is reused after the fork
+    _worker_state["credentials_pool"] = CredentialsPool.from_client_ids(
+        BrokeredCredentialsService(broker),
+        settings.credentials_client_ids,
+        breaker=CredentialsCircuitBreaker(
+            breaker_store, max_wait=settings.CREDENTIALS_BREAKER_LONG_RUN_MAX_WAIT_SECONDS
+        ) if breaker_store is not None else None,
+    )
+    _worker_state["store"] = ReportStore(settings.REPORT_STORE_PATH) if settings.REPORT_STORE_PATH else None
+    _worker_state["key_index"] = KeyIndex(settings.KEY_INDEX_PATH) if settings.KEY_INDEX_PATH else None
+
+
+def _collect_page(
+        page: int,
+        limit: int,
+        minutes_ago: int,
+        report_mode: ReportMode,
+        send_reports: bool,
+) -> dict:
+    with profile_run() as profile:
+        devices_with_reports = fetch_and_report_locations_for_devices(
+            credentials_service=_worker_state["credentials_pool"],
+            page=page,
+            limit=limit,
+            minutes_ago=minutes_ago,
+            send_reports=False,
+            store=_worker_state["store"],
+            report_mode=report_mode,
+            key_index=_worker_state["key_index"],
+        )
+        report_payloads = build_report_payloads(devices_with_reports) if send_reports else []
+    return {
+        "page": page,
+        "devices_with_reports": len(devices_with_reports),
+        "report_payloads": report_payloads,
+        "published_at": [published_seconds(device.report.date_published) for device in devices_with_reports]
+        if send_reports else [],
+        "profile": profile.as_dict(),
+    }
+
+
+def _count_pages(limit: int) -> tuple[int, int]:
+    device_response = fetch_devices_metadata_from_space_invader_api(
+        settings.get_haystacks_endpoint, headers=settings.headers, limit=1, page=0
+    )
+    total = device_response.meta.total
+    return total, math.ceil(total / limit)
+
+
+def run_parallel_collection(
+        credentials_service: CredentialsService,
+        workers: int,
+        limit: int,
+        minutes_ago: int,
+        report_mode: ReportMode = "latest",
+        send_reports: bool = True,
+) -> dict:
+    """Collect all device pages on `workers` processes, returns the combined summary"""
+    started_at = time.perf_counter()
+    total_devices, page_count = _count_pages(limit)
+    logger.info(f"Collecting {total_devices} devices in {page_count} pages of {limit} on {workers} workers")
+
+    summary = {
+        "devices": total_devices,
+        "pages": page_count,
+        "failed_pages": [],
+        "devices_with_reports": 0,
+        "uploaded_reports": 0,
+        "phases": {},
+    }
+    freshness = FreshnessTracker()
+    with CoordinatorManager() as manager:
+        broker = manager.CredentialsBroker(credentials_service)
+        # Workers pause together on credential expiry, like the Lambda shards
+        breaker_store = manager.BreakerStore() if settings.CREDENTIALS_BREAKER_ENABLED else None
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(broker, breaker_store)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _collect_page, page, limit, minutes_ago, report_mode, send_reports
+                ): page
+                for page in range(page_count)
+            }
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.exception(f"Page {page} failed: {e}")
+                    summary["failed_pages"].append(page)
+                    continue
+
+                # Pages are uploaded as they finish, while the workers carry on with the next ones
+                if result["report_payloads"]:
+                    summary["uploaded_reports"] += upload_report_payloads(
+                        result["report_payloads"], result["published_at"], freshness
+                    )
+                summary["devices_with_reports"] += result["devices_with_reports"]
+                _merge_phases(summary["phases"], result["profile"]["phases"])
+                logger.info(f"Page {page} done: {result['devices_with_reports']} devices with reports")
+        summary["credential_fetches"] = broker.get_fetch_count()
+
+    summary["wall_s"] = round(time.perf_counter() - started_at, 3)
+    summary["devices_per_s"] = round(total_devices / summary["wall_s"], 1) if summary["wall_s"] else None
+    summary["phases"] = list(summary["phases"].values())
+    summary["freshness"] = freshness.summary()
+    logger.info(f"Parallel collection summary: {summary}")
+    return summary
+
+
+def _merge_phases(total: dict, phases: list[dict]):
+    """Sum the phase stats of the workers (CPU and wall seconds add up across processes)"""
+    for phase in phases:
+        merged = total.setdefault(
+            phase["phase"], {"phase": phase["phase"], "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "items": 0}
+        )
+        merged["calls"] += phase["calls"]
+        merged["wall_s"] = round(merged["wall_s"] + phase["wall_s"], 4)
+        merged["cpu_s"] = round(merged["cpu_s"] + phase["cpu_s"], 4)
+        merged["items"] += phase["items"]
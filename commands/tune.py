@@ -0,0 +1,227 @@
+"""
+Auto-tuning of the fetch and upload throughput knobs: every knob is swept in turn (keeping the best values found
+so far for the others) against the local simulator or a recorded cassette, and the best values are written
+as a tuned profile that `settings` loads at startup.
+"""
+import json
+import logging
+import statistics
+import time
+from contextlib import contextmanager
+
+from app.apple_fetch import plan_request_payloads, response_cache
+from app.api import fetch_devices_metadata_from_space_invader_api
+from app.cassette import REPLAY, use_cassette
+from app.credentials.api import APICredentialsService, api_credentials_service
+from app.credentials.base import CredentialsService
+from app.date import unix_epoch
+from app.device_service import build_report_payloads, report_locations_for_devices, upload_report_payloads
+from app.metrics import metrics
+from app.settings import settings
+from app.simulator import AcsnserviceSimulator, SimulatorConfig, SimulatorThread
+
+logger = logging.getLogger(__name__)
+
+CANDIDATES = {
+    "FETCH_CONCURRENCY": (5, 10, 20, 40, 80),
+    "FETCH_DEVICE_BATCH_SIZE": (1, 5, 20),
+    "FETCH_TIME_CHUNK_SECONDS": (6 * 3600, 24 * 3600, 7 * 24 * 3600),
+    "FETCH_SHORT_RANGE_SECONDS": (10 * 60, 20 * 60, 60 * 60),
+    "UPLOAD_BATCH_SIZE": (50, 100, 250),
+    "UPLOAD_PAUSE_SECONDS": (0, 0.1, 0.5),
+}
+# Knobs that leave the requests themselves unchanged, so recorded responses still match them. Replays do not
+# model throttling by Apple or the Haystacks API, they only measure the collector's own limits.
+REPLAYABLE = ("FETCH_CONCURRENCY", "UPLOAD_BATCH_SIZE")
+# Knobs that only change how the requests are planned: a value planning the same requests as the best one for
+# the tuned lookback would only be measured on noise
+PLANNING = ("FETCH_DEVICE_BATCH_SIZE", "FETCH_TIME_CHUNK_SECONDS", "FETCH_SHORT_RANGE_SECONDS")
+
+
+@contextmanager
+def _overridden(values: dict):
+    original = {name: getattr(settings, name) for name in values}
+    for name, value in values.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(settings, name, value)
+
+
+@contextmanager
+def _without_response_cache():
+    # Cached windows would make every trial after the first one look faster
+    enabled = response_cache.enabled
+    response_cache.enabled = False
+    try:
+        yield
+    finally:
+        response_cache.enabled = enabled
+
+
+def _error_rate() -> float:
+    responses = metrics.get("apple_fetch_responses_total").values
+    total = sum(responses.values())
+    failed = sum(count for labels, count in responses.items() if not dict(labels)["status"].startswith("2"))
+    return failed / total if total else 0.0
+
+
+def run_trial(credentials_service: CredentialsService, values: dict, minutes_ago: int, max_devices: int = 0) -> dict:
+    """One collection of all device pages with `values` applied, uploads included"""
+    with _overridden(values), _without_response_cache():
+        metrics.reset()
+        started_at = time.perf_counter()
+        devices = payloads = uploaded = 0
+        page = 0
+        while True:
+            device_response = fetch_devices_metadata_from_space_invader_api(
+                settings.get_haystacks_endpoint, headers=settings.headers, limit=settings.DEVICE_BATCH_SIZE, page=page
+            )
+            if not device_response.data:
+                break
+            devices += len(device_response.data)
+            devices_with_reports = report_locations_for_devices(
+                credentials_service=credentials_service,
+                devices=device_response.data,
+                minutes_ago=minutes_ago,
+                send_reports=False,
+            )
+            report_payloads = build_report_payloads(devices_with_reports)
+            payloads += len(report_payloads)
+            uploaded += upload_report_payloads(report_payloads)
+            page += 1
+            if page >= device_response.meta.pageCount or (max_devices and devices >= max_devices):
+                break
+        wall_s = time.perf_counter() - started_at
+
+    latency = metrics.get("apple_fetch_request_seconds")
+    return {
+        "values": dict(values),
+        "devices": devices,
+        "wall_s": round(wall_s, 3),
+        "devices_per_s": round(devices / wall_s, 1) if wall_s else 0.0,
+        "request_p50_s": latency.quantile(0.5),
+        "request_p95_s": latency.quantile(0.95),
+        "error_rate": round(_error_rate(), 4),
+        "upload_error_rate": round(1 - uploaded / payloads, 4) if payloads else 0.0,
+    }
+
+
+def _planned_requests(values: dict, minutes_ago: int, end_date: int, device_count: int = 100) -> list[tuple]:
+    """Shape (device count and window) of the requests planned with `values` for a lookback of `minutes_ago`"""
+    ids = [str(i) for i in range(device_count)]
+    with _overridden(values), _quiet("app.apple_fetch"):
+        payloads = plan_request_payloads(ids, end_date - minutes_ago * 60, end_date)
+    return [(len(payload["ids"]), payload["startDate"], payload["endDate"]) for payload in payloads]
+
+
+@contextmanager
+def _quiet(name: str):
+    planning_logger = logging.getLogger(name)
+    level = planning_logger.level
+    planning_logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        planning_logger.setLevel(level)
+
+
+def _score(trials: list[dict], max_error_rate: float) -> float:
+    """Median throughput of the repeated trials, 0 when they fail too often"""
+    if any(t["error_rate"] > max_error_rate or t["upload_error_rate"] > max_error_rate for t in trials):
+        return 0.0
+    return statistics.median(t["devices_per_s"] for t in trials)
+
+
+def tune(
+        credentials_service: CredentialsService,
+        minutes_ago: int,
+        knobs: tuple[str, ...],
+        repeat: int = 2,
+        max_error_rate: float = 0.01,
+        min_gain: float = 0.05,
+        max_devices: int = 0,
+) -> dict:
+    """
+    Coordinate descent over `knobs`, starting from the current settings. A candidate replaces the best value
+    only when its throughput is `min_gain` better, so noise does not move the defaults.
+    """
+    best = {name: getattr(settings, name) for name in knobs}
+    measured = {}
+    # Warm-up: the first run pays for connections and the simulator's payload cache
+    run_trial(credentials_service, best, minutes_ago, max_devices)
+
+    def measure(values: dict) -> float:
+        key = json.dumps(values, sort_keys=True)
+        if key not in measured:
+            trials = [run_trial(credentials_service, values, minutes_ago, max_devices) for _ in range(repeat)]
+            measured[key] = {"values": values, "score": _score(trials, max_error_rate), "trials": trials}
+            logger.info(f"{values}: {measured[key]['score']} devices/s")
+        return measured[key]["score"]
+
+    best_score = measure(dict(best))
+    for name in knobs:
+        for candidate in CANDIDATES[name]:
+            if candidate == best[name]:
+                continue
+            now = unix_epoch()
+            if name in PLANNING and _planned_requests({**best, name: candidate}, minutes_ago, now) == \
+                    _planned_requests(best, minutes_ago, now):
+                logger.info(f"Skipping {name}={candidate}: same requests as {best[name]} for {minutes_ago} minutes")
+                continue
+            score = measure({**best, name: candidate})
+            if score > best_score * (1 + min_gain):
+                logger.info(f"{name}={candidate} beats {best[name]}: {score} vs {best_score} devices/s")
+                best[name], best_score = candidate, score
+
+    return {
+        "meta": {"timestamp": unix_epoch(), "minutes_ago": minutes_ago, "devices_per_s": best_score},
+        "settings": best,
+        "measurements": list(measured.values()),
+    }
+
+
+def run_tuning(
+        output: str,
+        minutes_ago: int = 60,
+        replay: str = None,
+        fleet_size: int = 1000,
+        simulator_config: dict = None,
+        knobs: tuple[str, ...] = None,
+        limit: int = None,
+        **kwargs,
+) -> dict:
+    """
+    Tune against the cassette `replay` (recorded with pages of `limit` devices), or against a simulated fleet
+    of `fleet_size`, and write the profile
+    """
+    if replay:
+        knobs = tuple(name for name in (knobs or REPLAYABLE) if name in REPLAYABLE)
+        page_size = {"DEVICE_BATCH_SIZE": limit} if limit else {}
+        with use_cassette(replay, REPLAY), _overridden(page_size):
+            profile = tune(api_credentials_service, minutes_ago, knobs, **kwargs)
+        profile["meta"]["target"] = f"replay:{replay}"
+    else:
+        knobs = knobs or tuple(CANDIDATES)
+        simulator = AcsnserviceSimulator(fleet_size, SimulatorConfig(**(simulator_config or {})))
+        with SimulatorThread(simulator) as simulator_thread:
+            targets = {
+                "ACSNSERVICE_URL": f"{simulator_thread.base_url}/acsnservice/fetch",
+                "BASE_URL": simulator_thread.base_url,
+            }
+            with _overridden(targets):
+                credentials_service = APICredentialsService(
+                    api_key="", base_url=f"{simulator_thread.base_url}/credentials"
+                )
+                profile = tune(credentials_service, minutes_ago, knobs, **kwargs)
+        profile["meta"]["target"] = f"simulator:{fleet_size}"
+        profile["meta"]["simulator"] = simulator.config.model_dump()
+
+    with open(output, "w") as f:
+        json.dump(profile, f, indent=2)
+    logger.info(
+        f"Tuned profile written to {output}: {profile['settings']} ({profile['meta']['devices_per_s']} devices/s)"
+    )
+    return profile
@@ -1,10 +1,16 @@
 import os
 from app.auth import api_auth_required
-from app.credentials.dynamodb import dynamodb_credentials_service
+from app.credentials.pool import CredentialsPool
+from app.credentials.breaker import CredentialsCircuitBreaker
+from app.credentials.dynamodb import DynamoDBBreakerStore, DynamoDBFetchRunStore, dynamodb_credentials_service
 from app.device_service import fetch_and_report_locations_for_devices
 from app.dtos import PutHeadersBody
-import logging.config
+from app.fetch_runs import FetchRunScheduler
+import logging
 from app.helpers import lambda_exception_handler
+from app.log import flush_logs, setup_logging
+from app.metrics import metrics
+from app.scheduler import PollingScheduler
 import json
 from app.sentry import setup_sentry
 from app.settings import settings
@@ -12,9 +18,19 @@ from app.sqs import schedule_device_location_metadata_enrichment
 
 setup_sentry()
 logger = logging.getLogger(__name__)
-with open('app/logging.json', 'rt') as f:
-    config = json.load(f)
-    logging.config.dictConfig(config)
+setup_logging(log_format=settings.LOG_FORMAT, rate_limit=settings.LOG_RATE_LIMIT_PER_MINUTE)
+
+# Kept at module level, so warm Lambda invocations reuse the cached credentials of all accounts
+# All shards share the credentials circuit breaker through the credentials table
+credentials_pool = CredentialsPool.from_client_ids(
+    dynamodb_credentials_service,
+    settings.credentials_client_ids,
+    breaker=CredentialsCircuitBreaker(DynamoDBBreakerStore()) if settings.CREDENTIALS_BREAKER_ENABLED else None,
+)
+# Polling statistics in /tmp only survive while the Lambda container stays warm
+polling_scheduler = PollingScheduler(settings.SCHEDULER_STATE_PATH) if settings.SCHEDULER_STATE_PATH else None
+# Bursts of credential updates share one fetch run
+fetch_run_scheduler = FetchRunScheduler(DynamoDBFetchRunStore())
 
 
 @lambda_exception_handler
@@ -36,13 +52,21 @@ def put_credentials(event, context):
     client_id = event['pathParameters']['client_id']
 
     logger.info(f"Received credentials: {body.headers} for client_id: {client_id}")
-    dynamodb_credentials_service.update_credentials(body.headers)
+    # Only the additional accounts of CREDENTIALS_CLIENT_IDS get items of their own, any other client id updates
+    # the default credentials item as before multiple accounts were supported
+    if client_id not in settings.credentials_client_ids:
+        client_id = None
+    dynamodb_credentials_service.update_credentials(body.headers, client_id=client_id)
     if body.schedule_data_fetching:
         logger.info("Scheduling data fetching...")
-        schedule_device_location_metadata_enrichment(
-            os.environ.get('QUEUE_URL'),
-            num_batches=1,
-            batch_size=settings.DEVICE_BATCH_SIZE
+        fetch_run_scheduler.trigger(
+            pages=1,
+            enqueue=lambda run: schedule_device_location_metadata_enrichment(
+                os.environ.get('QUEUE_URL'),
+                num_batches=run.pages,
+                batch_size=settings.DEVICE_BATCH_SIZE,
+                run=run,
+            ),
         )
 
     return {
@@ -93,13 +117,29 @@ def fetch_locations_and_report(event, context):
             "body": json.dumps({"error": "Page value must be an integer"})
         }
 
-    logger.info(f"Processing page: {page}")
-    fetch_and_report_locations_for_devices(
-        credentials_service=dynamodb_credentials_service,
-        page=page,
-        limit=limit,
-        minutes_ago=15
-    )
+    run_id = message_body.get('run_id')
+    logger.info(f"Processing page: {page}{f' of fetch run {run_id}' if run_id else ''}")
+    try:
+        if run_id:
+            fetch_run_scheduler.started(run_id, int(message_body['triggered_at']))
+        try:
+            fetch_and_report_locations_for_devices(
+                credentials_service=credentials_pool,
+                page=page,
+                limit=limit,
+                minutes_ago=15,
+                scheduler=polling_scheduler,
+            )
+        except Exception:
+            # A failed run must not hold back the next credentials trigger until it times out
+            if run_id:
+                fetch_run_scheduler.abandon(run_id)
+            raise
+        if run_id:
+            fetch_run_scheduler.finished(run_id)
+    finally:
+        metrics.flush_emf()
+        flush_logs()
 
     return {
         "statusCode": 200,
@@ -1,8 +1,18 @@
+import cProfile
+import contextlib
+import functools
+import pstats
 import random
 import sys
 from time import sleep
 
+from app.cassette import RECORD, REPLAY, use_cassette
+from app.date import unix_epoch
+from app.log import setup_logging
+from app.metrics import metrics
+from app.profiling import profile_run
 from app.sentry import setup_sentry
+from app.settings import settings
 import json
 import logging.config
 import click
@@ -17,9 +27,7 @@ from commands.location_and_reports import resolve_locations
 
 setup_sentry()
 logger = logging.getLogger(__name__)
-with open('app/logging.json', 'rt') as f:
-    config = json.load(f)
-    logging.config.dictConfig(config)
+setup_logging(log_format=settings.LOG_FORMAT, rate_limit=settings.LOG_RATE_LIMIT_PER_MINUTE)
 
 
 @click.group()
@@ -34,25 +42,266 @@ def cli():
     help='Comma-separated list of trackers. E.g: E0D4FA128FA9,EC3987ECAA50,CDAA0CCF4128,EDDC7DA1A247,D173D540749D'
 )
 @click.option('--limit', '-l', default=2500, help='Number of locations to fetch')
-@click.option('--page', '-p', default=0, help='Page number for pagination')
+@click.option('--page', '-p', default=0, help='Page number for pagination (ignored with --trackers)')
 @click.option('--minutes-ago', '-ma', default=24, help='Number of minutes ago to fetch locations for')
 @click.option('--send-reports', '-s', is_flag=True, default=False, help='Whether to send reports')
+@click.option('--profile', is_flag=True, default=False, help='Print a phase timing report and dump a cProfile profile')
+@click.option('--profile-output', default='fetch-locations.prof', help='File for the cProfile dump (see --profile)')
+@click.option('--metrics-file', default=None, help='Write Prometheus text metrics of the run to this file')
+@click.option(
+    '--report-mode', type=click.Choice(['latest', 'history']), default='latest',
+    help='Keep only the newest report per device, or every report (uploaded as a downsampled track)'
+)
+@click.option(
+    '--record', default=None,
+    help='Record the Apple and Haystacks API traffic into this cassette (.jsonl.gz), device private keys redacted'
+)
+@click.option(
+    '--record-keys', is_flag=True, default=False,
+    help='Keep the device private keys in the --record cassette, so replays decrypt (the cassette is then a secret)'
+)
+@click.option('--replay', default=None, help='Answer Apple and Haystacks API requests from this cassette, offline')
+@click.option('--replay-speed', default=1.0, help='Replay speed-up of the recorded latencies (0 = no delays)')
+@click.option('--workers', '-w', default=1, help='Worker processes (with --all-pages)')
+@click.option('--all-pages', is_flag=True, default=False, help='Collect every page of the fleet instead of --page')
 def fetch_locations(
         trackers: str,
         limit: int,
         page: int,
         send_reports: bool,
-        minutes_ago: int
+        minutes_ago: int,
+        profile: bool,
+        profile_output: str,
+        metrics_file: str,
+        report_mode: str,
+        record: str,
+        record_keys: bool,
+        replay: str,
+        replay_speed: float,
+        workers: int,
+        all_pages: bool,
 ) -> None:
     tracker_ids = set(trackers.split(',')) if trackers else None
-    resolve_locations(
+    if workers > 1 and not all_pages:
+        raise click.UsageError('--workers needs --all-pages')
+    if record and replay:
+        raise click.UsageError('Use either --record or --replay')
+    if record_keys and not record:
+        raise click.UsageError('--record-keys needs --record')
+    if (record or replay) and all_pages:
+        raise click.UsageError('Cassettes are not supported with --all-pages')
+    if tracker_ids and all_pages:
+        raise click.UsageError('--trackers are looked up across all pages already, drop --all-pages')
+    if all_pages:
+        from app.credentials.api import api_credentials_service
+        from commands.parallel import run_parallel_collection
+
+        run_parallel_collection(
+            credentials_service=api_credentials_service,
+            workers=workers,
+            limit=limit,
+            minutes_ago=minutes_ago,
+            report_mode=report_mode,
+            send_reports=send_reports,
+        )
+        return
+
+    run = functools.partial(
+        resolve_locations,
         tracker_ids=tracker_ids,
         limit=limit,
         page=page,
         send_reports=send_reports,
         minutes_ago=minutes_ago,
         print_report=True,
+        report_mode=report_mode,
     )
+    if record or replay:
+        cassette = use_cassette(
+            record or replay, RECORD if record else REPLAY, speed=replay_speed, keep_keys=record_keys
+        )
+    else:
+        cassette = contextlib.nullcontext()
+    with cassette:
+        try:
+            if not profile:
+                run()
+                return
+
+            profiler = cProfile.Profile()
+            with profile_run(trace_memory=True) as run_profile:
+                profiler.runcall(run)
+            profiler.dump_stats(profile_output)
+            click.echo(run_profile.report())
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+            click.echo(f'Profile written to {profile_output} (inspect with `python -m pstats {profile_output}`)')
+        finally:
+            if metrics_file:
+                metrics.write_prometheus(metrics_file)
+
+
+@cli.command()
+@click.option('--interval', '-i', default=300, help='Seconds between the starts of two collection cycles')
+@click.option('--limit', '-l', default=2500, help='Page size used to load the device registry')
+@click.option('--minutes-ago', '-ma', default=15, help='Lookback per cycle (never less than the interval)')
+@click.option('--send-reports/--no-send-reports', default=True, help='Whether to send reports')
+@click.option('--registry-refresh-cycles', default=12, help='Reload the device registry every N cycles')
+@click.option('--metrics-port', default=None, type=int, help='Serve Prometheus metrics on this port')
+@click.option('--adaptive', is_flag=True, default=False, help='Poll devices adaptively based on their report history')
+@click.option('--schedule-state', default=None, help='File to persist the adaptive polling statistics in')
+def collect(
+        interval: int,
+        limit: int,
+        minutes_ago: int,
+        send_reports: bool,
+        registry_refresh_cycles: int,
+        metrics_port: int,
+        adaptive: bool,
+        schedule_state: str,
+) -> None:
+    """Run collection cycles until SIGTERM / Ctrl+C"""
+    from commands.collector import run_collector
+
+    run_collector(
+        interval=interval,
+        minutes_ago=minutes_ago,
+        limit=limit,
+        send_reports=send_reports,
+        registry_refresh_cycles=registry_refresh_cycles,
+        metrics_port=metrics_port,
+        adaptive=adaptive,
+        schedule_state=schedule_state,
+    )
+
+
+@cli.command()
+@click.option('--from', 'from_date', required=True, help='Start of the backfill (ISO date or date-time, UTC by default)')
+@click.option('--to', 'to_date', default=None, help='End of the backfill (default: now)')
+@click.option('--workers', '-w', default=4, help='Work units fetched in parallel')
+@click.option('--devices-per-unit', default=100, help='Devices per work unit (each unit covers one day)')
+@click.option('--state', default='backfill-state.jsonl', help='Checkpoint file, an interrupted backfill resumes from it')
+@click.option('--output', '-o', default='backfill-reports.jsonl', help='File the decrypted reports are appended to')
+@click.option(
+    '--trackers', '-t', default='', help='Comma-separated list of trackers to backfill (default: the whole fleet)'
+)
+@click.option('--limit', '-l', default=2500, help='Page size used to load the device registry')
+@click.option('--store', default=None, help='Also append the reports to this report store (see `query`)')
+def backfill(
+        from_date: str,
+        to_date: str,
+        workers: int,
+        devices_per_unit: int,
+        state: str,
+        output: str,
+        trackers: str,
+        limit: int,
+        store: str,
+) -> None:
+    """Fetch the location history of a time range, resuming where a previous run stopped"""
+    from app.store import ReportStore
+    from commands.backfill import parse_date, run_backfill
+    from commands.location_and_reports import credentials_pool, key_index, report_store
+
+    finished = run_backfill(
+        credentials_service=credentials_pool,
+        start_date=parse_date(from_date),
+        end_date=parse_date(to_date) if to_date else unix_epoch(),
+        state_path=state,
+        output_path=output,
+        workers=workers,
+        devices_per_unit=devices_per_unit,
+        trackers_filter=set(trackers.split(',')) if trackers else None,
+        limit=limit,
+        store=ReportStore(store) if store else report_store,
+        key_index=key_index,
+    )
+    if not finished:
+        click.echo(f'Backfill incomplete, run the same command again to resume from {state}', err=True)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--store', default=None, help='Report store to query (default: REPORT_STORE_PATH)')
+@click.option('--from', 'from_date', default=None, help='Start of the time range (ISO date or date-time, UTC by default)')
+@click.option('--to', 'to_date', default=None, help='End of the time range (exclusive)')
+@click.option('--device', '-d', 'device_ids', multiple=True, help='Device id to query (repeatable)')
+@click.option('--bbox', default=None, help='Bounding box as min_lat,min_lon,max_lat,max_lon')
+@click.option('--limit', '-l', default=None, type=int, help='Maximum number of reports')
+def query(
+        store: str,
+        from_date: str,
+        to_date: str,
+        device_ids: tuple[str, ...],
+        bbox: str,
+        limit: int,
+) -> None:
+    """Print stored reports as JSON lines, ordered by device and timestamp"""
+    from app.settings import settings
+    from app.store import ReportStore
+    from commands.backfill import parse_date
+
+    path = store or settings.REPORT_STORE_PATH
+    if not path:
+        raise click.UsageError('Pass --store or set REPORT_STORE_PATH')
+    if bbox:
+        bbox = tuple(float(value) for value in bbox.split(','))
+        if len(bbox) != 4:
+            raise click.BadParameter('Expected min_lat,min_lon,max_lat,max_lon', param_hint='--bbox')
+
+    reports = ReportStore(path).query(
+        start_date=parse_date(from_date) if from_date else None,
+        end_date=parse_date(to_date) if to_date else None,
+        device_ids=list(device_ids),
+        bbox=bbox or None,
+        limit=limit,
+    )
+    for report in reports:
+        click.echo(json.dumps(report))
+
+
+@cli.command()
+@click.option('--plist-dir', default='/tmp/plists', help='Directory searched recursively for .plist files')
+@click.option('--url', default='', help='Endpoint the devices are PUT to (nothing is uploaded without it)')
+@click.option('--output', '-o', default=None, help='Also write the devices as JSON lines to this file')
+@click.option('--workers', '-w', default=None, type=int, help='Parsing processes (default: CPU count)')
+@click.option(
+    '--batch-devices', default=0,
+    help='Maximum devices per upload request (0 = one request). Only split when the endpoint merges PUTs'
+)
+@click.option('--batch-bytes', default=0, help='Maximum JSON size per upload request (0 = one request)')
+def export_devices(
+        plist_dir: str,
+        url: str,
+        output: str,
+        workers: int,
+        batch_devices: int,
+        batch_bytes: int,
+) -> None:
+    """Ingest device keys from plists, with precomputed public key hashes"""
+    from app.export import ingest
+
+    counts = ingest(
+        plist_dir=plist_dir,
+        url=url,
+        headers=settings.headers,
+        output=output,
+        workers=workers,
+        max_batch_devices=batch_devices,
+        max_batch_bytes=batch_bytes,
+    )
+    if counts['failed_plists'] or counts.get('upload_failed'):
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--output', '-o', default='device-keys.idx', help='File to write the index to (use it via KEY_INDEX_PATH)')
+@click.option('--limit', '-l', default=2500, help='Page size used to load the device registry')
+def build_key_index(output: str, limit: int) -> None:
+    """Build the memory-mapped index resolving location ids to device key material from the device registry"""
+    from app.device_service import fetch_device_registry
+    from app.key_index import KeyIndex
+
+    KeyIndex.build(fetch_device_registry(limit), output).close()
 
 
 @cli.command()
@@ -71,5 +320,129 @@ def refresh_credentials(schedule_location_fetching: bool) -> None:
             refresh_credentials_on_aws(schedule_location_fetching=False)
 
 
+@cli.command()
+@click.option('--host', default='127.0.0.1', help='Interface to listen on')
+@click.option('--port', default=8080, help='Port to listen on')
+@click.option('--devices', '-d', default=2500, help='Size of the simulated fleet')
+@click.option('--seed', default=0, help='Seed of the simulated fleet')
+@click.option('--latency-ms', default=150.0, help='Mean response latency')
+@click.option('--latency-jitter-ms', default=100.0, help='Uniform jitter around the mean latency')
+@click.option('--error-rate', default=0.0, help='Share of requests answered with a 500')
+@click.option('--unauthorized-rate', default=0.0, help='Share of requests answered with a 401')
+@click.option('--unauthorized-burst-every', default=0, help='Seconds between 401 bursts (0 disables bursts)')
+@click.option('--unauthorized-burst-duration', default=5, help='Length of each 401 burst in seconds')
+@click.option('--credentials-ttl', default=60, help='Reject credentials older than this (0 disables)')
+@click.option('--slow-request-rate', default=0.0, help='Share of requests delayed by --slow-request-ms')
+@click.option('--slow-request-ms', default=5000.0, help='Extra latency of slow requests')
+@click.option('--reports-per-hour', default=4.0, help='Reports published per active device and hour')
+@click.option('--extended-payload-ratio', default=0.3, help='Share of payloads in the longer iOS format')
+def simulate_acsnservice(host: str, port: int, devices: int, seed: int, **config) -> None:
+    """
+    Serve a synthetic fleet locally. Point the collector at it with
+    ACSNSERVICE_URL=http://127.0.0.1:8080/acsnservice/fetch BASE_URL=http://127.0.0.1:8080
+    CREDENTIALS_API_URL=http://127.0.0.1:8080/credentials
+    """
+    from app.simulator import AcsnserviceSimulator, SimulatorConfig, run_simulator
+
+    run_simulator(AcsnserviceSimulator(devices, SimulatorConfig(seed=seed, **config)), host=host, port=port)
+
+
+@cli.command()
+@click.option('--fleet-size', default=2500, help='Number of synthetic devices')
+@click.option('--report-sizes', default='10000,100000', help='Comma-separated location counts for create_reports')
+@click.option('--lookback-days', default=30, help='Lookback for the payload planning benchmark')
+@click.option('--repeat', '-r', default=3, help='Runs per benchmark (the median is reported)')
+@click.option('--skip-end-to-end', is_flag=True, default=False, help='Skip the run against the local simulator')
+@click.option('--output', '-o', default=None, help='Write the results as JSON to this file')
+@click.option('--save-baseline', default=None, help='Store the results as the baseline in this file')
+@click.option('--compare', '-c', default=None, help='Compare against the baseline in this file')
+@click.option(
+    '--threshold', default=None, type=float,
+    help='Allowed slowdown vs the baseline median (0.2 = 20%), overrides the threshold stored with the baseline'
+)
+def benchmark(
+        fleet_size: int,
+        report_sizes: str,
+        lookback_days: int,
+        repeat: int,
+        skip_end_to_end: bool,
+        output: str,
+        save_baseline: str,
+        compare: str,
+        threshold: float,
+) -> None:
+    from commands import benchmark as benchmarks
+
+    run = benchmarks.run_benchmarks(
+        fleet_size=fleet_size,
+        report_sizes=tuple(int(size) for size in report_sizes.split(',') if size),
+        lookback_days=lookback_days,
+        repeat=repeat,
+        end_to_end=not skip_end_to_end,
+    )
+    if output:
+        with open(output, 'w') as f:
+            json.dump(run, f, indent=2)
+    if save_baseline:
+        benchmarks.save_baseline(run, save_baseline, threshold)
+    if compare:
+        regressions = benchmarks.compare_with_baseline(run, benchmarks.load_baseline(compare), threshold)
+        if regressions:
+            click.echo(f'Performance regressions: {", ".join(regressions)}', err=True)
+            sys.exit(1)
+
+
+@cli.command()
+@click.option('--output', '-o', default='tuned_profile.json', help='Profile to write (see TUNED_PROFILE_PATH)')
+@click.option('--minutes-ago', '-ma', default=60, help='Lookback of the measured collections')
+@click.option('--replay', default=None, help='Tune against this recorded cassette instead of the simulator')
+@click.option('--limit', '-l', default=None, type=int, help='Page size the cassette was recorded with')
+@click.option('--fleet-size', default=1000, help='Size of the simulated fleet')
+@click.option('--latency-ms', default=150.0, help='Mean simulated acsnservice latency')
+@click.option('--max-concurrent-requests', default=40, help='Simulated acsnservice throttling (0 = unlimited)')
+@click.option('--max-upload-reports-per-second', default=500.0, help='Simulated upload throttling (0 = unlimited)')
+@click.option('--knob', '-k', 'knobs', multiple=True, help='Only sweep this setting (repeatable)')
+@click.option('--repeat', '-r', default=2, help='Runs per candidate (the median is compared)')
+@click.option('--max-error-rate', default=0.01, help='Candidates with more failed requests than this are rejected')
+@click.option('--max-devices', default=0, help='Stop each run after this many devices (0 = all pages)')
+def tune(
+        output: str,
+        minutes_ago: int,
+        replay: str,
+        limit: int,
+        fleet_size: int,
+        latency_ms: float,
+        max_concurrent_requests: int,
+        max_upload_reports_per_second: float,
+        knobs: tuple[str, ...],
+        repeat: int,
+        max_error_rate: float,
+        max_devices: int,
+) -> None:
+    """Sweep the fetch and upload throughput settings and write the fastest combination as a tuned profile"""
+    from commands.tune import CANDIDATES, run_tuning
+
+    unknown = set(knobs) - set(CANDIDATES)
+    if unknown:
+        raise click.BadParameter(f'Unknown knobs {", ".join(sorted(unknown))}, choose from {", ".join(CANDIDATES)}')
+    profile = run_tuning(
+        output=output,
+        minutes_ago=minutes_ago,
+        replay=replay,
+        limit=limit,
+        fleet_size=fleet_size,
+        simulator_config={
+            "latency_ms": latency_ms,
+            "max_concurrent_requests": max_concurrent_requests,
+            "max_upload_reports_per_second": max_upload_reports_per_second,
+        },
+        knobs=knobs or None,
+        repeat=repeat,
+        max_error_rate=max_error_rate,
+        max_devices=max_devices,
+    )
+    click.echo(json.dumps(profile["settings"], indent=2))
+
+
 if __name__ == '__main__':
     cli()
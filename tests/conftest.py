@@ -0,0 +1,10 @@
+import os
+
+# `app.settings` requires these, the tested code never uses them
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("PASSWD", "test")
+os.environ.setdefault("CREDENTIALS_API_KEY", "test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-central-1")
+os.environ.setdefault("SENTRY_ENABLED", "false")
+# A tuned profile in the working directory must not change the tested defaults
+os.environ.setdefault("TUNED_PROFILE_PATH", "")
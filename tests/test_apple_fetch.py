@@ -0,0 +1,60 @@
+from app.apple_fetch import create_aligned_time_chunks, generate_request_payloads
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+def _covers(chunks: list[tuple[int, int]], start: int, end: int) -> bool:
+    return chunks[0][0] == start and chunks[-1][1] == end and all(
+        previous[1] == current[0] for previous, current in zip(chunks, chunks[1:])
+    )
+
+
+def test_aligned_chunks_without_chunk_size():
+    start, end = 10 * DAY + 1234, 10 * DAY + 5 * HOUR + 99
+
+    chunks = create_aligned_time_chunks(start, end, bucket_size=HOUR)
+
+    assert chunks == [(10 * DAY, 10 * DAY + 5 * HOUR), (10 * DAY + 5 * HOUR, end)]
+
+
+def test_aligned_chunks_split_closed_buckets():
+    start, end = 10 * DAY + 30 * 60, 12 * DAY + 2 * HOUR + 5
+
+    chunks = create_aligned_time_chunks(start, end, bucket_size=HOUR, time_chunk_size=DAY)
+
+    assert _covers(chunks, 10 * DAY, end)
+    assert chunks[:-1] == [(10 * DAY, 11 * DAY), (11 * DAY, 12 * DAY), (12 * DAY, 12 * DAY + 2 * HOUR)]
+    # The open bucket is a window of its own
+    assert chunks[-1] == (12 * DAY + 2 * HOUR, end)
+
+
+def test_aligned_chunks_are_stable_across_runs():
+    first = create_aligned_time_chunks(10 * DAY + 5, 10 * DAY + 3 * HOUR + 10, bucket_size=HOUR)
+    second = create_aligned_time_chunks(10 * DAY + 700, 10 * DAY + 3 * HOUR + 900, bucket_size=HOUR)
+
+    assert first[:-1] == second[:-1]
+
+
+def test_aligned_chunks_within_one_bucket():
+    assert create_aligned_time_chunks(DAY + 10, DAY + 20, bucket_size=HOUR) == [(DAY, DAY + 20)]
+
+
+def test_aligned_chunks_end_on_boundary():
+    assert create_aligned_time_chunks(DAY + 10, DAY + 2 * HOUR, bucket_size=HOUR) == [(DAY, DAY + 2 * HOUR)]
+
+
+def test_chunk_size_rounded_to_buckets():
+    chunks = create_aligned_time_chunks(0, 4 * HOUR, bucket_size=HOUR, time_chunk_size=90 * 60)
+
+    assert chunks == [(0, HOUR), (HOUR, 2 * HOUR), (2 * HOUR, 3 * HOUR), (3 * HOUR, 4 * HOUR)]
+
+
+def test_payloads_newest_window_first():
+    payloads = generate_request_payloads(
+        ["a", "b", "c"], 0, 2 * DAY, device_batch_size=2, time_chunk_size=DAY
+    )
+
+    assert [(payload["ids"], payload["startDate"]) for payload in payloads] == [
+        (["a", "b"], DAY * 1000), (["c"], DAY * 1000), (["a", "b"], 0), (["c"], 0),
+    ]
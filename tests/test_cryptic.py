@@ -0,0 +1,26 @@
+from app.cryptic import PAYLOAD_LENGTH, UNCOMPRESSED_POINT_PREFIX, validate_payload
+
+
+def _payload(extra: int = 0, prefix: int = UNCOMPRESSED_POINT_PREFIX) -> bytes:
+    data = bytearray(PAYLOAD_LENGTH + extra)
+    data[5 + extra] = prefix
+    return bytes(data)
+
+
+def test_valid_payload():
+    assert validate_payload(_payload()) is None
+
+
+def test_longer_ios_payload():
+    assert validate_payload(_payload(extra=1)) is None
+    assert validate_payload(_payload(extra=40)) is None
+
+
+def test_truncated_payload():
+    assert validate_payload(b"") == "truncated"
+    assert validate_payload(_payload()[:-1]) == "truncated"
+
+
+def test_point_prefix():
+    assert validate_payload(_payload(prefix=0x02)) == "point_prefix"
+    assert validate_payload(_payload(extra=3, prefix=0x00)) == "point_prefix"
@@ -0,0 +1,109 @@
+import pytest
+
+from app.fetch_runs import FINISHED, QUEUED, RUNNING, FetchRun, FetchRunScheduler, LocalFetchRunStore
+
+COALESCE = 600
+TIMEOUT = 900
+
+
+@pytest.fixture
+def store() -> LocalFetchRunStore:
+    return LocalFetchRunStore()
+
+
+@pytest.fixture
+def scheduler(store) -> FetchRunScheduler:
+    return FetchRunScheduler(store, coalesce_seconds=COALESCE, run_timeout=TIMEOUT)
+
+
+def _run(run_id: str, queued_at: int) -> FetchRun:
+    return FetchRun(run_id=run_id, queued_at=queued_at, changed_at=queued_at)
+
+
+def _enqueued():
+    runs = []
+    return runs, runs.append
+
+
+def test_first_trigger_queues_a_run(scheduler, store):
+    runs, enqueue = _enqueued()
+
+    run = scheduler.trigger(pages=3, enqueue=enqueue, now=1000)
+
+    assert runs == [run]
+    assert (store.get().run_id, store.get().status, store.get().pages) == (run.run_id, QUEUED, 3)
+
+
+def test_burst_is_coalesced(scheduler, store):
+    runs, enqueue = _enqueued()
+    scheduler.trigger(pages=1, enqueue=enqueue, now=1000)
+
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1010) is None
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1020) is None
+    assert len(runs) == 1
+    assert store.get().triggers == 3
+
+
+def test_in_flight_run_is_not_replaced(scheduler, store):
+    runs, enqueue = _enqueued()
+    run = scheduler.trigger(pages=2, enqueue=enqueue, now=1000)
+    scheduler.started(run.run_id, triggered_at=1000)
+
+    # Past the coalescing window, but the run is still running
+    assert store.claim(_run("2000", 1000 + COALESCE + 1), COALESCE, TIMEOUT) is False
+    assert store.get().status == RUNNING
+
+
+def test_finished_run_allows_a_new_one_after_the_window(scheduler, store):
+    runs, enqueue = _enqueued()
+    run = scheduler.trigger(pages=2, enqueue=enqueue, now=1000)
+    scheduler.started(run.run_id, triggered_at=1000)
+    scheduler.finished(run.run_id)
+    assert store.get().status == RUNNING
+    scheduler.finished(run.run_id)
+    assert store.get().status == FINISHED
+
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1000 + COALESCE - 1) is None
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1000 + COALESCE) is not None
+    assert len(runs) == 2
+
+
+def test_stale_run_is_replaced(store):
+    store.claim(_run("1000", 1000), COALESCE, TIMEOUT)
+    assert store.claim(_run("1500", 1000 + TIMEOUT - 1), COALESCE, TIMEOUT) is False
+
+    assert store.claim(_run("2000", 1000 + TIMEOUT), COALESCE, TIMEOUT) is True
+    assert store.get().run_id == "2000"
+
+
+def test_abandoned_run_does_not_coalesce(scheduler, store):
+    runs, enqueue = _enqueued()
+    run = scheduler.trigger(pages=1, enqueue=enqueue, now=1000)
+    scheduler.abandon(run.run_id)
+
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1010) is not None
+    assert len(runs) == 2
+
+
+def test_failed_enqueue_abandons_the_run(scheduler, store):
+    def enqueue(run):
+        raise RuntimeError("queue unavailable")
+
+    with pytest.raises(RuntimeError):
+        scheduler.trigger(pages=1, enqueue=enqueue, now=1000)
+    assert store.get().status == FINISHED
+
+    runs, enqueue = _enqueued()
+    assert scheduler.trigger(pages=1, enqueue=enqueue, now=1010) is not None
+
+
+def test_transitions_of_an_old_run_are_ignored(scheduler, store):
+    runs, enqueue = _enqueued()
+    first = scheduler.trigger(pages=1, enqueue=enqueue, now=1000)
+    scheduler.abandon(first.run_id)
+    second = scheduler.trigger(pages=1, enqueue=enqueue, now=1010)
+
+    assert store.start(first.run_id) is False
+    assert store.finish_page(first.run_id) is False
+    assert store.get().run_id == second.run_id
+    assert store.get().status == QUEUED
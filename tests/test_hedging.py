@@ -0,0 +1,73 @@
+import asyncio
+
+from app.hedging import RequestHedger
+
+
+def _hedger() -> RequestHedger:
+    """Hedges every request still pending after 10 ms"""
+    hedger = RequestHedger(enabled=True, max_ratio=1, min_delay=0.01, min_samples=1)
+    hedger.latencies.observe(0.01)
+    return hedger
+
+
+def _attempts(*behaviours):
+    """`send` whose n-th call sleeps and then returns or raises as the n-th behaviour says"""
+    calls = []
+
+    async def send():
+        delay, outcome = behaviours[len(calls)]
+        calls.append(outcome)
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send, calls
+
+
+def _ok(status: int) -> bool:
+    return status == 200
+
+
+def test_disabled_sends_once():
+    send, calls = _attempts((0.05, 200))
+    hedger = _hedger()
+    hedger.enabled = False
+
+    assert asyncio.run(hedger.run(send, _ok)) == 200
+    assert len(calls) == 1
+
+
+def test_fast_primary_is_not_hedged():
+    send, calls = _attempts((0, 200))
+
+    assert asyncio.run(_hedger().run(send, _ok)) == 200
+    assert len(calls) == 1
+
+
+def test_hedge_wins_over_slow_primary():
+    send, calls = _attempts((0.2, 500), (0, 200))
+
+    assert asyncio.run(_hedger().run(send, _ok)) == 200
+    assert len(calls) == 2
+
+
+def test_fast_failed_hedge_does_not_win():
+    send, calls = _attempts((0.05, 200), (0, 500))
+
+    assert asyncio.run(_hedger().run(send, _ok)) == 200
+
+
+def test_failed_response_preferred_over_exception():
+    send, calls = _attempts((0.05, RuntimeError("timeout")), (0, 401))
+
+    assert asyncio.run(_hedger().run(send, _ok)) == 401
+
+
+def test_no_hedge_without_tokens():
+    send, calls = _attempts((0.05, 200), (0, 200))
+    hedger = _hedger()
+    hedger.max_ratio = 0
+
+    assert asyncio.run(hedger.run(send, _ok)) == 200
+    assert len(calls) == 1
@@ -0,0 +1,49 @@
+from app.quarantine import PayloadQuarantine
+
+
+def test_check_returns_reason():
+    quarantine = PayloadQuarantine()
+    quarantine.add("payload", "truncated")
+
+    assert quarantine.check("payload") == "truncated"
+    assert quarantine.check("other") is None
+
+
+def test_least_recently_seen_is_evicted():
+    quarantine = PayloadQuarantine(max_size=2)
+    quarantine.add("a", "truncated")
+    quarantine.add("b", "truncated")
+    quarantine.check("a")  # "b" is now the least recently seen
+    quarantine.add("c", "point_prefix")
+
+    assert quarantine.check("a") == "truncated"
+    assert quarantine.check("b") is None
+    assert quarantine.check("c") == "point_prefix"
+    assert len(quarantine) == 2
+    assert quarantine.evicted == 1
+
+
+def test_scope_separates_entries():
+    quarantine = PayloadQuarantine()
+    quarantine.add("payload", "decrypt", scope="key-1")
+
+    assert quarantine.check("payload", scope="key-1") == "decrypt"
+    assert quarantine.check("payload", scope="key-2") is None
+    assert quarantine.check("payload") is None
+
+
+def test_disabled_with_zero_size():
+    quarantine = PayloadQuarantine(max_size=0)
+    quarantine.add("payload", "truncated")
+
+    assert quarantine.check("payload") is None
+    assert len(quarantine) == 0
+
+
+def test_stats():
+    quarantine = PayloadQuarantine()
+    quarantine.add("a", "truncated")
+    quarantine.add("b", "truncated")
+    quarantine.add("c", "decrypt", scope="key")
+
+    assert quarantine.stats() == {"size": 3, "evicted": 0, "reasons": {"truncated": 2, "decrypt": 1}}